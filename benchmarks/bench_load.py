@@ -0,0 +1,73 @@
+"""Compare the columnar layer build with the previous row-wise one.
+
+Usage: python benchmarks/bench_load.py [n_events]
+
+"""
+import asyncio
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+import numpy as np
+import pandas as pd
+
+from eviex.indexer import LayerLevel
+from eviex.indexer import MemoryIndexer
+
+
+def generate_items(n_events, n_values=10_000, span_days=365, seed=42):
+    """Generate events uniformly spread over the time span."""
+    rng = np.random.RandomState(seed)
+    first_timestamp = datetime(2020, 1, 1).replace(tzinfo=timezone.utc)
+    offsets = np.sort(rng.randint(0, span_days * 24 * 3600, size=n_events))
+    values = rng.randint(0, n_values, size=(n_events, 3))
+    return [
+        {
+            "timestamp": first_timestamp + timedelta(seconds=int(offset)),
+            "values": [f"value-{v}" for v in row],
+        }
+        for offset, row in zip(offsets, values)
+    ]
+
+
+def legacy_load(items, min_level=LayerLevel.SECOND, max_level=LayerLevel.YEAR):
+    """Build the layers as `MemoryIndexer.load` did before the columnar build."""
+    df = pd.DataFrame(items)
+    layers = {}
+    for ll in [
+        LayerLevel.get(i) for i in range(min_level.value, max_level.value + 1)
+    ]:
+        col = f"timestamp_{ll.name.lower()}"
+        df[col] = df["timestamp"].apply(ll.transform)
+        df_level = df.groupby(col).agg({"values": sum}).reset_index()
+        df_level["values"] = df_level["values"].apply(lambda v: list(set(v)))
+        layers[ll] = df_level["values"].to_numpy()
+        df_level[col].apply(MemoryIndexer._indexify).to_numpy()
+
+    return layers
+
+
+def main():
+    """Run the benchmark and print the timings."""
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    items = generate_items(n_events)
+
+    start = time.perf_counter()
+    legacy_load(items)
+    legacy = time.perf_counter() - start
+
+    indexer = MemoryIndexer(min_level=LayerLevel.SECOND)
+    start = time.perf_counter()
+    asyncio.get_event_loop().run_until_complete(indexer.load(items))
+    columnar = time.perf_counter() - start
+
+    print(f"events:   {n_events}")
+    print(f"legacy:   {legacy:.3f}s")
+    print(f"columnar: {columnar:.3f}s")
+    print(f"speedup:  {legacy / columnar:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+"""Benchmark the load and the queries of `MemoryIndexer` on synthetic events.
+
+Each combination of the dataset parameters and of the layer levels is loaded once
+to time the load and once more under `tracemalloc` to measure its peak memory,
+then `get` is timed over narrow ranges aligned to hours, wide ranges aligned to
+days and ranges with unaligned ends. The results are written as JSON, and
+compared with the results of a previous run given as `--baseline`.
+
+Usage: python benchmarks/bench_suite.py [--events 10000,100000]
+    [--levels SECOND:YEAR,MINUTE:MONTH] [--range-unions DAY:4,MONTH:1] [--lazy]
+    [--output results.json] [--baseline previous.json]
+
+Run `python benchmarks/bench_suite.py --help` for all the options.
+
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+import numpy as np
+import pandas as pd
+
+import eviex
+from eviex.indexer import LayerLevel
+from eviex.indexer import MemoryIndexer
+
+
+FIRST_TIMESTAMP = datetime(2020, 1, 1).replace(tzinfo=timezone.utc)
+BURST_SECONDS = 3600
+DATASET_PARAMETERS = [
+    "events",
+    "values_per_event",
+    "cardinality",
+    "span_days",
+    "burstiness",
+]
+QUERY_KINDS = ["narrow", "wide", "unaligned"]
+PERCENTILES = [50, 90, 99]
+
+
+def generate_items(
+    events,
+    values_per_event=3,
+    cardinality=10_000,
+    span_days=365,
+    burstiness=0.0,
+    bursts=20,
+    seed=42,
+):
+    """Generate random events over the time span.
+
+    A `burstiness` fraction of the events is concentrated in `bursts` one hour long
+    bursts, the others are spread uniformly. Each event has between 1 and
+    `2 * values_per_event - 1` values, drawn uniformly out of `cardinality` ones.
+
+    """
+    rng = np.random.RandomState(seed)
+    span = span_days * 24 * 3600
+    bursty = int(events * burstiness)
+    starts = rng.randint(0, max(span - BURST_SECONDS, 1), size=bursts)
+    offsets = np.concatenate(
+        [
+            rng.randint(0, span, size=events - bursty),
+            rng.choice(starts, size=bursty) + rng.randint(0, BURST_SECONDS, bursty),
+        ],
+    )
+    offsets = np.sort(offsets)
+
+    counts = rng.randint(1, 2 * values_per_event, size=events)
+    values = np.array([f"value-{v}" for v in range(cardinality)], dtype="object")
+    ids = np.split(rng.randint(0, cardinality, size=counts.sum()), np.cumsum(counts))
+    return [
+        {
+            "timestamp": FIRST_TIMESTAMP + timedelta(seconds=int(offset)),
+            "values": list(values[row]),
+        }
+        for offset, row in zip(offsets, ids)
+    ]
+
+
+def generate_ranges(kind, queries, span_days, seed=42):
+    """Generate query ranges of the kind within the time span.
+
+    Narrow ranges are one to six hours long and aligned to hours, wide ones are
+    a quarter to a half of the span long and aligned to days, and unaligned ones
+    are one hour to a quarter of the span long, starting and ending at any second.
+
+    """
+    rng = np.random.RandomState(seed)
+    span = span_days * 24 * 3600
+    if kind == "narrow":
+        unit, lengths = 3600, rng.randint(1, 7, size=queries)
+    elif kind == "wide":
+        unit = 24 * 3600
+        lengths = rng.randint(
+            max(span_days // 4, 1),
+            max(span_days // 2, 1) + 1,
+            size=queries,
+        )
+    elif kind == "unaligned":
+        unit, lengths = 1, rng.randint(3600, max(span // 4, 3601), size=queries)
+    else:
+        raise ValueError(f"unknown query kind {kind}")
+
+    starts = rng.randint(0, max(span // unit - lengths.max(), 1), size=queries) * unit
+    return [
+        (
+            FIRST_TIMESTAMP + timedelta(seconds=int(start)),
+            FIRST_TIMESTAMP + timedelta(seconds=int(start + length * unit)),
+        )
+        for start, length in zip(starts, lengths)
+    ]
+
+
+def run_case(
+    items,
+    dataset,
+    min_level,
+    max_level,
+    queries,
+    range_unions=None,
+    lazy=False,
+):
+    """Load the items with the layer levels and time the queries."""
+    loop = asyncio.get_event_loop()
+    options = {
+        "min_level": min_level,
+        "max_level": max_level,
+        "range_unions": range_unions,
+        "lazy": lazy,
+    }
+
+    indexer = MemoryIndexer(**options)
+    start = time.perf_counter()
+    loop.run_until_complete(indexer.load(items))
+    load_seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    loop.run_until_complete(MemoryIndexer(**options).load(items))
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    snapshot = indexer.snapshot
+    result = {
+        "dataset": dataset,
+        "min_level": min_level.name,
+        "max_level": max_level.name,
+        "range_unions": {ll.name: span for ll, span in (range_unions or {}).items()},
+        "lazy": lazy,
+        "load_seconds": load_seconds,
+        "peak_memory_bytes": peak_memory,
+        "index_bytes": sum(layer.nbytes for layer in snapshot.layers.values())
+        + sum(v_index.nbytes for v_index in snapshot.virtual_indexes.values()),
+        "unions_bytes": sum(
+            unions.nbytes for unions in snapshot.derived.get("unions", {}).values()
+        ),
+        "postings": {
+            ll.name: len(layer.ids) for ll, layer in snapshot.layers.items()
+        },
+        "dictionary_size": len(snapshot.dictionary),
+        "get": {},
+    }
+
+    for kind in QUERY_KINDS:
+        ranges = generate_ranges(kind, queries, dataset["span_days"])
+        # The first query also pays for the lazily derived state of the snapshot.
+        indexer.get(*ranges[0])
+        latencies, sizes = [], []
+        for date_from, date_to in ranges:
+            start = time.perf_counter()
+            values = indexer.get(date_from, date_to)
+            latencies.append(time.perf_counter() - start)
+            sizes.append(len(values))
+
+        latencies = np.array(latencies) * 1000
+        result["get"][kind] = {
+            "queries": queries,
+            "mean_ms": float(latencies.mean()),
+            "max_ms": float(latencies.max()),
+            **{
+                f"p{p}_ms": float(np.percentile(latencies, p)) for p in PERCENTILES
+            },
+            "mean_results": float(np.mean(sizes)),
+        }
+
+    return result
+
+
+def compare(results, baseline):
+    """Print the relative change of the results against the baseline ones."""
+    previous = {_case_key(r): r for r in baseline["results"]}
+    print(
+        f"baseline: eviex {baseline['eviex']} on {baseline['date']}",
+        file=sys.stderr,
+    )
+    for result in results:
+        old = previous.get(_case_key(result))
+        if old is None:
+            continue
+
+        changes = [
+            ("load", result["load_seconds"], old["load_seconds"]),
+            ("peak", result["peak_memory_bytes"], old["peak_memory_bytes"]),
+            ("size", result["index_bytes"], old["index_bytes"]),
+        ] + [
+            (f"{kind} p50", result["get"][kind]["p50_ms"], old["get"][kind]["p50_ms"])
+            for kind in QUERY_KINDS
+        ]
+        print(
+            _case_name(result),
+            "  ".join(f"{name} {_change(new, old)}" for name, new, old in changes),
+            file=sys.stderr,
+        )
+
+
+def main():
+    """Run the benchmarks and write the results."""
+    args = _parse_args()
+    levels = [
+        tuple(LayerLevel[name.upper()] for name in pair.split(":"))
+        for pair in args.levels.split(",")
+    ]
+    range_unions = {}
+    if args.range_unions:
+        for pair in args.range_unions.split(","):
+            name, span = pair.split(":")
+            range_unions[LayerLevel[name.upper()]] = int(span)
+
+    results = []
+    for values in itertools.product(
+        *(_ints(getattr(args, name)) for name in DATASET_PARAMETERS[:-1]),
+        [float(b) for b in args.burstiness.split(",")],
+    ):
+        dataset = dict(zip(DATASET_PARAMETERS, values))
+        items = generate_items(**dataset, seed=args.seed)
+        for min_level, max_level in levels:
+            result = run_case(
+                items,
+                dataset,
+                min_level,
+                max_level,
+                args.queries,
+                range_unions,
+                args.lazy,
+            )
+            results.append(result)
+            print(
+                _case_name(result),
+                f"load {result['load_seconds']:.3f}s",
+                f"peak {result['peak_memory_bytes'] / 2 ** 20:.1f}MiB",
+                f"size {result['index_bytes'] / 2 ** 20:.1f}MiB",
+                *(
+                    f"{kind} p50 {result['get'][kind]['p50_ms']:.2f}ms"
+                    for kind in QUERY_KINDS
+                ),
+                file=sys.stderr,
+            )
+
+    output = {
+        "eviex": eviex.__version__,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "arguments": vars(args),
+        "results": results,
+    }
+    if args.output == "-":
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--events", default="10000,100000")
+    parser.add_argument("--values-per-event", default="3")
+    parser.add_argument("--cardinality", default="10000")
+    parser.add_argument("--span-days", default="365")
+    parser.add_argument("--burstiness", default="0.0,0.8")
+    parser.add_argument("--levels", default="SECOND:YEAR,MINUTE:YEAR,HOUR:MONTH")
+    parser.add_argument(
+        "--range-unions",
+        default="",
+        help="smallest span of the range unions of each level, as LEVEL:SPAN",
+    )
+    parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="build the layers coarser than the minimum one on demand",
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="-", help="path of the JSON results")
+    parser.add_argument("--baseline", help="path of previous JSON results")
+    return parser.parse_args()
+
+
+def _ints(values):
+    return [int(v) for v in values.split(",")]
+
+
+def _case_key(result):
+    dataset = result["dataset"]
+    return (
+        tuple(dataset[name] for name in DATASET_PARAMETERS),
+        result["min_level"],
+        result["max_level"],
+        tuple(sorted(result.get("range_unions", {}).items())),
+        result.get("lazy", False),
+    )
+
+
+def _case_name(result):
+    dataset = ",".join(f"{k}={v}" for k, v in result["dataset"].items())
+    lazy = " lazy" if result.get("lazy") else ""
+    return f"[{dataset} {result['min_level']}:{result['max_level']}{lazy}]"
+
+
+def _change(new, old):
+    return f"{(new - old) / old:+.1%}" if old else "n/a"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Hashable
+from typing import Optional
+
+import numpy as np
+
+
+class ResultCache:
+    """Bounded LRU cache of query results.
+
+    Results are keyed on the query bounds normalized to the minimum layer level, so
+    that queries whose bounds fall in the same buckets share the same entry. All the
+    entries are dropped as soon as they are looked up with a different last update
+    of the indexer than the one they have been stored with. Lookups are guarded by a
+    lock, as offloaded queries go through the cache from the executor threads.
+
+    """
+
+    __slots__ = [
+        "_lock",
+        "_entries",
+        "_max_entries",
+        "_max_bytes",
+        "_nbytes",
+        "_last_update",
+        "hits",
+        "misses",
+        "evictions",
+        "invalidations",
+    ]
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 2 ** 20):
+        """Initialize a cache bounded by number of entries and by memory."""
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._nbytes = 0
+        self._last_update = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        """Return the number of cached results."""
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        """Return the estimated memory taken by the cached results."""
+        return self._nbytes
+
+    def get(
+        self,
+        key: Hashable,
+        last_update: Optional[datetime],
+    ) -> Optional[np.ndarray]:
+        """Return the cached result for the key, if any and still valid."""
+        with self._lock:
+            self._validate(last_update)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(
+        self,
+        key: Hashable,
+        last_update: Optional[datetime],
+        result: np.ndarray,
+    ) -> np.ndarray:
+        """Cache the result for the key and return it as a read-only array."""
+        nbytes = _sizeof(result)
+        with self._lock:
+            self._validate(last_update)
+            if nbytes > self._max_bytes:
+                return result
+
+            result.flags.writeable = False
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (result, nbytes)
+            self._nbytes += nbytes
+            while (
+                len(self._entries) > self._max_entries
+                or self._nbytes > self._max_bytes
+            ):
+                self._nbytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+            return result
+
+    def clear(self) -> None:
+        """Drop all the cached results."""
+        with self._lock:
+            self._clear()
+
+    def _clear(self) -> None:
+        self._entries.clear()
+        self._nbytes = 0
+
+    def _validate(self, last_update: Optional[datetime]) -> None:
+        if last_update == self._last_update:
+            return
+
+        if self._entries:
+            self.invalidations += 1
+            self._clear()
+
+        self._last_update = last_update
+
+
+def _sizeof(result: np.ndarray) -> int:
+    if result.dtype == object:
+        return result.nbytes + sum(sys.getsizeof(v) for v in result)
+
+    return result.nbytes
@@ -0,0 +1,121 @@
+from typing import Callable
+from typing import Hashable
+from typing import Iterable
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+class ValueFilter:
+    """Filter of the values returned by a query.
+
+    Filters are resolved once per query into a mask over the ids of the sorted
+    dictionary, applied to the postings before they are deduplicated, and matched
+    against the values of the items that are not in the layers yet.
+
+    """
+
+    __slots__ = []
+
+    def keep(self, dictionary: np.ndarray) -> np.ndarray:
+        """Return the mask of the ids of the dictionary whose value passes."""
+        return self.matches(np.asarray(dictionary))
+
+    def matches(self, values: np.ndarray) -> np.ndarray:
+        """Return the mask of the values that pass."""
+        raise NotImplementedError()
+
+
+class ValueSet(ValueFilter):
+    """Filter passing the values of an explicit set."""
+
+    __slots__ = ["values"]
+
+    def __init__(self, values: Iterable[Hashable]):
+        """Initialize a filter passing the provided values only."""
+        self.values = list(dict.fromkeys(values))
+
+    def keep(self, dictionary: np.ndarray) -> np.ndarray:
+        """Return the mask of the ids of the values found in the dictionary."""
+        mask = np.zeros(len(dictionary), dtype=bool)
+        for value in self.values:
+            value_id = lookup(dictionary, value)
+            if value_id is not None:
+                mask[value_id] = True
+
+        return mask
+
+    def matches(self, values: np.ndarray) -> np.ndarray:
+        """Return the mask of the values in the set."""
+        return pd.Index(self.values, dtype="object").get_indexer(values) >= 0
+
+
+class Prefix(ValueFilter):
+    """Filter passing the string values starting with a prefix.
+
+    As the dictionary is sorted, these values have contiguous ids that are found by
+    binary search.
+
+    """
+
+    __slots__ = ["prefix"]
+
+    def __init__(self, prefix: str):
+        """Initialize a filter passing the values starting with the prefix."""
+        self.prefix = prefix
+
+    def keep(self, dictionary: np.ndarray) -> np.ndarray:
+        """Return the mask of the contiguous range of ids of the matching values."""
+        mask = np.zeros(len(dictionary), dtype=bool)
+        if not self.prefix:
+            mask[:] = True
+            return mask
+
+        # Strings sort by code point, so the values starting with the prefix come
+        # before the prefix with its last character incremented.
+        upper = self.prefix[:-1] + chr(ord(self.prefix[-1]) + 1)
+        start = int(np.searchsorted(dictionary, self.prefix))
+        end = int(np.searchsorted(dictionary, upper))
+        mask[start:end] = True
+        return mask
+
+    def matches(self, values: np.ndarray) -> np.ndarray:
+        """Return the mask of the values starting with the prefix."""
+        return np.fromiter(
+            (isinstance(v, str) and v.startswith(self.prefix) for v in values),
+            dtype=bool,
+            count=len(values),
+        )
+
+
+class Predicate(ValueFilter):
+    """Filter passing the values for which a vectorized predicate holds.
+
+    The predicate is called with an array of values and returns a boolean mask. It's
+    evaluated once over the whole dictionary, resolving it into a set of ids, rather
+    than on every posting.
+
+    """
+
+    __slots__ = ["predicate"]
+
+    def __init__(self, predicate: Callable[[np.ndarray], np.ndarray]):
+        """Initialize a filter passing the values for which the predicate holds."""
+        self.predicate = predicate
+
+    def matches(self, values: np.ndarray) -> np.ndarray:
+        """Return the mask of the values for which the predicate holds."""
+        return np.asarray(self.predicate(values), dtype=bool)
+
+
+def lookup(dictionary: Optional[np.ndarray], value: Hashable) -> Optional[int]:
+    """Return the id of the value in the sorted dictionary, if there."""
+    if dictionary is None or not len(dictionary):
+        return None
+
+    index = int(np.searchsorted(dictionary, value))
+    if index < len(dictionary) and dictionary[np.array([index])][0] == value:
+        return index
+
+    return None
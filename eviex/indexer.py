@@ -1,23 +1,67 @@
-import bisect
+import asyncio
+import functools
+import threading
+import time
+import warnings
+from collections import deque
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 from enum import Enum
+from typing import AsyncIterable
+from typing import AsyncIterator
+from typing import Callable
 from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import NamedTuple
 from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
 
 import numpy as np
 import pandas as pd
 
+from eviex.cache import ResultCache
+from eviex.filters import ValueFilter
+from eviex.filters import lookup
+from eviex.postings import BitmapPostings
+from eviex.postings import Postings
+from eviex.postings import PostingsUnion
+from eviex.readers import EncodedColumns
+from eviex.readers import Items
+from eviex.readers import arrow_encoded_columns
+from eviex.readers import frame_encoded_columns
+from eviex.readers import items_columns
+from eviex.readers import read_chunks
+from eviex.readers import to_epoch_microseconds
+from eviex.reverse import ReverseIndex
+from eviex.sketches import Sketches
+from eviex.sketches import SketchUnion
+from eviex.sketches import hash_values
+from eviex.unions import RangeUnions
+
 
 class LayerLevel(Enum):
-    """Represent the granularity level of a layer in an indexer."""
+    """Represent the granularity level of a layer in an indexer.
+
+    Values order the levels by granularity. The levels with an integer value are
+    the standard ones that indexers have a layer for by default, while the other
+    ones are only used when explicitly chosen. Weeks start on Monday.
+
+    """
 
     NONE = 0
     SECOND = 1
     MINUTE = 2
+    FIVE_MINUTES = 2.25
+    FIFTEEN_MINUTES = 2.5
     HOUR = 3
     DAY = 4
+    WEEK = 4.5
     MONTH = 5
     QUARTER = 6
     YEAR = 7
@@ -44,14 +88,54 @@ class LayerLevel(Enum):
         levels = cls.levels()
         return levels[max(levels)]
 
+    @classmethod
+    def chain(
+        cls,
+        min_level: "LayerLevel",
+        max_level: "LayerLevel",
+    ) -> List["LayerLevel"]:
+        """Return the standard levels from `min_level` to `max_level`, both included."""
+        return sorted(
+            {min_level, max_level}
+            | {
+                ll
+                for ll in cls.__members__.values()
+                if ll.is_standard() and min_level.value < ll.value < max_level.value
+            },
+            key=lambda ll: ll.value,
+        )
+
+    def is_standard(self) -> bool:
+        """Return whether indexers have a layer of the level by default."""
+        return isinstance(self.value, int)
+
     def get_deeper_level(self) -> "LayerLevel":
-        """Return the next lower layer level."""
+        """Return the next lower standard layer level."""
         return self.levels()[self.value - 1]
 
     def get_shallower_level(self) -> "LayerLevel":
-        """Return the next higher layer level."""
+        """Return the next higher standard layer level."""
         return self.levels()[self.value + 1]
 
+    def nests(self, other: "LayerLevel") -> bool:
+        """Return whether each bucket of the level is inside a bucket of the other."""
+        if self.value > other.value:
+            return False
+
+        duration, other_duration = self._durations[self], self._durations[other]
+        if other_duration is None:
+            # Calendar levels are made of whole days, and of whole months if longer.
+            if duration is None:
+                return True
+
+            return self._offsets[self] == 0 and _DAY % duration == 0
+
+        if duration is None:
+            return False
+
+        offset = self._offsets[self] - self._offsets[other]
+        return other_duration % duration == 0 and offset % duration == 0
+
     def transform(self, ts: datetime) -> datetime:
         """Transofrm the provided timestamp according to the layer level granularity."""
         transformer = self._transformers[self]
@@ -60,13 +144,64 @@ class LayerLevel(Enum):
 
         return transformer(ts)
 
+    def floor(self, timestamps: np.ndarray) -> np.ndarray:
+        """Truncate the provided epoch microseconds according to the layer level."""
+        if not self._units[self]:
+            return timestamps
+
+        return self.starts(self.ordinals(timestamps))
+
+    def ordinals(self, timestamps: np.ndarray) -> np.ndarray:
+        """Return the buckets since the epoch containing the epoch microseconds."""
+        unit = self._units[self]
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if not unit:
+            return timestamps
+
+        truncated = timestamps.astype("datetime64[us]").astype(f"datetime64[{unit}]")
+        if self in self._multiples:
+            multiple, offset = self._multiples[self]
+            return (truncated.astype(np.int64) + offset) // multiple
+
+        return truncated.astype(np.int64)
+
+    def starts(self, ordinals: np.ndarray) -> np.ndarray:
+        """Return the epoch microseconds at which the provided buckets start."""
+        unit = self._units[self]
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        if not unit:
+            return ordinals
+
+        if self in self._multiples:
+            multiple, offset = self._multiples[self]
+            ordinals = ordinals * multiple - offset
+
+        truncated = ordinals.astype(f"datetime64[{unit}]")
+        return truncated.astype("datetime64[us]").astype(np.int64)
+
 
 LayerLevel._transformers = {
     LayerLevel.NONE: None,
     LayerLevel.SECOND: lambda t: t.replace(microsecond=0),
     LayerLevel.MINUTE: lambda t: t.replace(second=0, microsecond=0),
+    LayerLevel.FIVE_MINUTES: lambda t: t.replace(
+        minute=t.minute - t.minute % 5,
+        second=0,
+        microsecond=0,
+    ),
+    LayerLevel.FIFTEEN_MINUTES: lambda t: t.replace(
+        minute=t.minute - t.minute % 15,
+        second=0,
+        microsecond=0,
+    ),
     LayerLevel.HOUR: lambda t: t.replace(minute=0, second=0, microsecond=0),
     LayerLevel.DAY: lambda t: t.replace(hour=0, minute=0, second=0, microsecond=0),
+    LayerLevel.WEEK: lambda t: (t - timedelta(days=t.weekday())).replace(
+        hour=0,
+        minute=0,
+        second=0,
+        microsecond=0,
+    ),
     LayerLevel.MONTH: lambda t: t.replace(
         day=1,
         hour=0,
@@ -93,23 +228,481 @@ LayerLevel._transformers = {
 }
 
 
+LayerLevel._units = {
+    LayerLevel.NONE: None,
+    LayerLevel.SECOND: "s",
+    LayerLevel.MINUTE: "m",
+    LayerLevel.FIVE_MINUTES: "m",
+    LayerLevel.FIFTEEN_MINUTES: "m",
+    LayerLevel.HOUR: "h",
+    LayerLevel.DAY: "D",
+    LayerLevel.WEEK: "D",
+    LayerLevel.MONTH: "M",
+    LayerLevel.QUARTER: "M",
+    LayerLevel.YEAR: "Y",
+}
+
+
+# Levels whose buckets are made of many units, as the number of units and the
+# number of units from the start of a bucket to the epoch.
+LayerLevel._multiples = {
+    LayerLevel.FIVE_MINUTES: (5, 0),
+    LayerLevel.FIFTEEN_MINUTES: (15, 0),
+    # The epoch is a Thursday.
+    LayerLevel.WEEK: (7, 3),
+    LayerLevel.QUARTER: (3, 0),
+}
+
+
+_DAY = 24 * 3600 * 10 ** 6
+
+
+# Duration and start before the epoch of the first bucket of the levels whose
+# buckets have all the same duration, in microseconds.
+LayerLevel._durations = {
+    LayerLevel.NONE: 1,
+    LayerLevel.SECOND: 10 ** 6,
+    LayerLevel.MINUTE: 60 * 10 ** 6,
+    LayerLevel.FIVE_MINUTES: 5 * 60 * 10 ** 6,
+    LayerLevel.FIFTEEN_MINUTES: 15 * 60 * 10 ** 6,
+    LayerLevel.HOUR: 3600 * 10 ** 6,
+    LayerLevel.DAY: _DAY,
+    LayerLevel.WEEK: 7 * _DAY,
+    LayerLevel.MONTH: None,
+    LayerLevel.QUARTER: None,
+    LayerLevel.YEAR: None,
+}
+LayerLevel._offsets = {ll: 0 for ll in LayerLevel._durations}
+LayerLevel._offsets[LayerLevel.WEEK] = 3 * _DAY
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_NO_KEYS = np.array([], dtype=np.int64)
+_MIN_MERGE_SIZE = 1_000_000
+_NO_IDS = np.array([], dtype=np.int32)
+_NO_VALUES = np.array([], dtype="object")
+_ITER_BUCKETS = 1024
+_MICROSECOND = timedelta(microseconds=1)
+
+
 MIN_LAYER_LEVEL = LayerLevel.min()
 MAX_LAYER_LEVEL = LayerLevel.max()
 
 
-class Indexer:
-    """Base indexer."""
+class Delta:
+    """Mutable segment of the items added after the layers have been built.
+
+    Items are appended as array chunks so that adding is proportional to the batch
+    size, while the chunks are concatenated lazily on the first search.
+
+    """
+
+    __slots__ = ["_chunks", "_size", "_lock"]
+
+    def __init__(self):
+        """Initialize an empty delta."""
+        self._chunks = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Return the number of postings in the delta."""
+        return self._size
+
+    def extend(self, timestamps: np.ndarray, values: np.ndarray) -> None:
+        """Append the postings with the provided epoch microseconds and values."""
+        with self._lock:
+            self._chunks.append((timestamps, values))
+            self._size += len(values)
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the epoch microseconds and the values of all the postings."""
+        # Queries offloaded to other threads search the delta while items are
+        # being added to it.
+        with self._lock:
+            if len(self._chunks) > 1:
+                timestamps, values = zip(*self._chunks)
+                self._chunks = [(np.concatenate(timestamps), np.concatenate(values))]
+
+            if not self._chunks:
+                return np.array([], dtype=np.int64), np.array([], dtype="object")
+
+            return self._chunks[0]
+
+    def search(
+        self,
+        layer_level: LayerLevel,
+        vi_index_from: int,
+        vi_index_to: int,
+    ) -> np.ndarray:
+        """Return the values whose truncated timestamp is in the provided range."""
+        timestamps, values = self.arrays()
+        keys = layer_level.floor(timestamps)
+        return values[(keys >= vi_index_from) & (keys < vi_index_to)]
+
+    def search_many(
+        self,
+        layer_level: LayerLevel,
+        vi_indexes_from: np.ndarray,
+        vi_indexes_to: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Vectorized `search` over arrays of ranges.
+
+        The postings are truncated and sorted once, and the ranges are resolved
+        together by binary search. Return the position of the range of each posting
+        found and the index of the posting, along with the values of all of them.
+
+        """
+        timestamps, values = self.arrays()
+        keys = layer_level.floor(timestamps)
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = np.searchsorted(keys, vi_indexes_from)
+        ends = np.maximum(np.searchsorted(keys, vi_indexes_to), starts)
+
+        counts = ends - starts
+        ranges = np.repeat(np.arange(len(counts)), counts)
+        # The positions run from the start of each range on.
+        shifts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return ranges, order[np.arange(counts.sum()) + shifts], values
+
+
+class Snapshot(NamedTuple):
+    """Immutable state of an indexer that queries run against.
+
+    Indexers replace their snapshot with a single assignment on every update, so
+    that a query holding one always sees layers, deltas and last update that belong
+    together, even while a load or a compaction is running. Structures derived from
+    the layers on demand are kept in `derived` as long as the layers don't change.
+
+    The buckets of a layer starting before its horizon in `horizons`, if any, have
+    been dropped by the retention policy or the memory budget of the indexer.
+
+    """
+
+    layers: Optional[Dict[LayerLevel, Postings]] = None
+    virtual_indexes: Optional[Dict[LayerLevel, np.ndarray]] = None
+    bases: Optional[Dict[LayerLevel, int]] = None
+    dictionary: Optional[np.ndarray] = None
+    deltas: Tuple[Delta, ...] = ()
+    last_update: Optional[datetime] = None
+    derived: Optional[dict] = None
+    horizons: Optional[Dict[LayerLevel, int]] = None
+
+
+class PlanStep(NamedTuple):
+    """Range of buckets of a layer gathered by a query, as returned by `explain`."""
+
+    level: LayerLevel
+    date_from: datetime
+    date_to: datetime
+    buckets: int
+    postings: int
+
+
+class CoarseFallbackWarning(UserWarning):
+    """Warning that part of a query has been answered by a coarser layer.
+
+    This happens when the buckets of the finer layers in that part of the time
+    interval have been dropped, so that the items of the whole buckets of the
+    coarser layer overlapping it are returned, from `date_from` to `date_to`.
+
+    """
+
+    def __init__(self, level: LayerLevel, date_from: datetime, date_to: datetime):
+        """Initialize the warning with the level and the interval it answered."""
+        super().__init__(
+            f"the interval from {date_from.isoformat()} to {date_to.isoformat()} "
+            f"has been answered at the {level.name} level",
+        )
+        self.level = level
+        self.date_from = date_from
+        self.date_to = date_to
+
+
+class LoadProgress:
+    """Progress of a load.
+
+    `phases` holds the seconds spent deduplicating the chunks (`add`), merging them
+    (`merge`), sorting the dictionary (`dictionary`) and applying the retention
+    (`retain`), and `levels` the seconds spent building the layer of each level.
+
+    """
+
+    __slots__ = [
+        "chunks",
+        "postings",
+        "distinct_postings",
+        "elapsed",
+        "phases",
+        "levels",
+    ]
+
+    def __init__(self):
+        """Initialize the progress of a load that didn't start yet."""
+        self.chunks = 0
+        self.postings = 0
+        self.distinct_postings = 0
+        self.elapsed = 0.0
+        self.phases = {}
+        self.levels = {}
+
+    def _time(self, phase: str, start: float) -> float:
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - start
+        return now
+
+    @property
+    def throughput(self) -> float:
+        """Return the postings loaded per second."""
+        return self.postings / self.elapsed if self.elapsed else 0.0
+
+
+class QueryStats:
+    """Statistics of a query, collected only when an indexer has a query hook.
+
+    `searches` is the number of layers searched by the planner and `bisections` the
+    bounds of intervals it looked up the buckets of. `buckets` holds the buckets
+    gathered by layer level, and `postings` the ids gathered out of them before
+    being deduplicated, besides the `bitmaps` or-ed together. `added` is the number
+    of values found in the items not in the layers yet. `timings` holds the seconds
+    spent in the `plan`, `collect`, `unique` and `added` phases.
+
+    """
+
+    __slots__ = [
+        "date_from",
+        "date_to",
+        "cached",
+        "searches",
+        "bisections",
+        "buckets",
+        "postings",
+        "bitmaps",
+        "added",
+        "results",
+        "timings",
+        "elapsed",
+        "_start",
+        "_last",
+    ]
+
+    def __init__(self, date_from: datetime, date_to: datetime):
+        """Initialize the statistics of a query starting now."""
+        self.date_from = date_from
+        self.date_to = date_to
+        self.cached = False
+        self.searches = 0
+        self.bisections = 0
+        self.buckets = {}
+        self.postings = 0
+        self.bitmaps = 0
+        self.added = 0
+        self.results = 0
+        self.timings = {}
+        self.elapsed = 0.0
+        self._start = self._last = time.perf_counter()
+
+    def lap(self, phase: str) -> None:
+        """Record the seconds spent in the phase, since the end of the previous one."""
+        now = time.perf_counter()
+        self.timings[phase] = self.timings.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def finish(self, results: int) -> None:
+        """Record the number of results and the total seconds spent."""
+        self.results = results
+        self.elapsed = time.perf_counter() - self._start
+
+
+class LayersBuilder:
+    """Incremental builder of the layers out of chunks of postings.
+
+    Chunks are deduplicated at the minimum layer level as soon as they are added and
+    merged together once they outgrow the already merged postings, so that the
+    memory taken stays close to the size of the minimum layer.
+
+    """
 
-    __instance = None
     __slots__ = [
-        "_uri",
         "_min_level",
-        "_max_level",
-        "_layers",
-        "_virtual_indexes",
-        "_last_update",
+        "_mapping",
+        "_keys",
+        "_ids",
+        "_pending",
+        "_pending_size",
+        "_start",
+        "progress",
+    ]
+
+    def __init__(self, min_level: LayerLevel):
+        """Initialize a builder of the layers starting from the provided level."""
+        self._min_level = min_level
+        self._mapping = {}
+        self._keys = _NO_KEYS
+        self._ids = _NO_KEYS
+        self._pending = []
+        self._pending_size = 0
+        self._start = time.perf_counter()
+        self.progress = LoadProgress()
+
+    def add(
+        self,
+        timestamps: np.ndarray,
+        codes: np.ndarray,
+        uniques: np.ndarray,
+    ) -> None:
+        """Add the postings with the provided epoch microseconds and value codes.
+
+        The codes index the distinct values in `uniques`, as returned by `encode`.
+
+        """
+        # Values are given provisional ids in order of appearance that are remapped
+        # to the sorted dictionary ids once all of them are known.
+        start = time.perf_counter()
+        mapping = self._mapping
+        ids = np.fromiter(
+            (mapping.setdefault(v, len(mapping)) for v in uniques),
+            dtype=np.int64,
+            count=len(uniques),
+        )
+        keys, ids = _unique_postings(self._min_level.floor(timestamps), ids[codes])
+        self._pending.append((keys, ids))
+        self._pending_size += len(ids)
+        start = self.progress._time("add", start)
+        if self._pending_size > max(len(self._ids), _MIN_MERGE_SIZE):
+            self._merge()
+            self.progress._time("merge", start)
+
+        self.progress.chunks += 1
+        self.progress.postings += len(codes)
+        self.progress.distinct_postings = len(self._ids) + self._pending_size
+        self.progress.elapsed = time.perf_counter() - self._start
+
+    def build(
+        self,
+        layer_levels: List[LayerLevel],
+        bitmaps: bool = False,
+        min_fanout: Optional[float] = None,
+    ) -> Tuple[dict, dict, dict, np.ndarray]:
+        """Return the layers, virtual indexes, bases and dictionary.
+
+        With `min_fanout`, the levels too sparse for it are skipped as explained in
+        `MemoryIndexer`.
+
+        """
+        start = time.perf_counter()
+        self._merge()
+        start = self.progress._time("merge", start)
+
+        dictionary = np.empty(len(self._mapping), dtype="object")
+        dictionary[:] = list(self._mapping)
+        order = np.argsort(dictionary)
+        ranks = np.empty(len(order), dtype=_ids_dtype(len(order)))
+        ranks[order] = np.arange(len(order))
+        self.progress._time("dictionary", start)
+
+        layers, v_indexes, bases = _build_layers(
+            layer_levels,
+            self._keys,
+            ranks[self._ids],
+            bitmaps=bitmaps,
+            dictionary_size=len(dictionary),
+            min_fanout=min_fanout,
+            timings=self.progress.levels,
+        )
+        self.progress.elapsed = time.perf_counter() - self._start
+        return layers, v_indexes, bases, dictionary[order]
+
+    def _merge(self) -> None:
+        if not self._pending:
+            return
+
+        keys, ids = zip(*self._pending)
+        self._keys, self._ids = _unique_postings(
+            np.concatenate((self._keys,) + keys),
+            np.concatenate((self._ids,) + ids),
+        )
+        self._pending = []
+        self._pending_size = 0
+
+
+class LevelTable:
+    """Lookup of the buckets of a layer by epoch microseconds.
+
+    The buckets of the levels of fixed duration are looked up by their ordinals,
+    computed with integer arithmetic, while the starts of the buckets of the
+    calendar levels, that have few of them, are computed once.
+
+    """
+
+    __slots__ = [
+        "level",
+        "v_indexes",
+        "base",
+        "duration",
+        "offset",
+        "starts",
+        "_max",
     ]
 
+    def __init__(self, level: LayerLevel, v_indexes: np.ndarray, base: int):
+        """Initialize the lookup of the buckets with the virtual indexes and base."""
+        self.level = level
+        self.v_indexes = v_indexes
+        self.base = base
+        self.duration = LayerLevel._durations[level]
+        self.offset = LayerLevel._offsets[level]
+        self.starts = None
+        if self.duration is None:
+            self.starts = level.starts(v_indexes.astype(np.int64) + base)
+
+        # The virtual indexes never reach the maximum of their data type, so
+        # clamping the bounds to it doesn't change the result of the bisections.
+        # Bounds are clamped to the 64 bits signed maximum too, so that they're
+        # never converted to floats.
+        self._max = min(np.iinfo(v_indexes.dtype).max, np.iinfo(np.int64).max)
+
+    def index(self, timestamp: int) -> int:
+        """Return the index of the first bucket starting at or after the timestamp."""
+        if self.starts is not None:
+            return int(self.starts.searchsorted(timestamp))
+
+        ordinal = -((-timestamp - self.offset) // self.duration)
+        v_index = min(max(ordinal - self.base, 0), self._max)
+        return int(self.v_indexes.searchsorted(self.v_indexes.dtype.type(v_index)))
+
+    def indexes(self, timestamps: np.ndarray) -> np.ndarray:
+        """Vectorized `index` over an array of epoch microseconds."""
+        if self.starts is not None:
+            return self.starts.searchsorted(timestamps)
+
+        ordinals = -((-timestamps - self.offset) // self.duration)
+        v_indexes = np.clip(ordinals - self.base, 0, self._max)
+        return self.v_indexes.searchsorted(v_indexes.astype(self.v_indexes.dtype))
+
+    def start(self, index: int) -> int:
+        """Return the epoch microseconds at which the bucket at the index starts."""
+        if self.starts is not None:
+            return int(self.starts[index])
+
+        return (int(self.v_indexes[index]) + self.base) * self.duration - self.offset
+
+    def starts_of(self, indexes: np.ndarray) -> np.ndarray:
+        """Vectorized `start` over an array of bucket indexes."""
+        if self.starts is not None:
+            return self.starts[indexes]
+
+        ordinals = self.v_indexes[indexes].astype(np.int64) + self.base
+        return ordinals * self.duration - self.offset
+
+
+class Indexer:
+    """Base indexer."""
+
+    __instance = None
+    __slots__ = ["_uri", "_min_level", "_max_level", "_snapshot"]
+
     def __init__(
         self,
         uri: str,
@@ -120,9 +713,7 @@ class Indexer:
         self._uri = uri
         self._min_level = min_level
         self._max_level = max_level
-        self._layers = None
-        self._virtual_indexes = None
-        self._last_update = None
+        self._snapshot = Snapshot()
 
     @property
     def uri(self) -> str:
@@ -132,7 +723,45 @@ class Indexer:
     @property
     def last_update(self) -> Optional[datetime]:
         """Return the timestamp of the last indexer update."""
-        return self._last_update
+        return self._snapshot.last_update
+
+    @property
+    def snapshot(self) -> Snapshot:
+        """Return the current state of the indexer."""
+        return self._snapshot
+
+    @property
+    def _layers(self) -> Optional[Dict[LayerLevel, Postings]]:
+        return self._snapshot.layers
+
+    @property
+    def _virtual_indexes(self) -> Optional[Dict[LayerLevel, np.ndarray]]:
+        return self._snapshot.virtual_indexes
+
+    @property
+    def _bases(self) -> Optional[Dict[LayerLevel, int]]:
+        return self._snapshot.bases
+
+    @property
+    def _dictionary(self) -> Optional[np.ndarray]:
+        return self._snapshot.dictionary
+
+    @property
+    def _last_update(self) -> Optional[datetime]:
+        return self._snapshot.last_update
+
+    def _touch(self) -> None:
+        """Set the last update to now."""
+        self._snapshot = self._snapshot._replace(last_update=self._next_update())
+
+    def _next_update(self) -> datetime:
+        """Return now, making sure that the last update always increases."""
+        now = datetime.utcnow().replace(tzinfo=timezone.utc)
+        last_update = self._snapshot.last_update
+        if last_update is not None and now <= last_update:
+            now = last_update + timedelta(microseconds=1)
+
+        return now
 
     async def load(self, items: List[dict]) -> None:
         """Load the provided items in the indexer."""
@@ -142,6 +771,10 @@ class Indexer:
         """Add the provided item in the indexer."""
         raise NotImplementedError()
 
+    async def add_many(self, items: List[dict]) -> None:
+        """Add the provided items in the indexer."""
+        raise NotImplementedError()
+
     async def get(self, date_from: datetime, date_to: datetime) -> np.ndarray:
         """Retrieve the items in the indexer according to the provided time interval."""
         raise NotImplementedError()
@@ -149,115 +782,2178 @@ class Indexer:
     @staticmethod
     def _indexify(date: datetime) -> int:
         first_timestamp = datetime.utcfromtimestamp(0).replace(tzinfo=timezone.utc)
-        # TODO: This should be depending on the layer level granularity to avoid
-        # using huge numbers.
         return int((date - first_timestamp).total_seconds() * 10 ** 6)
 
 
 class MemoryIndexer(Indexer):
-    """In-memory indexer."""
+    """In-memory indexer.
+
+    Added items are kept in a `Delta` that is merged with the layers at query time
+    and folded into them in the background once it grows over the compaction
+    threshold.
+
+    With `bitmaps` set, dense buckets are stored as bitmaps over the dictionary ids
+    so that wide queries are answered by or-ing them instead of sorting their ids.
+
+    With a `cache`, results of `get` are cached until the next update.
+
+    With `reverse_index` set, the index from each value to the buckets it occurs
+    in, used by `occurrences`, `first_seen` and `last_seen`, is built along with
+    the layers instead of on the first of these queries.
+
+    With a `retention`, the buckets of each of its levels older than its age are
+    dropped, down to the boundary of the buckets of the next coarser level. With a
+    `memory_budget`, the oldest buckets of the deepest levels are dropped until
+    the layers take at most that many bytes, while the top layer is always kept
+    whole. Both are applied on every load and compaction, and on `evict`. Parts of
+    the queries older than the buckets left in the finer layers are answered by
+    whole buckets of the coarser ones, which `get` and `count` report with a
+    `CoarseFallbackWarning`. Lookups by value only see the buckets left in the
+    minimum layer.
+
+    The layers are built for the standard levels from `min_level` to `max_level`,
+    or for the provided `levels`, that may include the finer `FIVE_MINUTES`,
+    `FIFTEEN_MINUTES` and `WEEK` ones as long as the buckets of each level are
+    nested in the buckets of the next coarser one. With a `min_fanout`, a level is
+    skipped on load when its buckets are on average split into fewer than that
+    many buckets of the next finer layer, as it would save little work to queries
+    while taking about as much memory.
+
+    With an `on_query` hook, the `QueryStats` of each `get` and `aget` are collected
+    and passed to it once the query is answered, possibly from the executor of the
+    event loop. Otherwise no statistics are collected at all. The `LoadProgress`
+    of the last load, with the time spent in each of its phases, is kept as
+    `last_load`.
+
+    With `range_unions`, mapping layer levels to a number of buckets, the unions of
+    the aligned ranges of buckets of these layers of at least that many buckets are
+    built along with the layers as `RangeUnions`, so that `get` gathers the
+    postings of wide ranges of buckets out of a few of them. Smaller numbers make
+    queries faster at the cost of more memory.
+
+    With `lazy` set, loads and compactions build the minimum layer only, along
+    with the layers of the `pinned` levels. The layer of any other level is built
+    out of the next finer one by the first query whose interval holds whole buckets
+    of it, and then kept for the following queries, so that startup is faster and
+    memory follows the levels actually used. The queries holding whole buckets of
+    each level are counted in `layer_usage`, so that the hot ones can be pinned
+    with `pin`. With `max_lazy_layers`, building a layer evicts the least used
+    layers built on demand past that many, other than the ones needed by the
+    query being answered. `aget` and `aget_many` build the layers in the executor
+    of the event loop. `explain` shows the plan over the layers built so far. Lazy
+    layers can't be combined with a retention or a memory budget, as coarser layers
+    couldn't be rebuilt out of a trimmed minimum layer.
+
+    """
+
+    __slots__ = [
+        "_levels",
+        "_lazy",
+        "_pinned",
+        "_max_lazy_layers",
+        "_usage",
+        "_on_query",
+        "_last_load",
+        "_range_unions",
+        "_min_fanout",
+        "_retention",
+        "_memory_budget",
+        "_reverse_index",
+        "_compaction",
+        "_compaction_threshold",
+        "_generation",
+        "_bitmaps",
+        "_cache",
+    ]
 
     def __init__(
         self,
         min_level: Optional[LayerLevel] = MIN_LAYER_LEVEL,
         max_level: Optional[LayerLevel] = MAX_LAYER_LEVEL,
+        compaction_threshold: int = 100_000,
+        bitmaps: bool = False,
+        cache: Optional[ResultCache] = None,
+        reverse_index: bool = False,
+        retention: Optional[Dict[LayerLevel, timedelta]] = None,
+        memory_budget: Optional[int] = None,
+        levels: Optional[Sequence[LayerLevel]] = None,
+        min_fanout: Optional[float] = None,
+        on_query: Optional[Callable[["QueryStats"], None]] = None,
+        range_unions: Optional[Dict[LayerLevel, int]] = None,
+        lazy: bool = False,
+        pinned: Optional[Sequence[LayerLevel]] = None,
+        max_lazy_layers: Optional[int] = None,
     ):
         """Initialize an in-memory indexer with the provided layer level ranges."""
-        super().__init__(":memory:", min_level=min_level, max_level=max_level)
+        if levels is None:
+            levels = LayerLevel.chain(min_level, max_level)
 
-    def get(self, date_from: datetime, date_to: datetime) -> np.ndarray:
-        """Retrieve the items in the indexer according to the provided time interval."""
+        levels = _check_levels(levels)
+        if lazy and (retention or memory_budget is not None):
+            raise ValueError(
+                "lazy layers can't be combined with a retention or a memory budget",
+            )
+
+        super().__init__(":memory:", min_level=levels[0], max_level=levels[-1])
+        self._levels = levels
+        self._lazy = lazy
+        self._pinned = set()
+        self._check_pinned(pinned or [])
+        self._pinned.update(pinned or [])
+        self._max_lazy_layers = max_lazy_layers
+        self._usage = {ll: 0 for ll in levels[1:]}
+        self._min_fanout = min_fanout
+        self._on_query = on_query
+        self._range_unions = range_unions or {}
+        self._last_load = None
+        self._bitmaps = bitmaps
+        self._cache = cache
+        self._reverse_index = reverse_index
+        self._retention = retention or {}
+        self._memory_budget = memory_budget
+        self._snapshot = Snapshot(deltas=(Delta(),))
+        self._compaction = None
+        self._compaction_threshold = compaction_threshold
+        self._generation = 0
+
+    @property
+    def _deltas(self) -> Tuple[Delta, ...]:
+        return self._snapshot.deltas
+
+    def get(
+        self,
+        date_from: datetime,
+        date_to: datetime,
+        values: Optional[ValueFilter] = None,
+    ) -> np.ndarray:
+        """Retrieve the items in the indexer according to the provided time interval.
+
+        With `values`, only the items passing the filter are returned. The filter is
+        applied to the postings before they are deduplicated, and filtered results
+        are not cached.
+
+        """
         if date_from >= date_to:
             return np.array([], dtype="object")
 
-        date_from = self._min_level.transform(date_from)
-        date_to = self._min_level.transform(date_to)
+        ts_from, ts_to = self._bounds(date_from, date_to)
+        snapshot = self._materialize(self._current(), ts_from, ts_to)
+        self._fallbacks(snapshot, ts_from, ts_to)
+        return self._cached_get(snapshot, ts_from, ts_to, values)
 
-        vi_index_from = self._indexify(date_from)
-        vi_index_to = self._indexify(date_to)
+    async def aget(
+        self,
+        date_from: datetime,
+        date_to: datetime,
+        offload_threshold: int = 100_000,
+        values: Optional[ValueFilter] = None,
+    ) -> np.ndarray:
+        """Retrieve the items in the provided time interval without blocking the loop.
+
+        Queries estimated to go through more than `offload_threshold` postings run
+        in the default executor of the event loop, the others run right away.
+        `values` filters the items as in `get`.
+
+        """
+        if date_from >= date_to:
+            return np.array([], dtype="object")
 
-        v = self._search_in_layer(self._max_level, vi_index_from, vi_index_to)
-        return np.unique(v[np.flatnonzero(v)])
+        ts_from, ts_to = self._bounds(date_from, date_to)
+        snapshot = await self._amaterialize(self._current(), ts_from, ts_to)
+        self._fallbacks(snapshot, ts_from, ts_to)
+        if self._estimate(snapshot, ts_from, ts_to) <= offload_threshold:
+            return self._cached_get(snapshot, ts_from, ts_to, values)
 
-    def _search_in_layer(self, layer_level, vi_index_from, vi_index_to):
-        index_from = bisect.bisect_left(
-            self._virtual_indexes[layer_level],
-            vi_index_from,
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None,
+            self._cached_get,
+            snapshot,
+            ts_from,
+            ts_to,
+            values,
         )
-        index_to = (
-            bisect.bisect_left(self._virtual_indexes[layer_level], vi_index_to) - 1
+
+    def explain(self, date_from: datetime, date_to: datetime) -> List[PlanStep]:
+        """Return the ranges of buckets that `get` gathers for the time interval.
+
+        The steps are in time order, each with the time interval covered by its
+        buckets and the number of postings gathered out of them. Items added and
+        not compacted yet are searched on top of these.
+
+        """
+        if date_from >= date_to:
+            return []
+
+        snapshot = self._current()
+        steps = []
+        for layer_level, index_from, index_to in self._plan(
+            snapshot,
+            *self._bounds(date_from, date_to),
+        ):
+            bucket_from = self._bucket_start(snapshot, layer_level, index_from)
+            ordinal = int(snapshot.virtual_indexes[layer_level][index_to - 1])
+            bucket_to = layer_level.starts(ordinal + snapshot.bases[layer_level] + 1)
+            steps.append(
+                PlanStep(
+                    layer_level,
+                    _EPOCH + timedelta(microseconds=bucket_from),
+                    _EPOCH + timedelta(microseconds=int(bucket_to)),
+                    index_to - index_from,
+                    snapshot.layers[layer_level].count(index_from, index_to),
+                ),
+            )
+
+        return steps
+
+    @property
+    def cache(self) -> Optional[ResultCache]:
+        """Return the cache of the results of the queries, if any."""
+        return self._cache
+
+    @property
+    def last_load(self) -> Optional[LoadProgress]:
+        """Return the progress of the last load, if any."""
+        return self._last_load
+
+    @property
+    def layer_usage(self) -> Dict[LayerLevel, int]:
+        """Return the number of queries holding whole buckets of each coarser level.
+
+        Queries are only counted with `lazy` set.
+
+        """
+        return dict(self._usage)
+
+    async def pin(self, levels: Sequence[LayerLevel]) -> None:
+        """Keep the layers of the levels, building the missing ones right away."""
+        self._check_pinned(levels)
+        self._pinned.update(levels)
+
+        snapshot = self._snapshot
+        if snapshot.layers is None:
+            return
+
+        missing = [ll for ll in _levels(levels) if ll not in snapshot.layers]
+        if missing:
+            loop = asyncio.get_event_loop()
+            layers = await loop.run_in_executor(None, self._extend, snapshot, missing)
+            self._swap_layers(snapshot, *layers)
+
+    def _check_pinned(self, levels: Sequence[LayerLevel]) -> None:
+        for ll in levels:
+            if ll not in self._levels[1:]:
+                raise ValueError(
+                    f"can't pin {ll.name}, that isn't a level above the minimum one",
+                )
+
+    def _materialize(
+        self,
+        snapshot: Snapshot,
+        ts_from: Union[int, np.ndarray],
+        ts_to: Union[int, np.ndarray],
+    ) -> Snapshot:
+        """Return the snapshot with the layers of the levels used by the intervals.
+
+        The missing layers are built and swapped into the current snapshot.
+
+        """
+        used, missing = self._used_levels(snapshot, ts_from, ts_to)
+        if not missing:
+            return snapshot
+
+        return self._swap_layers(snapshot, *self._extend(snapshot, missing, used))
+
+    async def _amaterialize(
+        self,
+        snapshot: Snapshot,
+        ts_from: Union[int, np.ndarray],
+        ts_to: Union[int, np.ndarray],
+    ) -> Snapshot:
+        """Asynchronous `_materialize` building the layers in the executor."""
+        used, missing = self._used_levels(snapshot, ts_from, ts_to)
+        if not missing:
+            return snapshot
+
+        loop = asyncio.get_event_loop()
+        layers = await loop.run_in_executor(
+            None,
+            self._extend,
+            snapshot,
+            missing,
+            used,
         )
+        return self._swap_layers(snapshot, *layers)
 
-        if layer_level == self._min_level:
-            index_to += 1
-            if index_from >= index_to:
-                return np.array([], dtype="object")
+    def _used_levels(
+        self,
+        snapshot: Snapshot,
+        ts_from: Union[int, np.ndarray],
+        ts_to: Union[int, np.ndarray],
+    ) -> Tuple[List[LayerLevel], List[LayerLevel]]:
+        """Count the uses of the levels with whole buckets in the intervals.
+
+        Return these levels along with the ones of them missing a layer, none
+        unless `lazy` is set.
+
+        """
+        if not self._lazy or snapshot.layers is None:
+            return [], []
+
+        used = []
+        for ll in self._levels[1:]:
+            # Coarser buckets are unions of finer ones, so none of them is whole
+            # either.
+            if not np.any(_whole_buckets(ll, ts_from, ts_to)):
+                break
+
+            self._usage[ll] += 1
+            used.append(ll)
+
+        return used, [ll for ll in used if ll not in snapshot.layers]
+
+    def _extend(
+        self,
+        snapshot: Snapshot,
+        levels: List[LayerLevel],
+        used: Sequence[LayerLevel] = (),
+    ) -> Tuple[dict, dict, dict]:
+        """Build the layers of the levels out of the next finer layer of each.
 
-            postings_lists = self._layers[layer_level][index_from:index_to]
-            return np.concatenate(postings_lists)
+        Then evict the least used layers built on demand over `max_lazy_layers`,
+        other than the ones of the levels built and of the `used` ones.
 
-        if index_from >= index_to:
-            return self._search_in_layer(
-                layer_level.get_deeper_level(),
-                vi_index_from,
-                vi_index_to,
+        """
+        layers = dict(snapshot.layers)
+        v_indexes = dict(snapshot.virtual_indexes)
+        bases = dict(snapshot.bases)
+        for ll in levels:
+            finer = [f for f in _levels(layers) if f.value < ll.value][-1]
+            indexes, ids = layers[finer].expand()
+            ordinals = v_indexes[finer][indexes].astype(np.int64) + bases[finer]
+            built = _build_layers(
+                [ll],
+                finer.starts(ordinals),
+                ids,
+                bitmaps=self._bitmaps,
+                dictionary_size=len(snapshot.dictionary),
             )
+            for built_arrays, arrays in zip(built, (layers, v_indexes, bases)):
+                arrays.update(built_arrays)
 
-        left = self._search_in_layer(
-            layer_level.get_deeper_level(),
-            vi_index_from,
-            self._virtual_indexes[layer_level][index_from],
+        if self._max_lazy_layers is not None:
+            on_demand = [ll for ll in _levels(layers)[1:] if ll not in self._pinned]
+            kept = set(levels) | set(used)
+            evictable = [ll for ll in on_demand if ll not in kept]
+            excess = max(len(on_demand) - self._max_lazy_layers, 0)
+            for ll in sorted(evictable, key=self._usage.get)[:excess]:
+                del layers[ll], v_indexes[ll], bases[ll]
+
+        return layers, v_indexes, bases
+
+    def _swap_layers(
+        self,
+        snapshot: Snapshot,
+        layers: Dict[LayerLevel, Postings],
+        v_indexes: Dict[LayerLevel, np.ndarray],
+        bases: Dict[LayerLevel, int],
+    ) -> Snapshot:
+        """Swap the layers into the current snapshot, if still of the same layers.
+
+        The results of the queries don't change, so the last update is kept along
+        with the reverse index, that is derived from the minimum layer only.
+
+        """
+        current = self._snapshot
+        if current.layers is not snapshot.layers:
+            # A load or a compaction replaced the layers in the meanwhile.
+            current = snapshot
+
+        derived = {k: v for k, v in current.derived.items() if k == "reverse"}
+        swapped = current._replace(
+            layers=layers,
+            virtual_indexes=v_indexes,
+            bases=bases,
+            derived=derived,
         )
-        right = self._search_in_layer(
-            layer_level.get_deeper_level(),
-            self._virtual_indexes[layer_level][index_to],
-            vi_index_to,
+        if current is self._snapshot:
+            self._snapshot = swapped
+
+        return swapped
+
+    def _current(self) -> Snapshot:
+        """Return the snapshot for a query to run against."""
+        return self._snapshot
+
+    def _bounds(self, date_from: datetime, date_to: datetime) -> Tuple[int, int]:
+        return self._timestamp(date_from), self._timestamp(date_to)
+
+    def _timestamp(self, date: datetime) -> int:
+        return self._indexify(self._min_level.transform(date))
+
+    def _cached_get(
+        self,
+        snapshot: Snapshot,
+        ts_from: int,
+        ts_to: int,
+        values: Optional[ValueFilter] = None,
+    ) -> np.ndarray:
+        if self._on_query is None:
+            return self._lookup(snapshot, ts_from, ts_to, values)
+
+        stats = QueryStats(
+            _EPOCH + timedelta(microseconds=ts_from),
+            _EPOCH + timedelta(microseconds=ts_to),
         )
-        postings_lists = self._layers[layer_level][index_from:index_to]
-        center = np.concatenate(postings_lists)
-        return np.concatenate([left, center, right])
+        values = self._lookup(snapshot, ts_from, ts_to, values, stats)
+        stats.finish(len(values))
+        self._on_query(stats)
+        return values
 
-    async def load(self, items: List[dict]) -> None:
-        """Load the provided items in the indexer."""
+    def _lookup(
+        self,
+        snapshot: Snapshot,
+        ts_from: int,
+        ts_to: int,
+        values: Optional[ValueFilter] = None,
+        stats: Optional[QueryStats] = None,
+    ) -> np.ndarray:
+        if self._cache is None or values is not None:
+            return self._get(snapshot, ts_from, ts_to, values, stats)
 
-        def layer(df):
-            return df["values"].to_numpy()
-
-        def virtual_indexes(df):
-            arr = df["timestamp"].apply(self._indexify).to_numpy()
-            # TODO: for better memory consumption the data type should be chosen
-            # wisely. When adding items will be supported, the corresponding
-            # virtual index value has to be checked agains overflow.
-            # IDEA: for further squeezing memory, what if data are stored on different
-            # arrays each with its minimal datatype?
-            if arr.max() < (2 ** 32 - 1):
-                arr = arr.astype(np.uint32)
+        result = self._cache.get((ts_from, ts_to), snapshot.last_update)
+        if result is None:
+            result = self._cache.put(
+                (ts_from, ts_to),
+                snapshot.last_update,
+                self._get(snapshot, ts_from, ts_to, stats=stats),
+            )
+        elif stats is not None:
+            stats.cached = True
+
+        return result
+
+    def _get(
+        self,
+        snapshot: Snapshot,
+        ts_from: int,
+        ts_to: int,
+        value_filter: Optional[ValueFilter] = None,
+        stats: Optional[QueryStats] = None,
+    ) -> np.ndarray:
+        ranges = self._plan(snapshot, ts_from, ts_to, stats)
+        if stats is not None:
+            stats.lap("plan")
+
+        unions = self._unions(snapshot) if ranges and self._range_unions else {}
+        union = PostingsUnion()
+        for layer_level, index_from, index_to in ranges:
+            layer = snapshot.layers[layer_level]
+            if layer_level in unions:
+                unions[layer_level].collect(layer, index_from, index_to, union)
             else:
-                arr = arr.astype(np.uint64)
-
-            return arr
-
-        def ts_col_name(layer_level):
-            return f"timestamp_{layer_level.name.lower()}"
-
-        df = pd.DataFrame(items)
-        layers, v_indexes = {}, {}
-        for ll in [
-            LayerLevel.levels()[i]
-            for i in range(self._min_level.value, self._max_level.value + 1)
-        ]:
-            ll_ts_col_name = ts_col_name(ll)
-
-            df[ll_ts_col_name] = df["timestamp"].apply(ll.transform)
-            df_level = df.groupby(ll_ts_col_name).agg({"values": sum}).reset_index()
-            df_level["values"] = df_level["values"].apply(lambda l: list(set(l)))
-            df_level = df_level.rename(columns={ll_ts_col_name: "timestamp"})
-
-            layers[ll] = layer(df_level)
-            v_indexes[ll] = virtual_indexes(df_level)
-
-        # TODO: the memory could be further squeezed by storing list of numbers on
-        # each level and remap them in the end so that the strings are stored once only.
-        self._layers = layers
-        self._virtual_indexes = v_indexes
-        self._last_update = datetime.utcnow().replace(tzinfo=timezone.utc)
+                layer.collect(index_from, index_to, union)
+
+        if stats is not None:
+            for layer_level, index_from, index_to in ranges:
+                buckets = stats.buckets.get(layer_level, 0) + index_to - index_from
+                stats.buckets[layer_level] = buckets
+
+            stats.postings = sum(len(chunk) for chunk in union.chunks)
+            stats.bitmaps = len(union.bitmaps)
+            stats.lap("collect")
+
+        values = _NO_VALUES
+        if union:
+            keep = None
+            if value_filter is not None:
+                keep = value_filter.keep(snapshot.dictionary)
+
+            values = snapshot.dictionary[union.ids(keep)]
+
+        if stats is not None:
+            stats.lap("unique")
+
+        added_values = [
+            delta.search(self._min_level, ts_from, ts_to)
+            for delta in snapshot.deltas
+            if len(delta)
+        ]
+        if value_filter is not None:
+            added_values = [v[value_filter.matches(v)] for v in added_values]
+
+        if stats is not None:
+            stats.added = sum(len(v) for v in added_values)
+            stats.lap("added")
+
+        if any(len(v) for v in added_values):
+            return np.unique(np.concatenate([values] + added_values))
+
+        return values
+
+    def iter_get(
+        self,
+        date_from: datetime,
+        date_to: datetime,
+        order: str = "asc",
+        limit: Optional[int] = None,
+    ) -> Iterator[np.ndarray]:
+        """Iterate over the items in the time interval by time of first occurrence.
+
+        Buckets of the minimum level are walked in time order, ascending or
+        descending according to `order`, and each yields the sorted chunk of the
+        items that occur in it and didn't occur in any bucket walked before. The
+        buckets of the coarser layers whose items all already occurred are skipped
+        without being descended into, and the iteration stops as soon as `limit`
+        items have been yielded, so that only the buckets up to the last page are
+        walked.
+
+        """
+        if order not in ("asc", "desc"):
+            raise ValueError(f"order must be either 'asc' or 'desc', not {order!r}")
+
+        ts_from, ts_to = self._bounds(date_from, date_to)
+        snapshot = self._materialize(self._current(), ts_from, ts_to)
+        self._fallbacks(snapshot, ts_from, ts_to)
+        chunks = self._ordered_chunks(snapshot, ts_from, ts_to, order == "desc")
+        return _take(chunks, limit)
+
+    def _ordered_chunks(
+        self,
+        snapshot: Snapshot,
+        ts_from: int,
+        ts_to: int,
+        descending: bool,
+    ) -> Iterator[np.ndarray]:
+        if ts_from >= ts_to:
+            return
+
+        dictionary = snapshot.dictionary
+        seen = np.zeros(0 if dictionary is None else len(dictionary), dtype=bool)
+        seen_added = set()
+        added = deque(self._added_buckets(snapshot, ts_from, ts_to, descending))
+
+        ranges = self._plan(snapshot, ts_from, ts_to)
+        for layer_level, index_from, index_to in (
+            reversed(ranges) if descending else ranges
+        ):
+            buckets = self._walk(
+                snapshot,
+                layer_level,
+                index_from,
+                index_to,
+                seen,
+                descending,
+            )
+            for start, ids in buckets:
+                # Added buckets walked before this one come first.
+                while added and (
+                    added[0][0] > start if descending else added[0][0] < start
+                ):
+                    yield _first_added(added.popleft()[1], dictionary, seen, seen_added)
+
+                ids = ids[~seen[ids]]
+                seen[ids] = True
+                values = dictionary[np.sort(ids)]
+                if added and added[0][0] == start:
+                    added_values = _first_added(
+                        added.popleft()[1],
+                        dictionary,
+                        seen,
+                        seen_added,
+                    )
+                    values = np.unique(np.concatenate([values, added_values]))
+
+                yield values
+
+        while added:
+            yield _first_added(added.popleft()[1], dictionary, seen, seen_added)
+
+    def _walk(
+        self,
+        snapshot: Snapshot,
+        layer_level: LayerLevel,
+        index_from: int,
+        index_to: int,
+        seen: np.ndarray,
+        descending: bool,
+    ) -> Iterator[Tuple[int, np.ndarray]]:
+        """Walk the buckets of the range in time order down to the minimum level.
+
+        Yield the start of each bucket of the minimum level along with the ids that
+        occur in it for the first time, given the ids already `seen`, that the
+        caller marks as the buckets are consumed. Buckets whose deeper buckets have
+        been dropped are yielded as they are.
+
+        """
+        layer = snapshot.layers[layer_level]
+        leaf = layer_level == self._min_level
+        if not leaf and snapshot.horizons and index_from < index_to:
+            horizon = snapshot.horizons.get(self._deeper(snapshot, layer_level))
+            leaf = horizon is not None and (
+                self._bucket_start(snapshot, layer_level, index_from) < horizon
+            )
+
+        if leaf:
+            # Buckets are processed in blocks, so that the work done past the
+            # bucket at which the iteration stops is bounded.
+            blocks = range(index_from, index_to, _ITER_BUCKETS)
+            for block_from in reversed(blocks) if descending else blocks:
+                block_to = min(block_from + _ITER_BUCKETS, index_to)
+                buckets = np.arange(block_from, block_to)
+                indexes, ids = layer.gather(buckets, buckets, buckets + 1)
+                new = ~seen[ids]
+                indexes, ids = indexes[new], ids[new]
+
+                order = np.argsort(indexes, kind="stable")
+                order = order[::-1] if descending else order
+                indexes, ids = indexes[order], ids[order]
+                first = np.sort(np.unique(ids, return_index=True)[1])
+                indexes, ids = indexes[first], ids[first]
+
+                bounds = _bucket_boundaries(indexes)
+                starts = self._bucket_starts(snapshot, layer_level, indexes[bounds])
+                for start, bucket_ids in zip(starts, np.split(ids, bounds[1:])):
+                    yield int(start), bucket_ids
+
+            return
+
+        deeper_level = self._deeper(snapshot, layer_level)
+        indexes = range(index_from, index_to)
+        for index in reversed(indexes) if descending else indexes:
+            bucket = np.array([index])
+            _, ids = layer.gather(bucket, bucket, bucket + 1)
+            if seen[ids].all():
+                continue
+
+            ordinal = int(snapshot.virtual_indexes[layer_level][index])
+            ordinal += snapshot.bases[layer_level]
+            yield from self._walk(
+                snapshot,
+                deeper_level,
+                self._bisect(snapshot, deeper_level, int(layer_level.starts(ordinal))),
+                self._bisect(
+                    snapshot,
+                    deeper_level,
+                    int(layer_level.starts(ordinal + 1)),
+                ),
+                seen,
+                descending,
+            )
+
+    def _added_buckets(
+        self,
+        snapshot: Snapshot,
+        ts_from: int,
+        ts_to: int,
+        descending: bool,
+    ) -> List[Tuple[int, np.ndarray]]:
+        """Return the start and the distinct values of the buckets of the deltas."""
+        keys, values = [_NO_KEYS], [_NO_VALUES]
+        for delta in snapshot.deltas:
+            if len(delta):
+                timestamps, delta_values = delta.arrays()
+                timestamps = self._min_level.floor(timestamps)
+                mask = (timestamps >= ts_from) & (timestamps < ts_to)
+                keys.append(timestamps[mask])
+                values.append(delta_values[mask])
+
+        keys, values = np.concatenate(keys), np.concatenate(values)
+        order = np.argsort(keys, kind="stable")
+        keys, values = keys[order], values[order]
+        bounds = _bucket_boundaries(keys)
+        buckets = [
+            (int(key), np.unique(bucket_values))
+            for key, bucket_values in zip(keys[bounds], np.split(values, bounds[1:]))
+        ]
+        return buckets[::-1] if descending else buckets
+
+    def _estimate(self, snapshot: Snapshot, ts_from: int, ts_to: int) -> int:
+        """Return an upper bound of the postings a query goes through."""
+        postings = sum(len(delta) for delta in snapshot.deltas)
+        if snapshot.layers is None or ts_from >= ts_to:
+            return postings
+
+        index_from = self._bisect(snapshot, self._min_level, ts_from)
+        index_to = self._bisect(snapshot, self._min_level, ts_to)
+        return postings + snapshot.layers[self._min_level].count(index_from, index_to)
+
+    def count(
+        self,
+        date_from: datetime,
+        date_to: datetime,
+        exact_threshold: int = 10_000,
+    ) -> int:
+        """Return the number of distinct items in the provided time interval.
+
+        The count is exact for intervals going through at most `exact_threshold`
+        postings, otherwise it's estimated by merging the HyperLogLog sketches of the
+        buckets, with a standard error of about 3%. Sketches are built on the first
+        estimate and kept until the layers change.
+
+        """
+        if date_from >= date_to:
+            return 0
+
+        ts_from, ts_to = self._bounds(date_from, date_to)
+        snapshot = self._materialize(self._current(), ts_from, ts_to)
+        self._fallbacks(snapshot, ts_from, ts_to)
+        return self._count(snapshot, ts_from, ts_to, exact_threshold)
+
+    def histogram(
+        self,
+        date_from: datetime,
+        date_to: datetime,
+        level: LayerLevel = LayerLevel.HOUR,
+        exact_threshold: int = 10_000,
+    ) -> pd.Series:
+        """Return the number of distinct items of each bucket of the level.
+
+        Buckets are the ones overlapping the time interval, indexed by their start,
+        and only the items in the interval are counted. Buckets fully inside the
+        interval of a level having a layer are counted from its cardinalities, the
+        other ones as in `count`.
+
+        """
+        if level.value < self._min_level.value:
+            raise ValueError(
+                f"level {level.name} is lower than the minimum layer level "
+                f"{self._min_level.name}",
+            )
+
+        ts_from, ts_to = self._bounds(date_from, date_to)
+        if ts_from >= ts_to:
+            return pd.Series([], index=pd.DatetimeIndex([], tz="UTC"), dtype=np.int64)
+
+        snapshot = self._materialize(self._current(), ts_from, ts_to)
+        self._fallbacks(snapshot, ts_from, ts_to)
+
+        first, last = level.ordinals(np.array([ts_from, ts_to - 1]))
+        ordinals = np.arange(first, last + 1)
+        starts, ends = level.starts(ordinals), level.starts(ordinals + 1)
+        bucket_from, bucket_to = np.maximum(starts, ts_from), np.minimum(ends, ts_to)
+
+        exact = (bucket_from == starts) & (bucket_to == ends)
+        for delta in snapshot.deltas:
+            if len(delta):
+                timestamps, _ = delta.arrays()
+                exact &= ~np.isin(ordinals, level.ordinals(timestamps))
+
+        counts = np.zeros(len(ordinals), dtype=np.int64)
+        if snapshot.layers is not None and level in snapshot.layers:
+            indexes = self._searchsorted(snapshot, level, starts)
+            v_indexes = snapshot.virtual_indexes[level]
+            found = indexes < len(v_indexes)
+            found[found] = (
+                v_indexes[indexes[found]].astype(np.int64) + snapshot.bases[level]
+                == ordinals[found]
+            )
+            cardinalities = np.diff(self._sketches(snapshot)[1][level].cardinalities)
+            counts[exact & found] = cardinalities[indexes[exact & found]]
+        else:
+            exact[:] = False
+
+        for i in np.flatnonzero(~exact):
+            counts[i] = self._count(
+                snapshot,
+                int(bucket_from[i]),
+                int(bucket_to[i]),
+                exact_threshold,
+            )
+
+        return pd.Series(counts, index=pd.to_datetime(starts, unit="us", utc=True))
+
+    def _count(
+        self,
+        snapshot: Snapshot,
+        ts_from: int,
+        ts_to: int,
+        exact_threshold: int,
+    ) -> int:
+        ranges = self._plan(snapshot, ts_from, ts_to)
+        added = [
+            delta.search(self._min_level, ts_from, ts_to)
+            for delta in snapshot.deltas
+            if len(delta)
+        ]
+        postings = sum(len(values) for values in added)
+        if ranges:
+            sketches = self._sketches(snapshot)[1]
+            postings += sum(sketches[ll].count(f, t) for ll, f, t in ranges)
+
+        if postings <= exact_threshold:
+            return len(self._get(snapshot, ts_from, ts_to))
+
+        union = SketchUnion()
+        if ranges:
+            hashes, sketches = self._sketches(snapshot)
+            for layer_level, index_from, index_to in ranges:
+                sketches[layer_level].collect(
+                    snapshot.layers[layer_level],
+                    hashes,
+                    index_from,
+                    index_to,
+                    union,
+                )
+
+        for values in added:
+            union.add_hashes(hash_values(values))
+
+        return union.estimate()
+
+    def _sketches(
+        self,
+        snapshot: Snapshot,
+    ) -> Tuple[np.ndarray, Dict[LayerLevel, Sketches]]:
+        """Return the hashes of the dictionary and the sketches of the layers."""
+        sketches = snapshot.derived.get("sketches")
+        if sketches is None:
+            hashes = hash_values(np.asarray(snapshot.dictionary))
+            sketches = hashes, {
+                ll: Sketches.from_postings(layer, hashes)
+                for ll, layer in snapshot.layers.items()
+            }
+            snapshot.derived["sketches"] = sketches
+
+        return sketches
+
+    def occurrences(
+        self,
+        value: Hashable,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+    ) -> pd.DatetimeIndex:
+        """Return the start of the minimum level buckets in which the value occurs.
+
+        Only the buckets in the time interval are returned, if provided.
+
+        """
+        snapshot = self._current()
+        ts_from = None if date_from is None else self._timestamp(date_from)
+        ts_to = None if date_to is None else self._timestamp(date_to)
+
+        timestamps = _NO_KEYS
+        value_id = lookup(snapshot.dictionary, value)
+        if value_id is not None:
+            reverse = self._reverse(snapshot)
+            timestamps = reverse.occurrences(value_id, ts_from, ts_to)
+
+        added = self._added_occurrences(snapshot, value)
+        if len(added):
+            if ts_from is not None:
+                added = added[added >= ts_from]
+            if ts_to is not None:
+                added = added[added < ts_to]
+
+            timestamps = np.union1d(timestamps, added)
+
+        return pd.to_datetime(timestamps, unit="us", utc=True)
+
+    def first_seen(self, value: Hashable) -> Optional[datetime]:
+        """Return the start of the first minimum level bucket the value occurs in."""
+        return self._seen(value, ReverseIndex.first, min)
+
+    def last_seen(self, value: Hashable) -> Optional[datetime]:
+        """Return the start of the last minimum level bucket the value occurs in."""
+        return self._seen(value, ReverseIndex.last, max)
+
+    def cooccurrences(
+        self,
+        values: Sequence[Hashable],
+        date_from: datetime,
+        date_to: datetime,
+        level: Optional[LayerLevel] = None,
+    ) -> pd.DatetimeIndex:
+        """Return the start of the buckets of the level in which all the values occur.
+
+        Only the items in the time interval are considered, and the level defaults
+        to the minimum level. The buckets fully inside the interval are intersected
+        from the postings of the layer of the level, if any, and the remainders at
+        the edges from the postings of the minimum layer.
+
+        """
+        level = self._min_level if level is None else level
+        if level.value < self._min_level.value:
+            raise ValueError(
+                f"level {level.name} is lower than the minimum layer level "
+                f"{self._min_level.name}",
+            )
+
+        snapshot = self._current()
+        values = list(dict.fromkeys(values))
+        ts_from, ts_to = self._bounds(date_from, date_to)
+        if not values or ts_from >= ts_to:
+            return pd.DatetimeIndex([], tz="UTC")
+
+        ids, positions = [], []
+        for position, value in enumerate(values):
+            value_id = lookup(snapshot.dictionary, value)
+            if value_id is not None:
+                ids.append(value_id)
+                positions.append(position)
+
+        pieces = [(self._min_level, ts_from, ts_to)]
+        if snapshot.layers is not None and level in snapshot.layers:
+            first, last = level.ordinals(np.array([ts_from, ts_to]))
+            full_from = int(level.starts(first + (level.starts(first) < ts_from)))
+            full_to = int(level.starts(last))
+            if full_from < full_to:
+                pieces = [
+                    (self._min_level, ts_from, full_from),
+                    (level, full_from, full_to),
+                    (self._min_level, full_to, ts_to),
+                ]
+
+        order = np.argsort(ids)
+        ids, positions = np.array(ids)[order], np.array(positions)[order]
+        all_ordinals, all_positions = [_NO_KEYS], [_NO_KEYS]
+        for layer_level, piece_from, piece_to in pieces:
+            if piece_from < piece_to and len(ids):
+                ordinals, found = self._cooccurring(
+                    snapshot,
+                    layer_level,
+                    level,
+                    piece_from,
+                    piece_to,
+                    ids,
+                )
+                all_ordinals.append(ordinals)
+                all_positions.append(positions[found])
+
+        for delta in snapshot.deltas:
+            if len(delta):
+                timestamps, added_values = delta.arrays()
+                timestamps = self._min_level.floor(timestamps)
+                found = pd.Index(values).get_indexer(added_values)
+                mask = (found >= 0) & (timestamps >= ts_from) & (timestamps < ts_to)
+                all_ordinals.append(level.ordinals(timestamps[mask]))
+                all_positions.append(found[mask])
+
+        ordinals, _ = _unique_postings(
+            np.concatenate(all_ordinals),
+            np.concatenate(all_positions),
+        )
+        ordinals, counts = np.unique(ordinals, return_counts=True)
+        starts = level.starts(ordinals[counts == len(values)])
+        return pd.to_datetime(starts, unit="us", utc=True)
+
+    def _seen(
+        self,
+        value: Hashable,
+        seen: Callable[[ReverseIndex, int], Optional[int]],
+        pick: Callable,
+    ) -> Optional[datetime]:
+        snapshot = self._current()
+        candidates = []
+        value_id = lookup(snapshot.dictionary, value)
+        if value_id is not None:
+            timestamp = seen(self._reverse(snapshot), value_id)
+            if timestamp is not None:
+                candidates.append(timestamp)
+
+        added = self._added_occurrences(snapshot, value)
+        if len(added):
+            candidates.append(int(pick(added)))
+
+        if not candidates:
+            return None
+
+        return _EPOCH + timedelta(microseconds=pick(candidates))
+
+    def _added_occurrences(self, snapshot: Snapshot, value: Hashable) -> np.ndarray:
+        occurrences = []
+        for delta in snapshot.deltas:
+            if len(delta):
+                timestamps, values = delta.arrays()
+                occurrences.append(self._min_level.floor(timestamps[values == value]))
+
+        return np.concatenate(occurrences) if occurrences else _NO_KEYS
+
+    def _cooccurring(
+        self,
+        snapshot: Snapshot,
+        layer_level: LayerLevel,
+        level: LayerLevel,
+        ts_from: int,
+        ts_to: int,
+        ids: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the postings of the sorted ids in the buckets of the interval.
+
+        Postings are returned as the ordinal of the bucket of the level they are in
+        and the index of their id.
+
+        """
+        index_from = self._bisect(snapshot, layer_level, ts_from)
+        index_to = self._bisect(snapshot, layer_level, ts_to)
+        buckets = np.arange(index_from, index_to)
+        indexes, bucket_ids = snapshot.layers[layer_level].gather(
+            buckets,
+            buckets,
+            buckets + 1,
+        )
+
+        found = np.searchsorted(ids, bucket_ids)
+        found[found == len(ids)] = 0
+        mask = ids[found] == bucket_ids
+        starts = self._bucket_starts(snapshot, layer_level, indexes[mask])
+        return level.ordinals(starts), found[mask]
+
+    def _reverse(self, snapshot: Snapshot) -> ReverseIndex:
+        """Return the reverse index of the layers of the snapshot."""
+        reverse = snapshot.derived.get("reverse")
+        if reverse is None:
+            indexes, ids = snapshot.layers[self._min_level].expand()
+            reverse = ReverseIndex.from_postings(
+                self._bucket_starts(snapshot, self._min_level, indexes),
+                ids,
+                len(snapshot.dictionary),
+            )
+            snapshot.derived["reverse"] = reverse
+
+        return reverse
+
+    def _unions(self, snapshot: Snapshot) -> Dict[LayerLevel, RangeUnions]:
+        """Return the range unions of the layers of the snapshot."""
+        unions = snapshot.derived.get("unions")
+        if unions is None:
+            unions = {
+                ll: RangeUnions.from_postings(
+                    snapshot.layers[ll],
+                    span,
+                    len(snapshot.dictionary),
+                    bitmaps=self._bitmaps,
+                )
+                for ll, span in self._range_unions.items()
+                if ll in snapshot.layers
+            }
+            snapshot.derived["unions"] = unions
+
+        return unions
+
+    async def _warm(self) -> None:
+        """Build the structures derived from the layers that are built eagerly."""
+        snapshot = self._snapshot
+        if snapshot.layers is None:
+            return
+
+        loop = asyncio.get_event_loop()
+        if self._reverse_index:
+            await loop.run_in_executor(None, self._reverse, snapshot)
+
+        if self._range_unions:
+            await loop.run_in_executor(None, self._unions, snapshot)
+
+    def get_many(
+        self,
+        dates_from: Sequence[datetime],
+        dates_to: Sequence[datetime],
+        combine: bool = False,
+    ) -> Union[List[np.ndarray], np.ndarray]:
+        """Retrieve the items in the indexer for each of the provided time intervals.
+
+        The layer boundaries of all the intervals are resolved together level by
+        level, and the postings of all of them are deduplicated at once. Return the
+        items of each interval, or the items of all of them if `combine` is set.
+
+        """
+        ts_from = self._min_level.floor(to_epoch_microseconds(dates_from))
+        ts_to = self._min_level.floor(to_epoch_microseconds(dates_to))
+        snapshot = self._materialize(self._current(), ts_from, ts_to)
+        for f, t in zip(ts_from, ts_to):
+            self._fallbacks(snapshot, int(f), int(t))
+
+        return self._get_many(snapshot, ts_from, ts_to, combine)
+
+    async def aget_many(
+        self,
+        dates_from: Sequence[datetime],
+        dates_to: Sequence[datetime],
+        combine: bool = False,
+        offload_threshold: int = 100_000,
+    ) -> Union[List[np.ndarray], np.ndarray]:
+        """Retrieve the items of each time interval without blocking the loop.
+
+        Batches are offloaded to the default executor of the event loop as `aget`
+        does, given the sum of the estimates of their intervals.
+
+        """
+        ts_from = self._min_level.floor(to_epoch_microseconds(dates_from))
+        ts_to = self._min_level.floor(to_epoch_microseconds(dates_to))
+        snapshot = await self._amaterialize(self._current(), ts_from, ts_to)
+        for f, t in zip(ts_from, ts_to):
+            self._fallbacks(snapshot, int(f), int(t))
+
+        estimate = 0
+        for f, t in zip(ts_from, ts_to):
+            estimate += self._estimate(snapshot, int(f), int(t))
+            if estimate > offload_threshold:
+                break
+        else:
+            return self._get_many(snapshot, ts_from, ts_to, combine)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None,
+            functools.partial(self._get_many, snapshot, ts_from, ts_to, combine),
+        )
+
+    def _get_many(
+        self,
+        snapshot: Snapshot,
+        ts_from: np.ndarray,
+        ts_to: np.ndarray,
+        combine: bool,
+    ) -> Union[List[np.ndarray], np.ndarray]:
+        queries = np.arange(len(ts_from))
+
+        keys, ids = _NO_KEYS, _NO_IDS
+        if snapshot.horizons:
+            # Each interval is split in the pieces resolved down to the deepest
+            # level that still has their buckets.
+            pieces = [
+                (q, piece)
+                for q, (f, t) in enumerate(zip(ts_from, ts_to))
+                for piece in self._pieces(snapshot, int(f), int(t))
+            ]
+            keys, ids = self._search_many(
+                snapshot,
+                np.array([q for q, _ in pieces], dtype=np.int64),
+                np.array([piece[1] for _, piece in pieces], dtype=np.int64),
+                np.array([piece[2] for _, piece in pieces], dtype=np.int64),
+                np.array([piece[0].value for _, piece in pieces]),
+            )
+        elif snapshot.layers is not None:
+            keys, ids = self._search_many(snapshot, queries, ts_from, ts_to)
+
+        dictionary = _NO_VALUES if snapshot.dictionary is None else snapshot.dictionary
+        unseen = _NO_VALUES
+        added = [
+            delta.search_many(self._min_level, ts_from, ts_to)
+            for delta in snapshot.deltas
+            if len(delta)
+        ]
+        if any(len(indexes) for _, indexes, _ in added):
+            # The added values are looked up in the dictionary, while the ones not
+            # there take the ids following it, so that they're deduplicated along
+            # with the postings of the layers without rebuilding the dictionary.
+            unseen, added_ids = _lookup_many(
+                dictionary,
+                np.concatenate([values for _, _, values in added]),
+            )
+            offsets = np.cumsum([0] + [len(values) for _, _, values in added])
+            keys = np.concatenate([keys] + [ranges for ranges, _, _ in added])
+            ids = np.concatenate(
+                [ids]
+                + [
+                    added_ids[offset + indexes]
+                    for offset, (_, indexes, _) in zip(offsets, added)
+                ],
+            )
+
+        if len(unseen) or not isinstance(dictionary, np.ndarray):
+            # The values of the matched ids are resolved once into a dictionary of
+            # their own, so that encoded dictionaries decode each value once only,
+            # sorted again if the added values took ids following the dictionary.
+            present, ids = np.unique(ids, return_inverse=True)
+            known = present < len(dictionary)
+            values = np.empty(len(present), dtype="object")
+            values[known] = dictionary[present[known]]
+            values[~known] = unseen[present[~known] - len(dictionary)]
+            dictionary = values
+
+            if len(unseen):
+                order = np.argsort(values, kind="stable")
+                ranks = np.empty(len(order), dtype=np.int64)
+                ranks[order] = np.arange(len(order))
+                dictionary, ids = values[order], ranks[ids]
+
+        if combine:
+            return dictionary[np.unique(ids)] if len(ids) else _NO_VALUES
+
+        keys, ids = _unique_postings(keys, ids)
+        bounds = np.searchsorted(keys, np.arange(len(queries) + 1))
+        results = []
+        for q, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            results.append(dictionary[ids[start:end]] if end > start else _NO_VALUES)
+
+        return results
+
+    def _search_many(
+        self,
+        snapshot: Snapshot,
+        queries: np.ndarray,
+        ts_from: np.ndarray,
+        ts_to: np.ndarray,
+        min_levels: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Gather the postings of the intervals tagged with the query they belong to."""
+        all_queries, all_ids = [], []
+        for layer_level, range_queries, index_from, index_to in self._decompose(
+            snapshot,
+            queries,
+            ts_from,
+            ts_to,
+            min_levels,
+        ):
+            layer_queries, layer_ids = snapshot.layers[layer_level].gather(
+                range_queries,
+                index_from,
+                index_to,
+            )
+            all_queries.append(layer_queries)
+            all_ids.append(layer_ids)
+
+        if not all_ids:
+            return _NO_KEYS, _NO_IDS
+
+        return np.concatenate(all_queries), np.concatenate(all_ids)
+
+    def _decompose(
+        self,
+        snapshot: Snapshot,
+        queries: np.ndarray,
+        ts_from: np.ndarray,
+        ts_to: np.ndarray,
+        min_levels: Optional[np.ndarray] = None,
+        stats: Optional[QueryStats] = None,
+    ) -> List[Tuple[LayerLevel, np.ndarray, np.ndarray, np.ndarray]]:
+        """Return the ranges of buckets of each layer that make up the intervals.
+
+        The intervals are resolved together level by level from the top one. At
+        each level, the buckets starting in an interval but the last one are taken
+        as a whole, and the remainders on their left and right are resolved at the
+        deeper level, so that each level costs a single `np.searchsorted` whatever
+        the number of intervals. Intervals are resolved down to the level of the
+        value they have in `min_levels`, or down to the minimum level.
+
+        Return the layer level, queries, first and last bucket indexes of the
+        ranges of each level, top level first.
+
+        """
+        if min_levels is None:
+            min_levels = np.full(len(queries), self._min_level.value)
+
+        mask = ts_from < ts_to
+        queries, ts_from, ts_to = queries[mask], ts_from[mask], ts_to[mask]
+        min_levels = min_levels[mask]
+
+        steps = []
+        layer_level = self._top(snapshot)
+        while len(queries):
+            size = len(queries)
+            indexes = self._searchsorted(
+                snapshot,
+                layer_level,
+                np.concatenate([ts_from, ts_to]),
+            )
+            if stats is not None:
+                stats.searches += 1
+                stats.bisections += 2 * size
+
+            # The last bucket of an interval may end after it, except at the
+            # deepest level of the interval that it's aligned to.
+            leaf = min_levels == layer_level.value
+            index_from, index_to = indexes[:size], indexes[size:] - ~leaf
+            full = index_from < index_to
+            if full.any():
+                steps.append(
+                    (layer_level, queries[full], index_from[full], index_to[full]),
+                )
+
+            split, rest = full & ~leaf, ~full & ~leaf
+            bucket_from = self._bucket_starts(snapshot, layer_level, index_from[split])
+            bucket_to = self._bucket_starts(snapshot, layer_level, index_to[split])
+            queries = np.concatenate([queries[rest], queries[split], queries[split]])
+            min_levels = np.concatenate(
+                [min_levels[rest], min_levels[split], min_levels[split]],
+            )
+            ts_from, ts_to = (
+                np.concatenate([ts_from[rest], ts_from[split], bucket_to]),
+                np.concatenate([ts_to[rest], bucket_from, ts_to[split]]),
+            )
+
+            mask = ts_from < ts_to
+            queries, ts_from, ts_to = queries[mask], ts_from[mask], ts_to[mask]
+            min_levels = min_levels[mask]
+            if len(queries):
+                layer_level = self._deeper(snapshot, layer_level)
+
+        return steps
+
+    def _plan(
+        self,
+        snapshot: Snapshot,
+        ts_from: int,
+        ts_to: int,
+        stats: Optional[QueryStats] = None,
+    ) -> List[Tuple[LayerLevel, int, int]]:
+        """Return the ranges of buckets of each layer that make up the interval.
+
+        This is `_decompose` on a single interval, with scalar lookups in the level
+        tables that are cheaper than array operations on a couple of bounds. The
+        ranges are returned in time order.
+
+        """
+        if snapshot.layers is None:
+            return []
+
+        ranges = []
+        chain = self._chain(snapshot)
+        for min_level, piece_from, piece_to in self._pieces(snapshot, ts_from, ts_to):
+            intervals = [(piece_from, piece_to)]
+            for table in chain:
+                leaf = table.level == min_level
+                if stats is not None:
+                    stats.searches += 1
+                    stats.bisections += 2 * len(intervals)
+
+                remainders = []
+                for f, t in intervals:
+                    index_from, index_to = table.index(f), table.index(t)
+                    if not leaf:
+                        # The last bucket may end after the interval, so it's left
+                        # to the deeper levels along with the remainders.
+                        index_to -= 1
+
+                    if index_from < index_to:
+                        bucket_from = table.start(index_from)
+                        ranges.append((bucket_from, table.level, index_from, index_to))
+                        if not leaf:
+                            remainders.append((f, bucket_from))
+                            remainders.append((table.start(index_to), t))
+                    elif not leaf:
+                        remainders.append((f, t))
+
+                intervals = [(f, t) for f, t in remainders if f < t]
+                if leaf or not intervals:
+                    break
+
+        ranges.sort(key=lambda r: r[0])
+        return [(layer_level, f, t) for _, layer_level, f, t in ranges]
+
+    def _pieces(
+        self,
+        snapshot: Snapshot,
+        ts_from: int,
+        ts_to: int,
+    ) -> List[Tuple[LayerLevel, int, int]]:
+        """Split the interval by the deepest level that still has its buckets.
+
+        Each piece is returned in time order along with that level, and with its
+        bounds widened to the boundaries of the buckets of the level.
+
+        """
+        horizons = snapshot.horizons
+        if not horizons:
+            return [(self._min_level, ts_from, ts_to)]
+
+        pieces = []
+        piece_to = ts_to
+        for layer_level in _levels(snapshot.layers):
+            horizon = horizons.get(layer_level)
+            piece_from = ts_from if horizon is None else max(ts_from, horizon)
+            if piece_from < piece_to:
+                first, last = layer_level.ordinals(np.array([piece_from, piece_to - 1]))
+                pieces.append(
+                    (
+                        layer_level,
+                        int(layer_level.starts(first)),
+                        int(layer_level.starts(last + 1)),
+                    ),
+                )
+
+            if horizon is None or horizon <= ts_from:
+                break
+
+            piece_to = min(piece_to, horizon)
+
+        return pieces[::-1]
+
+    def _fallbacks(self, snapshot: Snapshot, ts_from: int, ts_to: int) -> None:
+        """Warn about the pieces of the interval answered by a coarser level.
+
+        Every query entry point calls this right away, so that the warnings point
+        at the caller of the query.
+
+        """
+        if ts_from >= ts_to:
+            return
+
+        for layer_level, piece_from, piece_to in self._pieces(snapshot, ts_from, ts_to):
+            if piece_from < ts_from or piece_to > ts_to:
+                warnings.warn(
+                    CoarseFallbackWarning(
+                        layer_level,
+                        _EPOCH + timedelta(microseconds=piece_from),
+                        _EPOCH + timedelta(microseconds=piece_to),
+                    ),
+                    stacklevel=3,
+                )
+
+    def _bisect(
+        self,
+        snapshot: Snapshot,
+        layer_level: LayerLevel,
+        timestamp: int,
+    ) -> int:
+        """Return the index of the first bucket starting at or after the timestamp."""
+        return self._table(snapshot, layer_level).index(timestamp)
+
+    def _searchsorted(
+        self,
+        snapshot: Snapshot,
+        layer_level: LayerLevel,
+        timestamps: np.ndarray,
+    ) -> np.ndarray:
+        """Vectorized `_bisect` over an array of epoch microseconds."""
+        return self._table(snapshot, layer_level).indexes(
+            np.asarray(timestamps, dtype=np.int64),
+        )
+
+    def _bucket_start(
+        self,
+        snapshot: Snapshot,
+        layer_level: LayerLevel,
+        index: int,
+    ) -> int:
+        """Return the epoch microseconds at which the bucket at the index starts."""
+        return self._table(snapshot, layer_level).start(index)
+
+    def _bucket_starts(
+        self,
+        snapshot: Snapshot,
+        layer_level: LayerLevel,
+        indexes: np.ndarray,
+    ) -> np.ndarray:
+        """Vectorized `_bucket_start` over an array of bucket indexes."""
+        return self._table(snapshot, layer_level).starts_of(indexes)
+
+    def _table(self, snapshot: Snapshot, layer_level: LayerLevel) -> LevelTable:
+        tables = snapshot.derived.get("tables")
+        if tables is None:
+            tables = snapshot.derived["tables"] = {}
+
+        table = tables.get(layer_level)
+        if table is None:
+            table = tables[layer_level] = LevelTable(
+                layer_level,
+                snapshot.virtual_indexes[layer_level],
+                snapshot.bases[layer_level],
+            )
+
+        return table
+
+    def _chain(self, snapshot: Snapshot) -> List[LevelTable]:
+        """Return the tables of the layers from the coarsest to the finest."""
+        chain = snapshot.derived.get("chain")
+        if chain is None:
+            chain = snapshot.derived["chain"] = [
+                self._table(snapshot, layer_level)
+                for layer_level in _levels(snapshot.layers)[::-1]
+            ]
+
+        return chain
+
+    async def load(
+        self,
+        items: Items,
+        chunksize: int = 100_000,
+        progress: Optional[Callable[["LoadProgress"], None]] = None,
+    ) -> None:
+        """Load the provided items in the indexer.
+
+        The items are either a list of items, an iterable or async iterable of lists
+        of items, or the path of a file supported by `read_file` that is read in
+        chunks of `chunksize` events. The layers are built incrementally chunk by
+        chunk and `progress` is called with a `LoadProgress` after each of them.
+        Any previously added item is discarded.
+
+        """
+        await self._load(read_chunks(items, chunksize), progress)
+
+    async def load_frame(
+        self,
+        df: pd.DataFrame,
+        timestamp: str = "timestamp",
+        value: str = "value",
+    ) -> None:
+        """Load the events of the frame in the indexer.
+
+        The frame is in long format, with a `timestamp` column and a `value` column
+        holding one value per row. Any previously added item is discarded.
+
+        """
+        await self._load(_aiter([frame_encoded_columns(df, timestamp, value)]))
+
+    async def load_arrow(
+        self,
+        table,
+        timestamp: str = "timestamp",
+        value: str = "value",
+    ) -> None:
+        """Load the events of the Arrow table in the indexer.
+
+        The table is in the same long format as for `load_frame`. Any previously
+        added item is discarded. Requires `pyarrow`.
+
+        """
+        await self._load(_aiter([arrow_encoded_columns(table, timestamp, value)]))
+
+    async def _load(
+        self,
+        chunks: AsyncIterable[EncodedColumns],
+        progress: Optional[Callable[[LoadProgress], None]] = None,
+    ) -> None:
+        # The layers are built in the default executor, so that queries keep being
+        # answered by the current snapshot until the new one is published.
+        loop = asyncio.get_event_loop()
+        builder = LayersBuilder(self._min_level)
+        async for timestamps, codes, uniques in chunks:
+            await loop.run_in_executor(None, builder.add, timestamps, codes, uniques)
+            if progress is not None:
+                progress(builder.progress)
+
+        levels, min_fanout = self._load_levels()
+        layers, v_indexes, bases, dictionary = await loop.run_in_executor(
+            None,
+            builder.build,
+            levels,
+            self._bitmaps,
+            min_fanout,
+        )
+        start = time.perf_counter()
+        layers, v_indexes, bases, horizons = await loop.run_in_executor(
+            None,
+            self._retain,
+            layers,
+            v_indexes,
+            bases,
+            None,
+        )
+        builder.progress._time("retain", start)
+        last_update = self._next_update()
+        layers, v_indexes, bases, dictionary = await self._store(
+            layers,
+            v_indexes,
+            bases,
+            dictionary,
+            last_update,
+        )
+        self._last_load = builder.progress
+        self._generation += 1
+        self._publish(
+            layers,
+            v_indexes,
+            bases,
+            dictionary,
+            deltas=(Delta(),),
+            last_update=last_update,
+            horizons=horizons,
+        )
+        await self._warm()
+
+    async def _store(
+        self,
+        layers: Dict[LayerLevel, Postings],
+        v_indexes: Dict[LayerLevel, np.ndarray],
+        bases: Dict[LayerLevel, int],
+        dictionary: np.ndarray,
+        last_update: Optional[datetime],
+    ) -> Tuple[dict, dict, dict, np.ndarray]:
+        """Return the built layers to publish, once stored as the indexer keeps them.
+
+        Loads and compactions store the layers before checking that no other load
+        replaced them in the meanwhile, so storing must not be visible until they
+        are published, and is undone by `_discard` otherwise. In-memory indexers
+        keep them as built.
+
+        """
+        return layers, v_indexes, bases, dictionary
+
+    def _discard(self, layers: Dict[LayerLevel, Postings]) -> None:
+        """Drop the stored layers that are not going to be published."""
+
+    async def add(self, item: dict) -> None:
+        """Add the provided item in the indexer."""
+        await self.add_many([item])
+
+    async def add_many(self, items: List[dict]) -> None:
+        """Add the provided items in the indexer.
+
+        The items are immediately visible to queries, while they are folded into
+        the layers by a background compaction once enough of them are pending.
+
+        """
+        timestamps, values = items_columns(items)
+        self._snapshot.deltas[-1].extend(timestamps, values)
+        self._touch()
+
+        if (
+            self._compaction is None
+            and len(self._snapshot.deltas[-1]) >= self._compaction_threshold
+        ):
+            self._compaction = asyncio.ensure_future(self._compact())
+
+    async def compact(self) -> None:
+        """Fold all the added items into the layers."""
+        if self._compaction is not None:
+            await self._compaction
+
+        if len(self._snapshot.deltas[-1]):
+            self._compaction = asyncio.ensure_future(self._compact())
+            await self._compaction
+
+    async def _compact(self) -> None:
+        # The delta being compacted is frozen and keeps being searched until the
+        # new layers are swapped in, while new items go to a fresh delta.
+        snapshot = self._snapshot
+        delta = snapshot.deltas[-1]
+        self._snapshot = snapshot._replace(deltas=snapshot.deltas + (Delta(),))
+        generation = self._generation
+
+        loop = asyncio.get_event_loop()
+        try:
+            layers, v_indexes, bases, dictionary = await loop.run_in_executor(
+                None,
+                self._merge,
+                snapshot,
+                delta,
+            )
+            layers, v_indexes, bases, horizons = await loop.run_in_executor(
+                None,
+                self._retain,
+                layers,
+                v_indexes,
+                bases,
+                snapshot.horizons,
+            )
+            # Dropping buckets changes the results of the queries.
+            last_update = (
+                None
+                if horizons == (snapshot.horizons or {})
+                else self._next_update()
+            )
+            layers, v_indexes, bases, dictionary = await self._store(
+                layers,
+                v_indexes,
+                bases,
+                dictionary,
+                last_update,
+            )
+        finally:
+            self._compaction = None
+
+        # A `load` happened in the meanwhile and already replaced everything.
+        if generation != self._generation:
+            self._discard(layers)
+            return
+
+        self._publish(
+            layers,
+            v_indexes,
+            bases,
+            dictionary,
+            deltas=tuple(d for d in self._snapshot.deltas if d is not delta),
+            last_update=last_update,
+            horizons=horizons,
+        )
+        await self._warm()
+
+    def _publish(
+        self,
+        layers: Dict[LayerLevel, Postings],
+        v_indexes: Dict[LayerLevel, np.ndarray],
+        bases: Dict[LayerLevel, int],
+        dictionary: np.ndarray,
+        deltas: Optional[Tuple[Delta, ...]] = None,
+        last_update: Optional[datetime] = None,
+        horizons: Optional[Dict[LayerLevel, int]] = None,
+    ) -> None:
+        """Make the provided layers the ones used by queries.
+
+        The deltas, the last update and the horizons are kept unless provided, and
+        everything is swapped in at once as a new snapshot.
+
+        """
+        snapshot = self._snapshot
+        self._snapshot = Snapshot(
+            layers=layers,
+            virtual_indexes=v_indexes,
+            bases=bases,
+            dictionary=dictionary,
+            deltas=snapshot.deltas if deltas is None else deltas,
+            last_update=snapshot.last_update if last_update is None else last_update,
+            derived={},
+            horizons=snapshot.horizons if horizons is None else horizons,
+        )
+
+    def _load_levels(self) -> Tuple[List[LayerLevel], Optional[float]]:
+        """Return the levels of the layers built on load and the minimum fanout."""
+        if not self._lazy:
+            return self._levels, self._min_fanout
+
+        return [self._min_level] + _levels(self._pinned), None
+
+    def _merge(
+        self,
+        snapshot: Snapshot,
+        delta: Delta,
+    ) -> Tuple[dict, dict, dict, np.ndarray]:
+        timestamps, values = delta.arrays()
+        timestamps = self._min_level.floor(timestamps)
+        # Compactions keep the levels of the layers, that may have been chosen out of
+        # the candidate ones on load.
+        levels, min_fanout = self._load_levels()
+        if snapshot.layers is None:
+            ids, dictionary = _encode(values)
+        elif snapshot.horizons:
+            return self._merge_levels(snapshot, timestamps, values)
+        else:
+            levels, min_fanout = _levels(snapshot.layers), None
+            indexes, old_ids = snapshot.layers[self._min_level].expand()
+            remap, ids, dictionary = _merge_dictionaries(snapshot.dictionary, values)
+
+            timestamps = np.concatenate(
+                [self._bucket_starts(snapshot, self._min_level, indexes), timestamps],
+            )
+            ids = np.concatenate([remap[old_ids], ids])
+
+        layers, v_indexes, bases = _build_layers(
+            levels,
+            timestamps,
+            ids,
+            bitmaps=self._bitmaps,
+            dictionary_size=len(dictionary),
+            min_fanout=min_fanout,
+        )
+        return layers, v_indexes, bases, dictionary
+
+    def _merge_levels(
+        self,
+        snapshot: Snapshot,
+        timestamps: np.ndarray,
+        values: np.ndarray,
+    ) -> Tuple[dict, dict, dict, np.ndarray]:
+        """Merge the postings into each layer on its own.
+
+        Coarser layers hold the items of the buckets dropped from the finer ones, so
+        they can't be rebuilt out of the minimum layer.
+
+        """
+        remap, added_ids, dictionary = _merge_dictionaries(snapshot.dictionary, values)
+
+        layers, v_indexes, bases = {}, {}, {}
+        for ll in _levels(snapshot.layers):
+            indexes, old_ids = snapshot.layers[ll].expand()
+            old_keys = self._bucket_starts(snapshot, ll, indexes)
+            keys = ll.floor(timestamps)
+            horizon = snapshot.horizons.get(ll)
+            mask = slice(None) if horizon is None else keys >= horizon
+            layer, v_index, base = _build_layers(
+                [ll],
+                np.concatenate([old_keys, keys[mask]]),
+                np.concatenate([remap[old_ids], added_ids[mask]]),
+                bitmaps=self._bitmaps,
+                dictionary_size=len(dictionary),
+            )
+            layers.update(layer)
+            v_indexes.update(v_index)
+            bases.update(base)
+
+        return layers, v_indexes, bases, dictionary
+
+    def _retain(
+        self,
+        layers: Dict[LayerLevel, Postings],
+        v_indexes: Dict[LayerLevel, np.ndarray],
+        bases: Dict[LayerLevel, int],
+        horizons: Optional[Dict[LayerLevel, int]],
+    ) -> Tuple[dict, dict, dict, dict]:
+        """Drop the buckets out of the retention policy and of the memory budget.
+
+        Return the layers, virtual indexes and bases left, along with the horizons
+        of the layers.
+
+        """
+        horizons = dict(horizons or {})
+        if not self._retention and self._memory_budget is None:
+            return layers, v_indexes, bases, horizons
+
+        layers, v_indexes, bases = dict(layers), dict(v_indexes), dict(bases)
+        levels = _levels(layers)
+        boundaries = dict(zip(levels, levels[1:] + levels[-1:]))
+        now = self._indexify(datetime.utcnow().replace(tzinfo=timezone.utc))
+        for ll, age in self._retention.items():
+            if ll in layers:
+                horizon = _horizon(boundaries[ll], now - age // _MICROSECOND)
+                horizons[ll] = max(horizons.get(ll, horizon), horizon)
+
+        _trim(levels, layers, v_indexes, bases, horizons)
+        if self._memory_budget is None:
+            return layers, v_indexes, bases, horizons
+
+        # The oldest half of the buckets of the deepest level left is dropped until
+        # the layers fit in the budget.
+        for ll in levels[:-1]:
+            while _nbytes(layers, v_indexes) > self._memory_budget and len(layers[ll]):
+                ordinals = v_indexes[ll].astype(np.int64) + bases[ll]
+                start = int(ll.starts(ordinals[0]))
+                middle = int(ll.starts(ordinals[len(ordinals) // 2]))
+                horizon = _horizon(boundaries[ll], middle)
+                if horizon <= start:
+                    # The middle bucket shares its coarser bucket with the first.
+                    horizon = _horizon(boundaries[ll], middle, upper=True)
+
+                horizons[ll] = max(horizons.get(ll, horizon), horizon)
+                _trim(levels, layers, v_indexes, bases, horizons)
+
+        return layers, v_indexes, bases, horizons
+
+    async def evict(self) -> None:
+        """Apply the retention policy and the memory budget to the layers now."""
+        snapshot = self._snapshot
+        if snapshot.layers is None:
+            return
+
+        loop = asyncio.get_event_loop()
+        layers, v_indexes, bases, horizons = await loop.run_in_executor(
+            None,
+            self._retain,
+            snapshot.layers,
+            snapshot.virtual_indexes,
+            snapshot.bases,
+            snapshot.horizons,
+        )
+
+        # A load or a compaction replaced the layers in the meanwhile.
+        if self._snapshot.layers is not snapshot.layers:
+            return
+
+        if horizons != (snapshot.horizons or {}):
+            self._publish(
+                layers,
+                v_indexes,
+                bases,
+                snapshot.dictionary,
+                last_update=self._next_update(),
+                horizons=horizons,
+            )
+            await self._warm()
+
+    def _top(self, snapshot: Snapshot) -> LayerLevel:
+        """Return the coarsest level having a layer."""
+        return _levels(snapshot.layers)[-1]
+
+    def _deeper(self, snapshot: Snapshot, layer_level: LayerLevel) -> LayerLevel:
+        """Return the next finer level having a layer."""
+        deeper = snapshot.derived.get("deeper")
+        if deeper is None:
+            levels = _levels(snapshot.layers)
+            deeper = dict(zip(levels[1:], levels))
+            snapshot.derived["deeper"] = deeper
+
+        return deeper[layer_level]
+
+
+def _whole_buckets(
+    level: LayerLevel,
+    ts_from: Union[int, np.ndarray],
+    ts_to: Union[int, np.ndarray],
+) -> np.ndarray:
+    """Return whether each interval holds a whole bucket of the level."""
+    duration, offset = LayerLevel._durations[level], LayerLevel._offsets[level]
+    if duration is not None:
+        return -((-ts_from - offset) // duration) < (ts_to + offset) // duration
+
+    first = level.ordinals(ts_from)
+    first = first + (level.starts(first) < ts_from)
+    return first < level.ordinals(ts_to)
+
+
+def _levels(layers: Iterable[LayerLevel]) -> List[LayerLevel]:
+    """Return the levels of the layers from the finest to the coarsest."""
+    return sorted(layers, key=lambda ll: ll.value)
+
+
+def _check_levels(levels: Sequence[LayerLevel]) -> List[LayerLevel]:
+    """Return the levels from the finest to the coarsest.
+
+    Raise `ValueError` unless each bucket of a level is inside a single bucket of
+    the next coarser one, as layers are built and searched level by level.
+
+    """
+    levels = sorted(set(levels), key=lambda ll: ll.value)
+    if not levels:
+        raise ValueError("at least one layer level is required")
+
+    for finer, coarser in zip(levels, levels[1:]):
+        if not finer.nests(coarser):
+            raise ValueError(
+                f"the buckets of level {finer.name} are not nested in the buckets "
+                f"of level {coarser.name}",
+            )
+
+    return levels
+
+
+def _horizon(level: LayerLevel, timestamp: int, upper: bool = False) -> int:
+    """Return the boundary of the buckets of the level at the timestamp.
+
+    Buckets of the finer layers are dropped up to this boundary, so that the rest
+    of the time is covered by whole buckets of the level. The boundary is the one
+    before the timestamp, or the one after it with `upper`.
+
+    """
+    ordinal = int(level.ordinals(timestamp))
+    return int(level.starts(ordinal + 1 if upper else ordinal))
+
+
+def _trim(
+    levels: List[LayerLevel],
+    layers: Dict[LayerLevel, Postings],
+    v_indexes: Dict[LayerLevel, np.ndarray],
+    bases: Dict[LayerLevel, int],
+    horizons: Dict[LayerLevel, int],
+) -> None:
+    """Drop the buckets of the layers starting before their horizon, in place.
+
+    The horizons are raised first so that finer layers never have buckets that the
+    coarser ones dropped.
+
+    """
+    horizon = None
+    for ll in reversed(levels):
+        if ll in horizons and (horizon is None or horizons[ll] > horizon):
+            horizon = horizons[ll]
+        elif horizon is not None:
+            horizons[ll] = horizon
+
+        if horizon is None:
+            continue
+
+        ordinals = v_indexes[ll].astype(np.int64) + bases[ll]
+        count = int(np.searchsorted(ordinals, int(ll.ordinals(horizon))))
+        if count:
+            layers[ll] = layers[ll].drop(count)
+            ordinals = ordinals[count:]
+            bases[ll] = int(ordinals[0]) if len(ordinals) else bases[ll]
+            v_indexes[ll] = _virtual_indexes(ordinals - bases[ll])
+
+
+def _nbytes(
+    layers: Dict[LayerLevel, Postings],
+    v_indexes: Dict[LayerLevel, np.ndarray],
+) -> int:
+    """Return the memory taken by the layers."""
+    return sum(layer.nbytes for layer in layers.values()) + sum(
+        v_index.nbytes for v_index in v_indexes.values()
+    )
+
+
+def _take(chunks: Iterator[np.ndarray], limit: Optional[int]) -> Iterator[np.ndarray]:
+    """Yield the non-empty chunks until `limit` values have been yielded."""
+    remaining = limit
+    if remaining is not None and remaining <= 0:
+        return
+
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+
+        if remaining is not None:
+            if len(chunk) >= remaining:
+                yield chunk[:remaining]
+                return
+
+            remaining -= len(chunk)
+
+        yield chunk
+
+
+def _first_added(
+    values: np.ndarray,
+    dictionary: Optional[np.ndarray],
+    seen: np.ndarray,
+    seen_added: set,
+) -> np.ndarray:
+    """Return the added values not seen yet, marking them as seen."""
+    first = []
+    for value in values:
+        value_id = lookup(dictionary, value)
+        if value_id is None:
+            if value not in seen_added:
+                seen_added.add(value)
+                first.append(value)
+        elif not seen[value_id]:
+            seen[value_id] = True
+            first.append(value)
+
+    return np.array(first, dtype="object")
+
+
+async def _aiter(chunks: Iterable[EncodedColumns]) -> AsyncIterator[EncodedColumns]:
+    for chunk in chunks:
+        yield chunk
+
+
+def _encode(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Dictionary-encode the values into ids.
+
+    The dictionary is sorted so that sorting ids is equivalent to sorting values.
+
+    """
+    codes, uniques = pd.factorize(values)
+    order = np.argsort(uniques)
+    ranks = np.empty(len(order), dtype=_ids_dtype(len(order)))
+    ranks[order] = np.arange(len(order))
+    return ranks[codes], uniques[order]
+
+
+def _merge_dictionaries(
+    dictionary: np.ndarray,
+    values: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merge the values into the sorted dictionary.
+
+    Return the mapping from the old ids to the new ones, the ids of the values and
+    the merged dictionary.
+
+    """
+    codes, uniques = pd.factorize(values)
+    size = len(dictionary)
+
+    # The dictionary is an already sorted run that the stable sort merges in linear
+    # time with the few new values.
+    merged = np.concatenate([dictionary, uniques])
+    order = np.argsort(merged, kind="stable")
+    merged = merged[order]
+
+    # Values already in the dictionary are kept once only.
+    mask = np.ones(len(merged), dtype=bool)
+    mask[1:] = merged[1:] != merged[:-1]
+    ranks = np.empty(len(order), dtype=_ids_dtype(mask.sum()))
+    ranks[order] = np.cumsum(mask) - 1
+
+    return ranks[:size], ranks[size:][codes], merged[mask]
+
+
+def _lookup_many(
+    dictionary: np.ndarray,
+    values: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Look up the values in the sorted dictionary.
+
+    Return the values not in the dictionary and the ids of the values, where the
+    ones not in the dictionary take the ids following it in order of appearance.
+
+    """
+    codes, uniques = pd.factorize(values)
+    size = len(dictionary)
+
+    indexes = np.searchsorted(dictionary, uniques)
+    found = indexes < size
+    found[found] = dictionary[indexes[found]] == uniques[found]
+
+    unseen = uniques[~found]
+    indexes[~found] = size + np.arange(len(unseen))
+    return unseen, indexes[codes]
+
+
+def _ids_dtype(size: int) -> np.dtype:
+    """Return the smallest data type for the ids of a dictionary of the given size."""
+    if size < 2 ** 31:
+        return np.dtype(np.int32)
+
+    return np.dtype(np.int64)
+
+
+def _build_layers(
+    layer_levels: List[LayerLevel],
+    timestamps: np.ndarray,
+    ids: np.ndarray,
+    bitmaps: bool = False,
+    dictionary_size: int = 0,
+    min_fanout: Optional[float] = None,
+    timings: Optional[Dict[LayerLevel, float]] = None,
+) -> Tuple[
+    Dict[LayerLevel, Postings],
+    Dict[LayerLevel, np.ndarray],
+    Dict[LayerLevel, int],
+]:
+    """Build the postings and the virtual indexes of each of the layer levels.
+
+    The virtual indexes of a layer are the bucket ordinals relative to the ordinal of
+    its first bucket, that is stored as the base of the layer. With `bitmaps` set the
+    postings are converted to bitmaps over a dictionary of the provided size. With
+    `min_fanout`, the levels whose buckets hold on average fewer buckets of the
+    previous layer are skipped, except the first one. The seconds spent on each
+    level are recorded in `timings`, if provided.
+
+    """
+    layers, v_indexes, bases = {}, {}, {}
+    keys = timestamps
+    buckets = None
+    for ll in layer_levels:
+        start = time.perf_counter()
+        # Each layer is built out of the deduplicated postings of the previous
+        # level as coarser buckets are always unions of finer buckets, even when
+        # that level has been skipped.
+        keys, ids = _unique_postings(ll.floor(keys), ids)
+        starts = _bucket_boundaries(keys)
+        skip = (
+            min_fanout is not None
+            and buckets is not None
+            and buckets < len(starts) * min_fanout
+        )
+        if not skip:
+            buckets = len(starts)
+            ordinals = ll.ordinals(keys[starts])
+            bases[ll] = int(ordinals[0]) if len(ordinals) else 0
+
+            layers[ll] = Postings(ids, np.append(starts, len(ids)))
+            if bitmaps:
+                layers[ll] = BitmapPostings.from_postings(layers[ll], dictionary_size)
+
+            v_indexes[ll] = _virtual_indexes(ordinals - bases[ll])
+
+        if timings is not None:
+            timings[ll] = time.perf_counter() - start
+
+    return layers, v_indexes, bases
+
+
+def _unique_postings(
+    keys: np.ndarray,
+    ids: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Sort the postings by key and id and remove the duplicated pairs."""
+    order = np.lexsort((ids, keys))
+    keys, ids = keys[order], ids[order]
+
+    mask = np.ones(len(keys), dtype=bool)
+    mask[1:] = (keys[1:] != keys[:-1]) | (ids[1:] != ids[:-1])
+    return keys[mask], ids[mask]
+
+
+def _bucket_boundaries(keys: np.ndarray) -> np.ndarray:
+    """Return the positions where a new bucket starts in the sorted keys."""
+    mask = np.ones(len(keys), dtype=bool)
+    mask[1:] = keys[1:] != keys[:-1]
+    return np.flatnonzero(mask)
+
+
+def _virtual_indexes(arr: np.ndarray) -> np.ndarray:
+    """Cast the virtual indexes to the smallest unsigned data type that fits them.
+
+    The data type is chosen again on every build, so virtual indexes grown by added
+    items never overflow. Its maximum is kept out of the virtual indexes so that it
+    can be used to clamp the query bounds.
+
+    """
+    max_value = arr.max() if len(arr) else 0
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value < np.iinfo(dtype).max:
+            return arr.astype(dtype)
+
+    return arr.astype(np.uint64)
@@ -0,0 +1,239 @@
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+
+_NO_IDS = np.array([], dtype=np.int32)
+
+
+class PostingsUnion:
+    """Accumulator of the ids of ranges of buckets of one or more layers."""
+
+    __slots__ = ["chunks", "bitmaps"]
+
+    def __init__(self):
+        """Initialize an empty union."""
+        self.chunks = []
+        self.bitmaps = []
+
+    def __bool__(self) -> bool:
+        """Return whether any range of buckets has been added."""
+        return bool(self.chunks or self.bitmaps)
+
+    def ids(self, keep: Optional[np.ndarray] = None) -> np.ndarray:
+        """Return the sorted distinct ids of all the added ranges of buckets.
+
+        With `keep`, a mask over the ids, only the ids it's set for are returned.
+        They are filtered before being deduplicated, so that the ids filtered out
+        are never sorted.
+
+        """
+        chunks = [chunk for chunk in self.chunks if len(chunk)]
+        if keep is not None:
+            chunks = [chunk[keep[chunk]] for chunk in chunks]
+
+        if not self.bitmaps:
+            if not chunks:
+                return _NO_IDS
+
+            if len(chunks) == 1:
+                return np.unique(chunks[0])
+
+            return np.unique(np.concatenate(chunks))
+
+        # Deduplication is free once everything is or-ed into a single bitmap.
+        bitmap = self.bitmaps[0]
+        for other in self.bitmaps[1:]:
+            bitmap = bitmap | other
+
+        mask = np.unpackbits(bitmap).view(bool)
+        if keep is not None:
+            size = len(keep)
+            mask[:size] &= keep
+            mask[size:] = False
+        for chunk in chunks:
+            mask[chunk] = True
+
+        return np.flatnonzero(mask)
+
+
+class Postings:
+    """Postings lists of a layer stored as a flat buffer of ids plus bucket offsets.
+
+    The ids of the i-th bucket are `ids[offsets[i]:offsets[i + 1]]` so that the ids
+    of any range of contiguous buckets are a single zero-copy slice.
+
+    """
+
+    __slots__ = ["ids", "offsets"]
+
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray):
+        """Initialize the postings from the ids buffer and the buckets offsets."""
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        """Return the number of buckets."""
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        """Return the memory taken by the postings."""
+        return self.ids.nbytes + self.offsets.nbytes
+
+    def drop(self, count: int) -> "Postings":
+        """Return a copy of the postings without the first `count` buckets."""
+        start = self.offsets[count]
+        return Postings(self.ids[start:].copy(), self.offsets[count:] - start)
+
+    def slice(self, index_from: int, index_to: int) -> np.ndarray:
+        """Return the ids of the buckets in the range `[index_from, index_to)`."""
+        start, end = self.offsets[index_from], self.offsets[index_to]
+        return self.ids[start:end]
+
+    def count(self, index_from: int, index_to: int) -> int:
+        """Return the postings in the buckets in the range `[index_from, index_to)`."""
+        return int(self.offsets[index_to] - self.offsets[index_from])
+
+    def collect(self, index_from: int, index_to: int, union: PostingsUnion) -> None:
+        """Add the buckets in the range `[index_from, index_to)` to the union."""
+        union.chunks.append(self.slice(index_from, index_to))
+
+    def gather(
+        self,
+        queries: np.ndarray,
+        index_from: np.ndarray,
+        index_to: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the ids of each range of buckets tagged with the query it belongs to.
+
+        This is the vectorized `slice` over many ranges at once.
+
+        """
+        starts, ends = self.offsets[index_from], self.offsets[index_to]
+        lengths = ends - starts
+        positions = np.arange(lengths.sum()) + np.repeat(
+            starts - (np.cumsum(lengths) - lengths),
+            lengths,
+        )
+        return np.repeat(queries, lengths), self.ids[positions]
+
+    def expand(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the bucket index and the id of each posting."""
+        indexes = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        return indexes, self.ids
+
+
+class BitmapPostings(Postings):
+    """Postings lists of a layer stored either as ids or as bitmaps over the ids.
+
+    Similarly to roaring bitmaps, each bucket uses the cheapest container: buckets
+    whose ids take more memory than a bitmap over the whole dictionary are stored
+    as packed bitmaps, while the others are kept in the inherited flat ids buffer
+    where they take no space. Bitmaps are stored in bucket order with their own
+    offsets, so that the bitmaps of a range of buckets are a single slice too.
+
+    """
+
+    __slots__ = ["bitmaps", "bitmap_offsets"]
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        offsets: np.ndarray,
+        bitmaps: np.ndarray,
+        bitmap_offsets: np.ndarray,
+    ):
+        """Initialize the postings from the ids and the bitmaps of the buckets."""
+        super().__init__(ids, offsets)
+        self.bitmaps = bitmaps
+        self.bitmap_offsets = bitmap_offsets
+
+    @classmethod
+    def from_postings(cls, postings: Postings, size: int) -> "BitmapPostings":
+        """Convert the postings over a dictionary of the provided size."""
+        n_bytes = (size + 7) // 8
+        cardinalities = np.diff(postings.offsets)
+        dense = cardinalities * postings.ids.itemsize > n_bytes
+
+        indexes, ids = postings.expand()
+        in_bitmap = dense[indexes]
+
+        rows = np.zeros((dense.sum(), n_bytes * 8), dtype=bool)
+        bitmap_offsets = np.zeros(len(dense) + 1, dtype=np.int64)
+        np.cumsum(dense, out=bitmap_offsets[1:])
+        rows[bitmap_offsets[indexes[in_bitmap]], ids[in_bitmap]] = True
+
+        offsets = np.zeros(len(dense) + 1, dtype=postings.offsets.dtype)
+        np.cumsum(np.where(dense, 0, cardinalities), out=offsets[1:])
+
+        return cls(ids[~in_bitmap], offsets, np.packbits(rows, axis=1), bitmap_offsets)
+
+    @property
+    def nbytes(self) -> int:
+        """Return the memory taken by the postings."""
+        return super().nbytes + self.bitmaps.nbytes + self.bitmap_offsets.nbytes
+
+    def drop(self, count: int) -> "BitmapPostings":
+        """Return a copy of the postings without the first `count` buckets."""
+        postings = super().drop(count)
+        start = self.bitmap_offsets[count]
+        return BitmapPostings(
+            postings.ids,
+            postings.offsets,
+            self.bitmaps[start:].copy(),
+            self.bitmap_offsets[count:] - start,
+        )
+
+    def count(self, index_from: int, index_to: int) -> int:
+        """Return the postings in the buckets in the range `[index_from, index_to)`."""
+        start, end = self.bitmap_offsets[index_from], self.bitmap_offsets[index_to]
+        bits = int(np.unpackbits(self.bitmaps[start:end]).sum())
+        return super().count(index_from, index_to) + bits
+
+    def collect(self, index_from: int, index_to: int, union: PostingsUnion) -> None:
+        """Add the buckets in the range `[index_from, index_to)` to the union."""
+        super().collect(index_from, index_to, union)
+
+        start, end = self.bitmap_offsets[index_from], self.bitmap_offsets[index_to]
+        if start < end:
+            union.bitmaps.append(np.bitwise_or.reduce(self.bitmaps[start:end]))
+
+    def gather(
+        self,
+        queries: np.ndarray,
+        index_from: np.ndarray,
+        index_to: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the ids of each range of buckets tagged with the query it belongs to.
+
+        This is the vectorized `slice` over many ranges at once.
+
+        """
+        array_queries, array_ids = super().gather(queries, index_from, index_to)
+
+        starts = self.bitmap_offsets[index_from]
+        lengths = self.bitmap_offsets[index_to] - starts
+        rows = np.arange(lengths.sum()) + np.repeat(
+            starts - (np.cumsum(lengths) - lengths),
+            lengths,
+        )
+        positions, bitmap_ids = np.nonzero(np.unpackbits(self.bitmaps[rows], axis=1))
+
+        return (
+            np.concatenate([array_queries, np.repeat(queries, lengths)[positions]]),
+            np.concatenate([array_ids, bitmap_ids]),
+        )
+
+    def expand(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the bucket index and the id of each posting."""
+        array_indexes, array_ids = super().expand()
+
+        dense_indexes = np.flatnonzero(np.diff(self.bitmap_offsets))
+        rows, bitmap_ids = np.nonzero(np.unpackbits(self.bitmaps, axis=1))
+
+        indexes = np.concatenate([array_indexes, dense_indexes[rows]])
+        ids = np.concatenate([array_ids, bitmap_ids.astype(array_ids.dtype)])
+        order = np.argsort(indexes, kind="stable")
+        return indexes[order], ids[order]
@@ -0,0 +1,218 @@
+import asyncio
+import itertools
+import os
+from datetime import datetime
+from typing import AsyncIterable
+from typing import AsyncIterator
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+
+Columns = Tuple[np.ndarray, np.ndarray]
+EncodedColumns = Tuple[np.ndarray, np.ndarray, np.ndarray]
+Items = Union[List[dict], Iterable[List[dict]], AsyncIterable[List[dict]], str]
+
+
+def to_epoch_microseconds(dates: Sequence[datetime]) -> np.ndarray:
+    """Convert the dates to epoch microseconds, naive dates being taken as UTC."""
+    return np.asarray(pd.DatetimeIndex(pd.to_datetime(dates, utc=True)).asi8) // 1000
+
+
+def items_columns(items: List[dict]) -> Columns:
+    """Flatten the items into aligned arrays of epoch microseconds and values."""
+    timestamps = to_epoch_microseconds([item["timestamp"] for item in items])
+    lengths = np.fromiter(
+        (len(item["values"]) for item in items),
+        dtype=np.int64,
+        count=len(items),
+    )
+    values = np.empty(lengths.sum(), dtype="object")
+    values[:] = list(itertools.chain.from_iterable(item["values"] for item in items))
+
+    return _drop_empty(np.repeat(timestamps, lengths), values)
+
+
+def frame_columns(df: pd.DataFrame) -> Columns:
+    """Return the aligned arrays of epoch microseconds and values of the frame.
+
+    The frame has a `timestamp` column and either a `values` column of lists of
+    values, or a `value` column holding one value per row.
+
+    """
+    timestamps = to_epoch_microseconds(df["timestamp"])
+    if "value" in df.columns:
+        return _drop_empty(timestamps, df["value"].to_numpy(dtype="object"))
+
+    lengths = df["values"].map(len).to_numpy(dtype=np.int64)
+    values = np.empty(lengths.sum(), dtype="object")
+    values[:] = list(itertools.chain.from_iterable(df["values"]))
+
+    return _drop_empty(np.repeat(timestamps, lengths), values)
+
+
+def encode(timestamps: np.ndarray, values: np.ndarray) -> EncodedColumns:
+    """Dictionary-encode the values into the codes of their distinct values."""
+    codes, uniques = pd.factorize(values)
+    return _drop_empty_codes(timestamps, codes, np.asarray(uniques, dtype="object"))
+
+
+def frame_encoded_columns(
+    df: pd.DataFrame,
+    timestamp: str = "timestamp",
+    value: str = "value",
+) -> EncodedColumns:
+    """Return the epoch microseconds, value codes and distinct values of the frame.
+
+    The frame is in long format with one value per row. Categorical value columns
+    are used as they are, so that no value is ever materialized per row.
+
+    """
+    timestamps = to_epoch_microseconds(df[timestamp])
+    codes, uniques = pd.factorize(df[value])
+    return _drop_empty_codes(timestamps, codes, np.asarray(uniques, dtype="object"))
+
+
+def arrow_encoded_columns(
+    table,
+    timestamp: str = "timestamp",
+    value: str = "value",
+) -> EncodedColumns:
+    """Return the epoch microseconds, value codes and distinct values of the table.
+
+    The table is in long format with one value per row. Timestamps are read from the
+    column buffers and values are dictionary-encoded by Arrow, so that only the
+    distinct values are converted to Python objects. Requires `pyarrow`.
+
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:  # pragma: no cover
+        raise ImportError("reading Arrow tables requires pyarrow") from None
+
+    column = table.column(timestamp)
+    if pa.types.is_timestamp(column.type):
+        column = pc.cast(column, pa.timestamp("us", tz=column.type.tz))
+        timestamps = np.asarray(column.to_numpy()).view(np.int64)
+    else:
+        timestamps = to_epoch_microseconds(column.to_pandas())
+
+    column = table.column(value)
+    if not pa.types.is_dictionary(column.type):
+        column = pc.dictionary_encode(column)
+
+    # A single dictionary is needed for the codes of every chunk to be comparable.
+    column = pa.table([column], names=[value]).unify_dictionaries().column(0)
+    if column.num_chunks == 0:
+        return timestamps, np.array([], dtype=np.int64), np.array([], dtype="object")
+
+    codes = np.concatenate(
+        [
+            pc.fill_null(chunk.indices, -1).to_numpy(zero_copy_only=False)
+            for chunk in column.chunks
+        ],
+    )
+    uniques = column.chunk(0).dictionary.to_numpy(zero_copy_only=False)
+    return _drop_empty_codes(timestamps, codes, np.asarray(uniques, dtype="object"))
+
+
+def read_file(path: str, chunksize: int = 100_000) -> Iterator[Columns]:
+    """Read the events in the file at the path chunk by chunk.
+
+    Supported formats are NDJSON (`.ndjson`, `.jsonl`) with one item per line, CSV
+    (`.csv`) with `timestamp` and `value` columns, and Parquet (`.parquet`) with
+    either layout of `frame_columns`. Parquet files require `pyarrow`.
+
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".ndjson", ".jsonl"):
+        frames = pd.read_json(
+            path,
+            lines=True,
+            chunksize=chunksize,
+            convert_dates=False,
+        )
+    elif ext == ".csv":
+        frames = pd.read_csv(path, chunksize=chunksize, dtype={"value": "object"})
+    elif ext == ".parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:  # pragma: no cover
+            raise ImportError("reading Parquet files requires pyarrow") from None
+
+        parquet_file = pq.ParquetFile(path)
+        frames = (
+            batch.to_pandas() for batch in parquet_file.iter_batches(chunksize)
+        )
+    else:
+        raise ValueError(f"unsupported file format: {path}")
+
+    for df in frames:
+        yield frame_columns(df)
+
+
+async def read_chunks(items: Items, chunksize: int) -> AsyncIterator[EncodedColumns]:
+    """Yield the encoded columns of each chunk of the items.
+
+    The items are either a list of items, an iterable or async iterable of lists
+    of items, or the path of a file supported by `read_file`. Chunks are read and
+    encoded in the default executor of the event loop, so that the loop keeps
+    running in the meanwhile.
+
+    """
+    loop = asyncio.get_event_loop()
+    if isinstance(items, list) and (not items or isinstance(items[0], dict)):
+        yield await loop.run_in_executor(None, _encode_items, items)
+    elif hasattr(items, "__aiter__"):
+        async for chunk in items:
+            yield await loop.run_in_executor(None, _encode_items, chunk)
+    else:
+        if isinstance(items, (str, os.PathLike)):
+            chunks = read_file(os.fspath(items), chunksize)
+        else:
+            chunks = (items_columns(chunk) for chunk in items)
+
+        while True:
+            encoded = await loop.run_in_executor(None, _encode_next, chunks)
+            if encoded is None:
+                return
+
+            yield encoded
+
+
+def _encode_items(items: List[dict]) -> EncodedColumns:
+    return encode(*items_columns(items))
+
+
+def _encode_next(chunks: Iterator[Columns]) -> Optional[EncodedColumns]:
+    columns = next(chunks, None)
+    return None if columns is None else encode(*columns)
+
+
+def _drop_empty_codes(
+    timestamps: np.ndarray,
+    codes: np.ndarray,
+    uniques: np.ndarray,
+) -> EncodedColumns:
+    """Drop the falsy and missing distinct values and the rows referring to them."""
+    keep = uniques.astype(bool) & pd.notna(uniques)
+    mask = np.append(keep, False)[codes]
+    if mask.all():
+        return timestamps, codes, uniques
+
+    remap = np.cumsum(keep) - 1
+    return timestamps[mask], remap[codes[mask]], uniques[keep]
+
+
+def _drop_empty(timestamps: np.ndarray, values: np.ndarray) -> Columns:
+    """Drop the falsy and missing values as they would never be returned."""
+    mask = values.astype(bool) & pd.notna(values)
+    return timestamps[mask], values[mask]
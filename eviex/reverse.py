@@ -0,0 +1,56 @@
+from typing import Optional
+
+import numpy as np
+
+
+class ReverseIndex:
+    """Sorted bucket starts of the occurrences of each value of the dictionary.
+
+    The bucket starts of the value with id `i` are
+    `timestamps[offsets[i]:offsets[i + 1]]`, as epoch microseconds truncated to the
+    minimum layer level.
+
+    """
+
+    __slots__ = ["timestamps", "offsets"]
+
+    def __init__(self, timestamps: np.ndarray, offsets: np.ndarray):
+        """Initialize the index from the bucket starts and the values offsets."""
+        self.timestamps = timestamps
+        self.offsets = offsets
+
+    @classmethod
+    def from_postings(
+        cls,
+        timestamps: np.ndarray,
+        ids: np.ndarray,
+        size: int,
+    ) -> "ReverseIndex":
+        """Build the index of the postings over a dictionary of the provided size."""
+        order = np.lexsort((timestamps, ids))
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ids, minlength=size), out=offsets[1:])
+        return cls(timestamps[order], offsets)
+
+    def occurrences(
+        self,
+        value_id: int,
+        ts_from: Optional[int] = None,
+        ts_to: Optional[int] = None,
+    ) -> np.ndarray:
+        """Return the bucket starts of the value in the range `[ts_from, ts_to)`."""
+        start, end = self.offsets[value_id], self.offsets[value_id + 1]
+        timestamps = self.timestamps[start:end]
+        start = 0 if ts_from is None else np.searchsorted(timestamps, ts_from)
+        end = len(timestamps) if ts_to is None else np.searchsorted(timestamps, ts_to)
+        return timestamps[start:end]
+
+    def first(self, value_id: int) -> Optional[int]:
+        """Return the first bucket start of the value, if any."""
+        start, end = self.offsets[value_id], self.offsets[value_id + 1]
+        return int(self.timestamps[start]) if start < end else None
+
+    def last(self, value_id: int) -> Optional[int]:
+        """Return the last bucket start of the value, if any."""
+        start, end = self.offsets[value_id], self.offsets[value_id + 1]
+        return int(self.timestamps[end - 1]) if start < end else None
@@ -0,0 +1,243 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from eviex.filters import ValueFilter
+from eviex.indexer import MAX_LAYER_LEVEL
+from eviex.indexer import MIN_LAYER_LEVEL
+from eviex.indexer import Indexer
+from eviex.indexer import LayerLevel
+from eviex.indexer import LayersBuilder
+from eviex.indexer import MemoryIndexer
+from eviex.readers import Items
+from eviex.readers import encode
+from eviex.readers import read_chunks
+from eviex.readers import to_epoch_microseconds
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_NO_TIMESTAMPS = np.array([], dtype=np.int64)
+_NO_VALUES = np.array([], dtype="object")
+
+
+class ShardedIndexer(Indexer):
+    """Indexer partitioning the items in time shards, each one a `MemoryIndexer`.
+
+    Each shard holds the items of a single bucket of `shard_level` and has the layers
+    from `min_level` up to `shard_level`, or `max_level` if lower. Shards are built
+    in parallel in a process pool of `max_workers` on load. Queries are routed to
+    the shards overlapping the time interval only and run in parallel in a thread
+    pool of `query_workers`. Shards fully inside the interval are answered from the
+    single bucket of their top layer.
+
+    """
+
+    __slots__ = [
+        "_shard_level",
+        "_shards",
+        "_ordinals",
+        "_bitmaps",
+        "_compaction_threshold",
+        "_max_workers",
+        "_query_executor",
+    ]
+
+    def __init__(
+        self,
+        min_level: Optional[LayerLevel] = MIN_LAYER_LEVEL,
+        max_level: Optional[LayerLevel] = MAX_LAYER_LEVEL,
+        shard_level: LayerLevel = LayerLevel.YEAR,
+        compaction_threshold: int = 100_000,
+        bitmaps: bool = False,
+        max_workers: Optional[int] = None,
+        query_workers: Optional[int] = None,
+    ):
+        """Initialize a sharded indexer with the provided layer level ranges."""
+        if shard_level.value < min_level.value:
+            raise ValueError(
+                f"shard level {shard_level.name} is lower than the minimum layer "
+                f"level {min_level.name}",
+            )
+
+        super().__init__(":memory:", min_level=min_level, max_level=max_level)
+        self._shard_level = shard_level
+        self._shards = {}
+        self._ordinals = np.array([], dtype=np.int64)
+        self._bitmaps = bitmaps
+        self._compaction_threshold = compaction_threshold
+        self._max_workers = max_workers
+        self._query_executor = ThreadPoolExecutor(max_workers=query_workers)
+
+    @property
+    def shards(self) -> Dict[datetime, MemoryIndexer]:
+        """Return the shards by the start of their bucket of the shard level."""
+        starts = self._shard_level.starts(self._ordinals)
+        return {
+            _to_datetime(start): self._shards[ordinal]
+            for start, ordinal in zip(starts, self._ordinals)
+        }
+
+    def get(
+        self,
+        date_from: datetime,
+        date_to: datetime,
+        values: Optional[ValueFilter] = None,
+    ) -> np.ndarray:
+        """Retrieve the items in the indexer according to the provided time interval.
+
+        With `values`, only the items passing the filter are returned, each shard
+        applying it to its own postings.
+
+        """
+        if date_from >= date_to:
+            return _NO_VALUES
+
+        ts_from = self._indexify(self._min_level.transform(date_from))
+        ts_to = self._indexify(self._min_level.transform(date_to))
+        if ts_from >= ts_to:
+            return _NO_VALUES
+
+        first, last = self._shard_level.ordinals(np.array([ts_from, ts_to - 1]))
+        index_from = np.searchsorted(self._ordinals, first, side="left")
+        index_to = np.searchsorted(self._ordinals, last, side="right")
+        ordinals = self._ordinals[index_from:index_to]
+        if not len(ordinals):
+            return _NO_VALUES
+
+        starts = self._shard_level.starts(ordinals)
+        ends = self._shard_level.starts(ordinals + 1)
+        queries = []
+        for ordinal, start, end in zip(ordinals, starts, ends):
+            if start >= ts_from and end <= ts_to:
+                # The whole shard is a single bucket of its top layer.
+                bounds = (_to_datetime(start), _to_datetime(end))
+            else:
+                bounds = (date_from, date_to)
+
+            queries.append((self._shards[ordinal],) + bounds + (values,))
+
+        if len(queries) == 1:
+            return _query(queries[0])
+
+        results = list(self._query_executor.map(_query, queries))
+        return np.unique(np.concatenate(results))
+
+    async def load(self, items: Items, chunksize: int = 100_000) -> None:
+        """Load the provided items in the indexer building the shards in parallel.
+
+        The items are the same as for `MemoryIndexer.load`. Any previously added
+        item is discarded.
+
+        """
+        chunks = []
+        async for timestamps, codes, uniques in read_chunks(items, chunksize):
+            chunks.append((timestamps, uniques[codes]))
+
+        timestamps = np.concatenate([_NO_TIMESTAMPS] + [c[0] for c in chunks])
+        values = np.concatenate([_NO_VALUES] + [c[1] for c in chunks])
+        del chunks
+
+        ordinals = self._shard_level.ordinals(timestamps)
+        order = np.argsort(ordinals, kind="stable")
+        ordinals, timestamps, values = ordinals[order], timestamps[order], values[order]
+        shard_ordinals, starts = np.unique(ordinals, return_index=True)
+        ends = np.append(starts[1:], len(ordinals))
+
+        loop = asyncio.get_event_loop()
+        with ProcessPoolExecutor(max_workers=self._max_workers) as executor:
+            built = await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        executor,
+                        _build_shard,
+                        self._min_level,
+                        self._shards_max_level(),
+                        self._bitmaps,
+                        timestamps[start:end],
+                        values[start:end],
+                    )
+                    for start, end in zip(starts, ends)
+                ],
+            )
+
+        shards = {}
+        for ordinal, layers in zip(shard_ordinals, built):
+            shard = self._new_shard()
+            shard._publish(*layers)
+            shard._touch()
+            shards[ordinal] = shard
+
+        self._shards = shards
+        self._ordinals = shard_ordinals
+        self._touch()
+
+    async def add(self, item: dict) -> None:
+        """Add the provided item in the indexer."""
+        await self.add_many([item])
+
+    async def add_many(self, items: List[dict]) -> None:
+        """Add the provided items to the shards they belong to."""
+        ordinals = self._shard_level.ordinals(
+            to_epoch_microseconds([item["timestamp"] for item in items]),
+        )
+        for ordinal in np.unique(ordinals):
+            if ordinal not in self._shards:
+                self._shards[ordinal] = self._new_shard()
+                self._ordinals = np.sort(np.append(self._ordinals, ordinal))
+
+            shard_items = [item for item, o in zip(items, ordinals) if o == ordinal]
+            await self._shards[ordinal].add_many(shard_items)
+
+        self._touch()
+
+    async def compact(self) -> None:
+        """Fold all the added items into the layers of the shards."""
+        await asyncio.gather(*[shard.compact() for shard in self._shards.values()])
+
+    def close(self) -> None:
+        """Shut down the pool of threads running the queries."""
+        self._query_executor.shutdown()
+
+    def _new_shard(self) -> MemoryIndexer:
+        return MemoryIndexer(
+            min_level=self._min_level,
+            max_level=self._shards_max_level(),
+            compaction_threshold=self._compaction_threshold,
+            bitmaps=self._bitmaps,
+        )
+
+    def _shards_max_level(self) -> LayerLevel:
+        return min(self._max_level, self._shard_level, key=lambda ll: ll.value)
+
+
+def _build_shard(
+    min_level: LayerLevel,
+    max_level: LayerLevel,
+    bitmaps: bool,
+    timestamps: np.ndarray,
+    values: np.ndarray,
+) -> Tuple[dict, dict, dict, np.ndarray]:
+    """Build the layers of a shard, run in a worker process."""
+    builder = LayersBuilder(min_level)
+    builder.add(*encode(timestamps, values))
+    return builder.build(LayerLevel.chain(min_level, max_level), bitmaps)
+
+
+def _query(
+    query: Tuple[MemoryIndexer, datetime, datetime, Optional[ValueFilter]],
+) -> np.ndarray:
+    shard, date_from, date_to, values = query
+    return shard.get(date_from, date_to, values=values)
+
+
+def _to_datetime(ts: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=int(ts))
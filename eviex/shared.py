@@ -0,0 +1,296 @@
+"""Sharing of indexers between processes through shared memory.
+
+A `SharedIndexer` publishes each new version of its layers into its own shared
+memory segment named `<name>-<version>`, laid out as the files of `eviex.storage`.
+Once a segment is complete, its version is written into the manifest, the 8 bytes
+shared memory segment `<name>` holding the current version as a little-endian
+integer, and the segment of the previous version is unlinked. Processes that
+already attached to it keep their mapping until they release it.
+
+`SharedReplica`s attach zero-copy to the segment of the current version and switch
+to the newer ones as soon as they are published, so that the memory taken by the
+layers is shared between all the processes instead of being multiplied by them.
+
+Requires Python 3.8+.
+
+"""
+import sys
+from datetime import datetime
+from typing import AsyncIterable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from eviex.cache import ResultCache
+from eviex.indexer import MAX_LAYER_LEVEL
+from eviex.indexer import MIN_LAYER_LEVEL
+from eviex.indexer import Delta
+from eviex.indexer import LayerLevel
+from eviex.indexer import LoadProgress
+from eviex.indexer import MemoryIndexer
+from eviex.indexer import Snapshot
+from eviex.postings import Postings
+from eviex.readers import EncodedColumns
+from eviex.storage import build_metadata
+from eviex.storage import check_metadata
+from eviex.storage import from_arrays
+from eviex.storage import layout
+from eviex.storage import read_buffer
+from eviex.storage import read_last_update
+from eviex.storage import to_arrays
+from eviex.storage import write_buffer
+
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover
+    raise ImportError("eviex.shared requires Python 3.8+") from None
+
+
+_VERSION_SIZE = 8
+
+
+class SharedIndexer(MemoryIndexer):
+    """Indexer publishing its layers into shared memory.
+
+    A new version is published on every load and compaction, so added items are
+    visible to the replicas only once compacted. The published dictionary only
+    supports string values. The segments are unlinked on `close`.
+
+    """
+
+    __slots__ = ["_manifest", "_segment", "_retired", "_version"]
+
+    def __init__(
+        self,
+        name: str,
+        min_level: Optional[LayerLevel] = MIN_LAYER_LEVEL,
+        max_level: Optional[LayerLevel] = MAX_LAYER_LEVEL,
+        compaction_threshold: int = 100_000,
+        bitmaps: bool = False,
+        cache: Optional[ResultCache] = None,
+    ):
+        """Initialize an indexer publishing into the shared memory with the name."""
+        super().__init__(
+            min_level=min_level,
+            max_level=max_level,
+            compaction_threshold=compaction_threshold,
+            bitmaps=bitmaps,
+            cache=cache,
+        )
+        self._uri = name
+        self._manifest = shared_memory.SharedMemory(
+            name=name,
+            create=True,
+            size=_VERSION_SIZE,
+        )
+        self._segment = None
+        self._retired = []
+        self._version = 0
+        _write_version(self._manifest, 0)
+
+    @property
+    def version(self) -> int:
+        """Return the last published version, 0 if none has been published."""
+        return self._version
+
+    def close(self) -> None:
+        """Unlink the manifest and the segment of the current version."""
+        self._snapshot = Snapshot(deltas=self._snapshot.deltas)
+        if self._segment is not None:
+            self._segment.unlink()
+            self._retire(self._segment)
+            self._segment = None
+
+        self._manifest.unlink()
+        self._manifest.close()
+
+    def _publish(
+        self,
+        layers: Dict[LayerLevel, Postings],
+        v_indexes: Dict[LayerLevel, np.ndarray],
+        bases: Dict[LayerLevel, int],
+        dictionary: np.ndarray,
+        deltas: Optional[Tuple[Delta, ...]] = None,
+        last_update: Optional[datetime] = None,
+        horizons: Optional[Dict[LayerLevel, int]] = None,
+    ) -> None:
+        """Make the provided layers the ones used by queries and by the replicas."""
+        if last_update is None:
+            last_update = self._next_update()
+
+        metadata = build_metadata(self, bases, last_update)
+        arrays = to_arrays(layers, v_indexes, dictionary)
+
+        version = self._version + 1
+        segment = shared_memory.SharedMemory(
+            name=f"{self._uri}-{version}",
+            create=True,
+            size=layout(metadata, arrays)[3],
+        )
+        buf = np.frombuffer(segment.buf, dtype=np.uint8)
+        write_buffer(buf, metadata, arrays)
+        header, arrays = read_buffer(_read_only(buf), segment.name)
+        super()._publish(
+            *from_arrays(header["bases"], arrays),
+            deltas=deltas,
+            last_update=last_update,
+            horizons=horizons,
+        )
+
+        _write_version(self._manifest, version)
+        if self._segment is not None:
+            self._segment.unlink()
+            self._retire(self._segment)
+
+        self._segment = segment
+        self._version = version
+
+    def _retire(self, segment: shared_memory.SharedMemory) -> None:
+        self._retired.append(segment)
+        self._retired = _close(self._retired)
+
+
+class SharedReplica(MemoryIndexer):
+    """Read-only indexer attached to the layers published by a `SharedIndexer`.
+
+    The current version is checked on every query, whether it's a lookup by time
+    or by value, and the replica switches to a newer one as a whole before
+    answering. Until the first version is published the replica is empty.
+
+    """
+
+    __slots__ = ["_manifest", "_segment", "_retired", "_version"]
+
+    def __init__(
+        self,
+        name: str,
+        min_level: Optional[LayerLevel] = MIN_LAYER_LEVEL,
+        max_level: Optional[LayerLevel] = MAX_LAYER_LEVEL,
+        bitmaps: bool = False,
+        cache: Optional[ResultCache] = None,
+    ):
+        """Initialize a replica of the indexer publishing with the name."""
+        super().__init__(
+            min_level=min_level,
+            max_level=max_level,
+            bitmaps=bitmaps,
+            cache=cache,
+        )
+        self._uri = name
+        self._manifest = _attach(name)
+        self._segment = None
+        self._retired = []
+        self._version = 0
+        self.refresh()
+
+    @property
+    def version(self) -> int:
+        """Return the version the replica is attached to, 0 if none."""
+        return self._version
+
+    def refresh(self) -> bool:
+        """Switch to the current version if newer, returning whether it was."""
+        while True:
+            version = _read_version(self._manifest)
+            if version == self._version:
+                return False
+
+            try:
+                segment = _attach(f"{self._uri}-{version}")
+            except FileNotFoundError:
+                # The version has been superseded in the meanwhile.
+                continue
+
+            break
+
+        buf = _read_only(np.frombuffer(segment.buf, dtype=np.uint8))
+        header, arrays = read_buffer(buf, segment.name)
+        check_metadata(self, header, segment.name)
+
+        self._publish(
+            *from_arrays(header["bases"], arrays),
+            last_update=read_last_update(header),
+        )
+        if self._segment is not None:
+            self._retired = _close(self._retired + [self._segment])
+
+        self._segment = segment
+        self._version = version
+        return True
+
+    def close(self) -> None:
+        """Detach from the shared memory."""
+        self._snapshot = Snapshot(deltas=self._snapshot.deltas)
+        segments = self._retired + [self._manifest]
+        if self._segment is not None:
+            segments.append(self._segment)
+
+        self._segment = None
+        self._retired = _close(segments)
+
+    def _current(self) -> Snapshot:
+        self.refresh()
+        return self._snapshot
+
+    async def add(self, item: dict) -> None:
+        """Raise as replicas are read-only."""
+        raise NotImplementedError("shared replicas are read-only")
+
+    async def add_many(self, items: List[dict]) -> None:
+        """Raise as replicas are read-only."""
+        raise NotImplementedError("shared replicas are read-only")
+
+    async def _load(
+        self,
+        chunks: AsyncIterable[EncodedColumns],
+        progress: Optional[Callable[[LoadProgress], None]] = None,
+    ) -> None:
+        raise NotImplementedError("shared replicas are read-only")
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """Attach to the shared memory without tracking it.
+
+    Otherwise the resource tracker of this process would unlink it at exit, while
+    it's owned by the publishing process.
+
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    segment = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def _close(
+    segments: List[shared_memory.SharedMemory],
+) -> List[shared_memory.SharedMemory]:
+    """Close the segments, returning the ones still in use by some array."""
+    in_use = []
+    for segment in segments:
+        try:
+            segment.close()
+        except BufferError:
+            in_use.append(segment)
+
+    return in_use
+
+
+def _read_only(buf: np.ndarray) -> np.ndarray:
+    buf.flags.writeable = False
+    return buf
+
+
+def _read_version(manifest: shared_memory.SharedMemory) -> int:
+    return int(np.frombuffer(manifest.buf, dtype="<i8", count=1)[0])
+
+
+def _write_version(manifest: shared_memory.SharedMemory, version: int) -> None:
+    np.frombuffer(manifest.buf, dtype="<i8", count=1)[0] = version
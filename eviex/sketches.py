@@ -0,0 +1,140 @@
+import math
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from eviex.postings import Postings
+
+
+PRECISION = 10
+REGISTERS = 1 << PRECISION
+
+_HASH_BITS = 64 - PRECISION
+_ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+
+
+def hash_values(values: np.ndarray) -> np.ndarray:
+    """Return the 64 bits hashes of the values, the same for equal values."""
+    return pd.util.hash_array(np.asarray(values, dtype="object"))
+
+
+class SketchUnion:
+    """HyperLogLog sketch accumulating the distinct values of ranges of buckets."""
+
+    __slots__ = ["registers"]
+
+    def __init__(self):
+        """Initialize an empty sketch."""
+        self.registers = np.zeros(REGISTERS, dtype=np.uint8)
+
+    def add_hashes(self, hashes: np.ndarray) -> None:
+        """Add the values with the provided hashes."""
+        indexes, ranks = _registers(hashes)
+        np.maximum.at(self.registers, indexes, ranks)
+
+    def add_registers(self, registers: np.ndarray) -> None:
+        """Merge the provided rows of registers."""
+        if len(registers):
+            np.maximum(self.registers, registers.max(axis=0), out=self.registers)
+
+    def estimate(self) -> int:
+        """Return the estimated number of distinct values."""
+        ranks = self.registers.astype(np.int64)
+        estimate = _ALPHA * REGISTERS ** 2 / np.sum(np.ldexp(1.0, -ranks))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * REGISTERS and zeros:
+            estimate = REGISTERS * math.log(REGISTERS / zeros)
+
+        return int(round(estimate))
+
+
+class Sketches:
+    """Cardinalities and HyperLogLog sketches of the buckets of a layer.
+
+    Similarly to `BitmapPostings`, only the buckets whose hashes would take more
+    memory than a sketch have their registers stored, while the sketch of the other
+    ones is computed from their postings when needed, so that the sketches never
+    take more memory than the postings.
+
+    """
+
+    __slots__ = ["cardinalities", "registers", "register_offsets", "sparse"]
+
+    def __init__(
+        self,
+        cardinalities: np.ndarray,
+        registers: np.ndarray,
+        register_offsets: np.ndarray,
+        sparse: np.ndarray,
+    ):
+        """Initialize the sketches from the cumulative cardinalities and registers."""
+        self.cardinalities = cardinalities
+        self.registers = registers
+        self.register_offsets = register_offsets
+        self.sparse = sparse
+
+    @classmethod
+    def from_postings(cls, postings: Postings, hashes: np.ndarray) -> "Sketches":
+        """Build the sketches of the postings given the hashes of the dictionary."""
+        indexes, ids = postings.expand()
+        counts = np.bincount(indexes, minlength=len(postings))
+        cardinalities = np.zeros(len(postings) + 1, dtype=np.int64)
+        np.cumsum(counts, out=cardinalities[1:])
+
+        dense = counts * hashes.itemsize > REGISTERS
+        register_offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        np.cumsum(dense, out=register_offsets[1:])
+
+        in_dense = dense[indexes]
+        registers = np.zeros((dense.sum(), REGISTERS), dtype=np.uint8)
+        register_indexes, ranks = _registers(hashes[ids[in_dense]])
+        np.maximum.at(
+            registers,
+            (register_offsets[indexes[in_dense]], register_indexes),
+            ranks,
+        )
+
+        return cls(cardinalities, registers, register_offsets, np.flatnonzero(~dense))
+
+    def count(self, index_from: int, index_to: int) -> int:
+        """Return the postings in the buckets in the range `[index_from, index_to)`."""
+        return int(self.cardinalities[index_to] - self.cardinalities[index_from])
+
+    def collect(
+        self,
+        postings: Postings,
+        hashes: np.ndarray,
+        index_from: int,
+        index_to: int,
+        union: SketchUnion,
+    ) -> None:
+        """Add the buckets in the range `[index_from, index_to)` to the sketch."""
+        start, end = self.register_offsets[index_from], self.register_offsets[index_to]
+        union.add_registers(self.registers[start:end])
+
+        start, end = np.searchsorted(self.sparse, [index_from, index_to])
+        sparse = self.sparse[start:end]
+        if len(sparse):
+            queries = np.zeros(len(sparse), dtype=np.int64)
+            _, ids = postings.gather(queries, sparse, sparse + 1)
+            union.add_hashes(hashes[ids])
+
+
+def _registers(hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the register and the rank of each hash."""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    indexes = (hashes >> np.uint64(_HASH_BITS)).astype(np.intp)
+    rest = hashes & np.uint64((1 << _HASH_BITS) - 1)
+    ranks = (_HASH_BITS + 1 - _bit_length(rest)).astype(np.uint8)
+    return indexes, ranks
+
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    lengths = np.zeros(values.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        mask = values >= np.uint64(1 << shift)
+        lengths[mask] += shift
+        values = np.where(mask, values >> np.uint64(shift), values)
+
+    return lengths + (values > 0)
@@ -0,0 +1,446 @@
+"""Persistence of indexers into a single memory-mapped file.
+
+The file format is made of the following sections, all integers being little-endian:
+
+- 8 bytes of magic: `b"EVIEX\\x00\\x00\\x01"`, the last byte being the format version;
+- 8 bytes of unsigned integer: the length `H` of the header;
+- `H` bytes of UTF-8 JSON header;
+- the data section, starting at the first offset multiple of 64 after the header.
+
+The header holds the indexer configuration (`min_level`, `max_level` and `bitmaps`
+as layer level names and boolean), the `last_update` as epoch microseconds, the
+`bases` of the layers by layer level name and the `arrays` table. Each entry of the
+table has the `name`, the numpy `dtype` string, the `shape` and the `offset` of a
+C-contiguous array relative to the start of the data section. Arrays offsets are
+aligned to 64 bytes.
+
+Arrays are named after the layer level they belong to:
+
+- `<LEVEL>.ids`, `<LEVEL>.offsets`: the flat postings of the layer;
+- `<LEVEL>.bitmaps`, `<LEVEL>.bitmap_offsets`: the bitmaps of the layer, if any;
+- `<LEVEL>.virtual_indexes`: the virtual indexes of the layer;
+- `dictionary.data`, `dictionary.offsets`: the UTF-8 encoded values of the
+  dictionary concatenated, and the offset of each of them.
+
+"""
+import asyncio
+import json
+import os
+import tempfile
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from eviex.cache import ResultCache
+from eviex.indexer import MAX_LAYER_LEVEL
+from eviex.indexer import MIN_LAYER_LEVEL
+from eviex.indexer import LayerLevel
+from eviex.indexer import MemoryIndexer
+from eviex.postings import BitmapPostings
+from eviex.postings import Postings
+
+
+MAGIC = b"EVIEX\x00\x00\x01"
+ALIGNMENT = 64
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class StringDictionary:
+    """Dictionary of string values stored as UTF-8 bytes plus offsets.
+
+    Values are decoded only when looked up, so that a memory-mapped dictionary is
+    never fully loaded.
+
+    """
+
+    __slots__ = ["data", "offsets"]
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        """Initialize the dictionary from the encoded values and their offsets."""
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_values(cls, values: np.ndarray) -> "StringDictionary":
+        """Encode the provided string values."""
+        if not all(isinstance(v, str) for v in values):
+            raise TypeError("only string values can be stored in a dictionary")
+
+        encoded = [v.encode("utf-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        """Return the number of values."""
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ids: np.ndarray) -> np.ndarray:
+        """Decode the values with the provided ids."""
+        # Plain buffers and lists avoid going through `np.memmap` for every value.
+        data = memoryview(self.data)
+        starts = self.offsets[ids].tolist()
+        ends = self.offsets[np.asarray(ids) + 1].tolist()
+        values = np.empty(len(starts), dtype="object")
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            values[i] = str(data[start:end], "utf-8")
+
+        return values
+
+    def searchsorted(self, value, side: str = "left", sorter=None):
+        """Return the indexes at which the values would be inserted in the dictionary.
+
+        The values must be sorted. The binary searches of all the values run side by
+        side and only the values they visit are decoded.
+
+        """
+        values = np.empty(np.size(value), dtype="object")
+        values[:] = [value] if np.ndim(value) == 0 else list(value)
+
+        low = np.zeros(len(values), dtype=np.int64)
+        high = np.full(len(values), len(self), dtype=np.int64)
+        active = np.flatnonzero(low < high)
+        while len(active):
+            middle = (low[active] + high[active]) // 2
+            current = self[middle]
+            if side == "right":
+                right = current <= values[active]
+            else:
+                right = current < values[active]
+
+            right = right.astype(bool)
+            low[active[right]] = middle[right] + 1
+            high[active[~right]] = middle[~right]
+            active = active[low[active] < high[active]]
+
+        return int(low[0]) if np.ndim(value) == 0 else low
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        """Decode all the values."""
+        return self[np.arange(len(self))]
+
+
+def to_arrays(
+    layers: Dict[LayerLevel, Postings],
+    v_indexes: Dict[LayerLevel, np.ndarray],
+    dictionary: np.ndarray,
+) -> Dict[str, np.ndarray]:
+    """Return the named arrays that make up the provided layers and dictionary."""
+    if not isinstance(dictionary, StringDictionary):
+        dictionary = StringDictionary.from_values(dictionary)
+
+    arrays = {
+        "dictionary.data": dictionary.data,
+        "dictionary.offsets": dictionary.offsets,
+    }
+    for ll, layer in layers.items():
+        arrays[f"{ll.name}.ids"] = layer.ids
+        arrays[f"{ll.name}.offsets"] = layer.offsets
+        arrays[f"{ll.name}.virtual_indexes"] = v_indexes[ll]
+        if isinstance(layer, BitmapPostings):
+            arrays[f"{ll.name}.bitmaps"] = layer.bitmaps
+            arrays[f"{ll.name}.bitmap_offsets"] = layer.bitmap_offsets
+
+    return arrays
+
+
+def from_arrays(
+    bases: Dict[str, int],
+    arrays: Dict[str, np.ndarray],
+) -> Tuple[dict, dict, dict, StringDictionary]:
+    """Return the layers, virtual indexes, bases and dictionary from the arrays."""
+    layers, v_indexes, layer_bases = {}, {}, {}
+    for name, base in bases.items():
+        ll = LayerLevel[name]
+        if f"{name}.bitmaps" in arrays:
+            layers[ll] = BitmapPostings(
+                arrays[f"{name}.ids"],
+                arrays[f"{name}.offsets"],
+                arrays[f"{name}.bitmaps"],
+                arrays[f"{name}.bitmap_offsets"],
+            )
+        else:
+            layers[ll] = Postings(arrays[f"{name}.ids"], arrays[f"{name}.offsets"])
+
+        v_indexes[ll] = arrays[f"{name}.virtual_indexes"]
+        layer_bases[ll] = base
+
+    dictionary = StringDictionary(
+        arrays["dictionary.data"],
+        arrays["dictionary.offsets"],
+    )
+    return layers, v_indexes, layer_bases, dictionary
+
+
+def build_metadata(
+    indexer: MemoryIndexer,
+    bases: Dict[LayerLevel, int],
+    last_update: Optional[datetime],
+) -> dict:
+    """Return the metadata describing the indexer configuration and its layers."""
+    return {
+        "min_level": indexer._min_level.name,
+        "max_level": indexer._max_level.name,
+        "bitmaps": indexer._bitmaps,
+        "last_update": (
+            (last_update - _EPOCH) // timedelta(microseconds=1) if last_update else None
+        ),
+        "bases": {ll.name: base for ll, base in bases.items()},
+    }
+
+
+def check_metadata(indexer: MemoryIndexer, metadata: dict, source: str) -> None:
+    """Raise `ValueError` if the metadata doesn't match the indexer configuration."""
+    if (
+        LayerLevel[metadata["min_level"]] != indexer._min_level
+        or LayerLevel[metadata["max_level"]] != indexer._max_level
+        or metadata["bitmaps"] != indexer._bitmaps
+    ):
+        raise ValueError(
+            f"{source} has been written with a different configuration: "
+            f"{metadata['min_level']}-{metadata['max_level']} "
+            f"with bitmaps={metadata['bitmaps']}",
+        )
+
+
+def read_last_update(metadata: dict) -> Optional[datetime]:
+    """Return the last update stored in the metadata."""
+    if metadata["last_update"] is None:
+        return None
+
+    return _EPOCH + timedelta(microseconds=metadata["last_update"])
+
+
+def layout(
+    metadata: dict,
+    arrays: Dict[str, np.ndarray],
+) -> Tuple[bytes, List[dict], int, int]:
+    """Return the header, the arrays table, the data start and the total size."""
+    table, offset = [], 0
+    for name, arr in arrays.items():
+        table.append(
+            {
+                "name": name,
+                "dtype": arr.dtype.str,
+                "shape": list(arr.shape),
+                "offset": offset,
+            },
+        )
+        offset = _align(offset + arr.nbytes)
+
+    header = json.dumps(dict(metadata, arrays=table)).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    return header, table, data_start, data_start + offset
+
+
+def write(path: str, metadata: dict, arrays: Dict[str, np.ndarray]) -> None:
+    """Atomically write the metadata and the arrays to the file at the path."""
+    os.replace(stage(path, metadata, arrays), path)
+
+
+def stage(path: str, metadata: dict, arrays: Dict[str, np.ndarray]) -> str:
+    """Write the metadata and the arrays to a temporary file next to the path.
+
+    Return the path of the temporary file, that atomically replaces the file at the
+    path once moved there with `os.replace`.
+
+    """
+    header, table, data_start, _ = layout(metadata, arrays)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".eviex-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(np.array(len(header), dtype="<u8").tobytes())
+            f.write(header)
+            for entry, arr in zip(table, arrays.values()):
+                f.seek(data_start + entry["offset"])
+                f.write(np.ascontiguousarray(arr).tobytes())
+
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return tmp_path
+
+
+def write_buffer(
+    buf: np.ndarray,
+    metadata: dict,
+    arrays: Dict[str, np.ndarray],
+) -> None:
+    """Write the metadata and the arrays into the bytes buffer.
+
+    The buffer must be at least as large as the total size returned by `layout`.
+
+    """
+    header, table, data_start, _ = layout(metadata, arrays)
+    prefix = MAGIC + np.array(len(header), dtype="<u8").tobytes() + header
+    buf[: len(prefix)] = np.frombuffer(prefix, dtype=np.uint8)
+    for entry, arr in zip(table, arrays.values()):
+        data = np.ascontiguousarray(arr).reshape(-1).view(np.uint8)
+        start = data_start + entry["offset"]
+        buf[start:][: len(data)] = data
+
+
+def read(path: str) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """Memory-map the file at the path and return its metadata and arrays."""
+    return read_buffer(np.memmap(path, dtype=np.uint8, mode="r"), path)
+
+
+def read_buffer(buf: np.ndarray, source: str) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """Return the metadata and the arrays as views of the bytes buffer."""
+    magic_end = len(MAGIC)
+    if bytes(buf[:magic_end]) != MAGIC:
+        raise ValueError(f"{source} is not an eviex index file")
+
+    header_start = magic_end + 8
+    header_end = header_start + int(buf[magic_end:header_start].view("<u8")[0])
+    header = json.loads(bytes(buf[header_start:header_end]))
+    data_start = _align(header_end)
+
+    arrays = {}
+    for entry in header.pop("arrays"):
+        dtype = np.dtype(entry["dtype"])
+        start = data_start + entry["offset"]
+        end = start + dtype.itemsize * int(np.prod(entry["shape"]))
+        arrays[entry["name"]] = buf[start:end].view(dtype).reshape(entry["shape"])
+
+    return header, arrays
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class FileIndexer(MemoryIndexer):
+    """Indexer persisted in a memory-mapped file.
+
+    If the file at `uri` exists it is opened right away, otherwise it is created on
+    the first load or compaction. Layers are written in the documented format of
+    this module and are read through `np.memmap`, so that opening is near-instant,
+    the OS page cache is shared between processes opening the same file and indexes
+    larger than the memory can be queried. Other processes can pick up a rewritten
+    file with `refresh`.
+
+    """
+
+    __slots__ = ["_stat", "_staged"]
+
+    def __init__(
+        self,
+        uri: str,
+        min_level: Optional[LayerLevel] = MIN_LAYER_LEVEL,
+        max_level: Optional[LayerLevel] = MAX_LAYER_LEVEL,
+        compaction_threshold: int = 100_000,
+        bitmaps: bool = False,
+        cache: Optional[ResultCache] = None,
+    ):
+        """Initialize a file indexer with the provided layer level ranges."""
+        super().__init__(
+            min_level=min_level,
+            max_level=max_level,
+            compaction_threshold=compaction_threshold,
+            bitmaps=bitmaps,
+            cache=cache,
+        )
+        self._uri = uri
+        self._stat = None
+        self._staged = {}
+        if os.path.exists(uri):
+            self._open()
+
+    def refresh(self) -> bool:
+        """Reopen the file if it has been rewritten, returning whether it was."""
+        if not os.path.exists(self._uri) or _stat(self._uri) == self._stat:
+            return False
+
+        self._open()
+        return True
+
+    async def _store(
+        self,
+        layers: Dict[LayerLevel, Postings],
+        v_indexes: Dict[LayerLevel, np.ndarray],
+        bases: Dict[LayerLevel, int],
+        dictionary: np.ndarray,
+        last_update: Optional[datetime],
+    ) -> Tuple[dict, dict, dict, StringDictionary]:
+        """Write the layers to a temporary file and return them memory-mapped.
+
+        The temporary file replaces the file of the indexer once the layers are
+        published, so that the built ones are never kept in memory along with them
+        and a compaction overtaken by a load never overwrites the loaded layers.
+
+        """
+        loop = asyncio.get_event_loop()
+        tmp_path, mapped = await loop.run_in_executor(
+            None,
+            self._persist,
+            layers,
+            v_indexes,
+            bases,
+            dictionary,
+            self._last_update if last_update is None else last_update,
+        )
+        self._staged[id(mapped[0])] = tmp_path
+        return mapped
+
+    def _discard(self, layers: Dict[LayerLevel, Postings]) -> None:
+        os.unlink(self._staged.pop(id(layers)))
+
+    def _publish(
+        self,
+        layers: Dict[LayerLevel, Postings],
+        *args,
+        **kwargs,
+    ) -> None:
+        tmp_path = self._staged.pop(id(layers), None)
+        if tmp_path is not None:
+            os.replace(tmp_path, self._uri)
+            self._stat = _stat(self._uri)
+
+        super()._publish(layers, *args, **kwargs)
+
+    def _persist(
+        self,
+        layers: Dict[LayerLevel, Postings],
+        v_indexes: Dict[LayerLevel, np.ndarray],
+        bases: Dict[LayerLevel, int],
+        dictionary: np.ndarray,
+        last_update: Optional[datetime],
+    ) -> Tuple[str, Tuple[dict, dict, dict, StringDictionary]]:
+        """Write the layers to a temporary file and return them memory-mapped."""
+        tmp_path = stage(
+            self._uri,
+            build_metadata(self, bases, last_update),
+            to_arrays(layers, v_indexes, dictionary),
+        )
+        header, arrays = read(tmp_path)
+        return tmp_path, from_arrays(header["bases"], arrays)
+
+    def _open(self) -> None:
+        stat = _stat(self._uri)
+        header, arrays = read(self._uri)
+        check_metadata(self, header, self._uri)
+
+        self._publish(
+            *from_arrays(header["bases"], arrays),
+            last_update=read_last_update(header),
+        )
+        self._stat = stat
+
+
+def _stat(path: str) -> Tuple[int, int, int]:
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,113 @@
+from typing import List
+
+import numpy as np
+
+from eviex.postings import BitmapPostings
+from eviex.postings import Postings
+from eviex.postings import PostingsUnion
+
+
+class RangeUnions:
+    """Precomputed unions of the postings of aligned ranges of buckets of a layer.
+
+    The blocks of the k-th level are the distinct ids of the buckets in the ranges
+    `[j * 2 ** k, (j + 1) * 2 ** k)`, from the level of the blocks of `span` buckets
+    up to the one of the blocks of as many buckets as fit in the layer. As in a
+    segment tree, the union of any range of buckets is then made of at most two
+    blocks per level, plus fewer than `span` buckets on each side that are taken
+    from the layer. Larger spans take less memory at the cost of gathering more
+    buckets.
+
+    """
+
+    __slots__ = ["shift", "levels"]
+
+    def __init__(self, shift: int, levels: List[Postings]):
+        """Initialize the unions from the postings of the blocks of each level."""
+        self.shift = shift
+        self.levels = levels
+
+    @classmethod
+    def from_postings(
+        cls,
+        postings: Postings,
+        span: int,
+        dictionary_size: int,
+        bitmaps: bool = False,
+    ) -> "RangeUnions":
+        """Build the unions of the postings over a dictionary of the provided size.
+
+        The span is rounded up to a power of two of at least 2. With `bitmaps` set
+        the blocks are stored as `BitmapPostings`, so that the dense ones are or-ed
+        together instead of being sorted.
+
+        """
+        shift = max(int(span - 1).bit_length(), 1)
+        indexes, ids = postings.expand()
+        keys = (indexes >> shift).astype(np.int64) * dictionary_size + ids
+
+        levels = []
+        blocks = len(postings) >> shift
+        while blocks:
+            # The ids out of the last whole block are left out.
+            keys = np.unique(keys)
+            keys = keys[: np.searchsorted(keys, blocks * dictionary_size)]
+            block_indexes = keys // dictionary_size
+            level = Postings(
+                (keys % dictionary_size).astype(ids.dtype),
+                np.searchsorted(block_indexes, np.arange(blocks + 1)),
+            )
+            if bitmaps:
+                level = BitmapPostings.from_postings(level, dictionary_size)
+
+            levels.append(level)
+            keys = (block_indexes >> 1) * dictionary_size + keys % dictionary_size
+            blocks >>= 1
+
+        return cls(shift, levels)
+
+    @property
+    def nbytes(self) -> int:
+        """Return the memory taken by the blocks."""
+        return sum(level.nbytes for level in self.levels)
+
+    def collect(
+        self,
+        postings: Postings,
+        index_from: int,
+        index_to: int,
+        union: PostingsUnion,
+    ) -> None:
+        """Add the buckets in the range `[index_from, index_to)` to the union."""
+        span = 1 << self.shift
+        start = min(-(-index_from // span) * span, index_to)
+        end = max(index_to // span * span, start)
+        if index_from < start:
+            postings.collect(index_from, start, union)
+
+        if end < index_to:
+            postings.collect(end, index_to, union)
+
+        block_from, block_to = start >> self.shift, end >> self.shift
+        for i, level in enumerate(self.levels):
+            if block_from >= block_to:
+                return
+
+            if i == len(self.levels) - 1:
+                level.collect(block_from, block_to, union)
+                return
+
+            if block_from & 1:
+                level.collect(block_from, block_from + 1, union)
+                block_from += 1
+
+            if block_to & 1:
+                block_to -= 1
+                level.collect(block_to, block_to + 1, union)
+
+            block_from >>= 1
+            block_to >>= 1
+
+        if block_from < block_to:
+            # The layer is shorter than a block.
+            postings.collect(start, end, union)
@@ -0,0 +1,5 @@
+import sys
+
+
+# Shared memory is only available from Python 3.8.
+collect_ignore = [] if sys.version_info >= (3, 8) else ["test_shared.py"]
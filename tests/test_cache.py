@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timezone
+
+import numpy as np
+import pytest
+
+from eviex.cache import ResultCache
+from eviex.indexer import LayerLevel
+from eviex.indexer import MemoryIndexer
+from tests.test_indexer import mock_data_small_granularity
+
+
+def test_result_cache_lru():
+    """Test that the least recently used entries are evicted first."""
+    cache = ResultCache(max_entries=2)
+    last_update = datetime(2020, 1, 1).replace(tzinfo=timezone.utc)
+    for key in range(3):
+        cache.put(key, last_update, np.arange(key + 1))
+        cache.get(0, last_update)
+
+    assert len(cache) == 2
+    assert cache.get(1, last_update) is None
+    np.testing.assert_array_equal(cache.get(0, last_update), np.array([0]))
+    np.testing.assert_array_equal(cache.get(2, last_update), np.array([0, 1, 2]))
+    assert (cache.hits, cache.misses, cache.evictions) == (5, 1, 1)
+
+
+def test_result_cache_memory_cap():
+    """Test that entries are evicted to stay under the memory cap."""
+    cache = ResultCache(max_bytes=100)
+    cache.put(0, None, np.zeros(10, dtype=np.int64))
+    cache.put(1, None, np.zeros(5, dtype=np.int64))
+    assert cache.nbytes == 40
+    assert cache.get(0, None) is None
+
+    result = cache.put(2, None, np.zeros(20, dtype=np.int64))
+    assert result.flags.writeable
+    assert len(cache) == 1
+
+
+def test_result_cache_invalidation():
+    """Test that entries are dropped when the last update changes."""
+    cache = ResultCache()
+    result = cache.put(0, datetime(2020, 1, 1), np.arange(3))
+    assert not result.flags.writeable
+
+    assert cache.get(0, datetime(2020, 1, 2)) is None
+    assert len(cache) == 0
+    assert cache.invalidations == 1
+
+
+def test_result_cache_concurrent_access():
+    """Test that the cache can be looked up and invalidated from many threads."""
+    cache = ResultCache(max_entries=4)
+    updates = [datetime(2020, 1, d, tzinfo=timezone.utc) for d in range(1, 4)]
+
+    def query(thread):
+        for i in range(2_000):
+            key, last_update = (thread + i) % 8, updates[i % len(updates)]
+            if cache.get(key, last_update) is None:
+                cache.put(key, last_update, np.arange(3))
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(query, range(8)))
+
+    assert len(cache) <= 4
+
+
+@pytest.mark.asyncio
+async def test_get_with_cache():
+    """Test that queries in the same buckets hit the cache until an update."""
+    indexer = MemoryIndexer(min_level=LayerLevel.HOUR, cache=ResultCache())
+    await indexer.load(mock_data_small_granularity)
+
+    date_from = datetime(1970, 1, 1, 0, 10, 0).replace(tzinfo=timezone.utc)
+    date_to = datetime(1970, 1, 1, 3, 40, 0).replace(tzinfo=timezone.utc)
+    expected = np.array(["a", "b", "c"])
+    np.testing.assert_array_equal(indexer.get(date_from, date_to), expected)
+    np.testing.assert_array_equal(
+        indexer.get(date_from.replace(minute=30), date_to.replace(minute=0)),
+        expected,
+    )
+    assert (indexer.cache.hits, indexer.cache.misses) == (1, 1)
+
+    await indexer.add({"timestamp": date_from, "values": ["z"]})
+    np.testing.assert_array_equal(
+        indexer.get(date_from, date_to),
+        np.array(["a", "b", "c", "z"]),
+    )
+    assert (indexer.cache.hits, indexer.cache.misses) == (1, 2)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from eviex.filters import Predicate
+from eviex.filters import Prefix
+from eviex.filters import ValueSet
+from eviex.filters import lookup
+from eviex.storage import StringDictionary
+
+
+values = np.array(["a", "ab", "abc", "b", "ba", "c"], dtype="object")
+
+
+@pytest.fixture(params=["array", "string_dictionary"])
+def dictionary(request):
+    if request.param == "array":
+        return values
+
+    return StringDictionary.from_values(values)
+
+
+@pytest.mark.parametrize(
+    "value_filter, expected",
+    [
+        (ValueSet(["ab", "c", "missing"]), ["ab", "c"]),
+        (ValueSet([]), []),
+        (Prefix("a"), ["a", "ab", "abc"]),
+        (Prefix("ab"), ["ab", "abc"]),
+        (Prefix("z"), []),
+        (Prefix(""), list(values)),
+        (Predicate(lambda v: np.array([len(s) == 2 for s in v])), ["ab", "ba"]),
+    ],
+)
+def test_filters(dictionary, value_filter, expected):
+    """Test that the filters resolve the same values on dictionaries and values."""
+    np.testing.assert_array_equal(values[value_filter.keep(dictionary)], expected)
+    np.testing.assert_array_equal(values[value_filter.matches(values)], expected)
+
+
+def test_lookup(dictionary):
+    """Test the lookup of the ids of values in a sorted dictionary."""
+    assert lookup(dictionary, "a") == 0
+    assert lookup(dictionary, "ba") == 4
+    assert lookup(dictionary, "aa") is None
+    assert lookup(dictionary, "d") is None
+    assert lookup(None, "a") is None
@@ -1,13 +1,24 @@
+import asyncio
 import itertools
+import threading
+import warnings
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 from typing import List
 from typing import Tuple
 
 import numpy as np
+import pandas as pd
 import pytest
 
+from eviex.cache import ResultCache
+from eviex.filters import Predicate
+from eviex.filters import Prefix
+from eviex.filters import ValueSet
+from eviex.indexer import CoarseFallbackWarning
 from eviex.indexer import LayerLevel
+from eviex.indexer import LevelTable
 from eviex.indexer import MemoryIndexer
 
 
@@ -448,3 +459,1390 @@ async def test_get_with_none_granularity(
     await indexer.load(mock_data_none_granularity)
     actual = indexer.get(date_from, date_to)
     np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize(
+    "layer_level",
+    [LayerLevel.get(ll_value) for ll_value in LayerLevel.levels().keys()],
+)
+def test_floor_matches_transform(layer_level):
+    """Test that the vectorized truncation agrees with the per-timestamp one."""
+    timestamps = [
+        datetime(1969, 12, 31, 23, 59, 59, 999999),
+        datetime(1970, 1, 1, 0, 0, 0, 0),
+        datetime(1970, 5, 17, 13, 45, 30, 123),
+        datetime(1971, 12, 31, 23, 59, 59, 1),
+        datetime(2020, 8, 15, 6, 7, 8, 9),
+    ]
+    timestamps = [ts.replace(tzinfo=timezone.utc) for ts in timestamps]
+
+    actual = layer_level.floor(
+        np.array([MemoryIndexer._indexify(ts) for ts in timestamps], dtype=np.int64),
+    )
+    expected = np.array(
+        [MemoryIndexer._indexify(layer_level.transform(ts)) for ts in timestamps],
+        dtype=np.int64,
+    )
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.asyncio
+async def test_get_with_no_items():
+    """Test query on an indexer loaded with no items."""
+    indexer = MemoryIndexer()
+    await indexer.load([])
+    actual = indexer.get(
+        datetime(1970, 1, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+        datetime(1972, 1, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+    )
+    np.testing.assert_array_equal(actual, np.array([]))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+@pytest.mark.parametrize(
+    "min_level, max_level",
+    generate_levels_combinations(LayerLevel.SECOND, LayerLevel.HOUR),
+)
+async def test_get_matches_brute_force(min_level, max_level, bitmaps):
+    """Test query on random data against a brute force scan of the items."""
+    rng = np.random.RandomState(42)
+    first_timestamp = datetime(2019, 6, 15).replace(tzinfo=timezone.utc)
+    offsets = rng.randint(0, 3 * 365 * 24 * 3600, size=500)
+    items = [
+        {
+            "timestamp": first_timestamp + timedelta(seconds=int(offset)),
+            "values": [f"v{v}" for v in rng.randint(0, 100, size=rng.randint(1, 4))],
+        }
+        for offset in offsets
+    ]
+
+    indexer = MemoryIndexer(min_level=min_level, max_level=max_level, bitmaps=bitmaps)
+    await indexer.load(items)
+
+    for _ in range(20):
+        date_from, date_to = sorted(
+            first_timestamp + timedelta(seconds=int(offset))
+            for offset in rng.randint(0, 3 * 365 * 24 * 3600, size=2)
+        )
+        date_from = min_level.transform(date_from)
+        date_to = min_level.transform(date_to)
+
+        expected = np.unique(
+            [
+                v
+                for item in items
+                if date_from <= min_level.transform(item["timestamp"]) < date_to
+                for v in item["values"]
+            ],
+        )
+        np.testing.assert_array_equal(indexer.get(date_from, date_to), expected)
+
+
+@pytest.mark.asyncio
+async def test_load_encodes_values():
+    """Test that the values are stored once and the layers only hold their ids."""
+    items = [
+        {
+            "timestamp": datetime(1970, 1, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+            "values": ["b", "a", ""],
+        },
+        {
+            "timestamp": datetime(1970, 1, 1, 1, 0, 0).replace(tzinfo=timezone.utc),
+            "values": ["b", "c", "b"],
+        },
+    ]
+    indexer = MemoryIndexer(min_level=LayerLevel.HOUR, max_level=LayerLevel.DAY)
+    await indexer.load(items)
+
+    np.testing.assert_array_equal(indexer._dictionary, np.array(["a", "b", "c"]))
+    for layer in indexer._layers.values():
+        assert np.issubdtype(layer.ids.dtype, np.integer)
+
+    np.testing.assert_array_equal(
+        indexer.get(
+            datetime(1970, 1, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+            datetime(1970, 1, 2, 0, 0, 0).replace(tzinfo=timezone.utc),
+        ),
+        np.array(["a", "b", "c"]),
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+async def test_add_is_visible_before_and_after_compaction(bitmaps):
+    """Test that added items are merged with the loaded ones."""
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.DAY,
+        bitmaps=bitmaps,
+    )
+    await indexer.load(mock_data_small_granularity)
+    last_update = indexer.last_update
+
+    await indexer.add(
+        {
+            "timestamp": datetime(1970, 1, 1, 2, 0, 0).replace(tzinfo=timezone.utc),
+            "values": ["aa", "c"],
+        },
+    )
+    await indexer.add_many(
+        [
+            {
+                "timestamp": datetime(1970, 1, 2, 0, 0, 0).replace(tzinfo=timezone.utc),
+                "values": ["j"],
+            },
+        ],
+    )
+    assert indexer.last_update > last_update
+
+    date_from = datetime(1970, 1, 1, 1, 0, 0).replace(tzinfo=timezone.utc)
+    date_to = datetime(1970, 1, 3, 0, 0, 0).replace(tzinfo=timezone.utc)
+    expected = np.array(["aa", "c", "d", "e", "f", "g", "h", "i", "j"])
+    np.testing.assert_array_equal(indexer.get(date_from, date_to), expected)
+
+    await indexer.compact()
+    assert all(len(delta) == 0 for delta in indexer._deltas)
+    np.testing.assert_array_equal(
+        indexer._dictionary,
+        np.array(["a", "aa", "b", "c", "d", "e", "f", "g", "h", "i", "j"]),
+    )
+    np.testing.assert_array_equal(indexer.get(date_from, date_to), expected)
+
+
+@pytest.mark.asyncio
+async def test_add_compacts_in_background():
+    """Test that the compaction is triggered once the threshold is exceeded."""
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.HOUR,
+        max_level=LayerLevel.YEAR,
+        compaction_threshold=3,
+    )
+    for item in mock_data_big_granularity:
+        await indexer.add(item)
+
+    await indexer.compact()
+    assert all(len(delta) == 0 for delta in indexer._deltas)
+    np.testing.assert_array_equal(
+        indexer.get(
+            datetime(1970, 2, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+            datetime(1970, 10, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+        ),
+        np.array(["b", "c", "d", "e", "f"]),
+    )
+
+
+@pytest.mark.asyncio
+async def test_add_widens_virtual_indexes():
+    """Test that the virtual indexes data type grows with the added items."""
+    indexer = MemoryIndexer(min_level=LayerLevel.HOUR, max_level=LayerLevel.DAY)
+    await indexer.load(mock_data_small_granularity)
+    assert indexer._virtual_indexes[LayerLevel.HOUR].dtype == np.uint8
+
+    timestamp = datetime(2020, 1, 1, 0, 0, 0).replace(tzinfo=timezone.utc)
+    await indexer.add({"timestamp": timestamp, "values": ["z"]})
+    await indexer.compact()
+
+    assert indexer._virtual_indexes[LayerLevel.HOUR].dtype == np.uint32
+    np.testing.assert_array_equal(
+        indexer.get(timestamp, timestamp + timedelta(days=1)),
+        np.array(["z"]),
+    )
+
+
+@pytest.mark.asyncio
+async def test_load_stores_relative_virtual_indexes():
+    """Test that each layer stores bucket ordinals relative to its first bucket."""
+    indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    await indexer.load(mock_data_big_granularity)
+
+    np.testing.assert_array_equal(
+        indexer._virtual_indexes[LayerLevel.MONTH],
+        np.array([0, 1, 2, 3, 6, 8, 14, 22, 23]),
+    )
+    np.testing.assert_array_equal(
+        indexer._virtual_indexes[LayerLevel.QUARTER],
+        np.array([0, 1, 2, 4, 7]),
+    )
+    np.testing.assert_array_equal(
+        indexer._virtual_indexes[LayerLevel.YEAR],
+        np.array([0, 1]),
+    )
+    assert indexer._bases[LayerLevel.YEAR] == 0
+    assert indexer._virtual_indexes[LayerLevel.MINUTE].dtype == np.uint32
+    assert indexer._virtual_indexes[LayerLevel.MONTH].dtype == np.uint8
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+@pytest.mark.parametrize(
+    "min_level, max_level",
+    generate_levels_combinations(LayerLevel.NONE, LayerLevel.MINUTE),
+)
+async def test_get_many_matches_get(min_level, max_level, bitmaps):
+    """Test that a batch query returns the same items as the single queries."""
+    indexer = MemoryIndexer(min_level=min_level, max_level=max_level, bitmaps=bitmaps)
+    await indexer.load(mock_data_small_granularity)
+    await indexer.add_many(
+        [
+            {
+                "timestamp": datetime(1970, 1, 1, h, m, 0).replace(
+                    tzinfo=timezone.utc,
+                ),
+                "values": values,
+            }
+            for h, m, values in [(2, 30, ["z"]), (0, 5, ["y", "a"]), (4, 0, ["z"])]
+        ],
+    )
+
+    dates = [
+        datetime(1970, 1, 1, h, m, 0).replace(tzinfo=timezone.utc)
+        for h in range(6)
+        for m in (0, 10, 40)
+    ]
+    dates_from, dates_to = zip(*itertools.product(dates, dates))
+
+    actual = indexer.get_many(dates_from, dates_to)
+    assert len(actual) == len(dates_from)
+    for date_from, date_to, values in zip(dates_from, dates_to, actual):
+        np.testing.assert_array_equal(values, indexer.get(date_from, date_to))
+
+    np.testing.assert_array_equal(
+        indexer.get_many(dates_from[:3], dates_to[:3], combine=True),
+        np.unique(np.concatenate(actual[:3])),
+    )
+
+
+def _layers_arrays(indexer: MemoryIndexer) -> List[np.ndarray]:
+    arrays = [np.asarray(indexer._dictionary)]
+    for ll, layer in indexer._layers.items():
+        arrays.extend([layer.ids, layer.offsets, indexer._virtual_indexes[ll]])
+
+    return arrays
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("min_merge_size", [1, 1_000_000])
+async def test_load_chunks_matches_load(monkeypatch, min_merge_size):
+    """Test that loading chunk by chunk builds the same layers as a single load."""
+    monkeypatch.setattr("eviex.indexer._MIN_MERGE_SIZE", min_merge_size)
+    expected = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    await expected.load(mock_data_big_granularity)
+
+    chunks = [
+        mock_data_big_granularity[i:j] for i, j in zip(range(0, 9, 2), range(2, 11, 2))
+    ]
+    indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    await indexer.load(iter(chunks))
+    for actual, desired in zip(_layers_arrays(indexer), _layers_arrays(expected)):
+        np.testing.assert_array_equal(actual, desired)
+
+    async def achunks():
+        for chunk in chunks:
+            yield chunk
+
+    indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    await indexer.load(achunks())
+    for actual, desired in zip(_layers_arrays(indexer), _layers_arrays(expected)):
+        np.testing.assert_array_equal(actual, desired)
+
+
+@pytest.mark.asyncio
+async def test_load_reports_progress():
+    """Test that the progress callback is called after each chunk."""
+    reports = []
+    indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    await indexer.load(
+        [mock_data_big_granularity[:4], mock_data_big_granularity[4:]],
+        progress=lambda p: reports.append((p.chunks, p.postings, p.throughput)),
+    )
+
+    assert [(chunks, postings) for chunks, postings, _ in reports] == [(1, 4), (2, 9)]
+    assert all(throughput >= 0 for _, _, throughput in reports)
+
+
+def long_frame(items: List[dict]) -> pd.DataFrame:
+    """Return the items as a frame with one value per row."""
+    return pd.DataFrame(
+        [
+            {"ts": item["timestamp"], "value": value}
+            for item in items
+            for value in item["values"]
+        ],
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("source", ["frame", "categorical", "arrow"])
+async def test_load_frame_matches_load(source):
+    """Test that loading a long-format frame or table builds the same layers."""
+    expected = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    await expected.load(mock_data_big_granularity)
+
+    df = long_frame(mock_data_big_granularity)
+    indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    if source == "arrow":
+        pa = pytest.importorskip("pyarrow")
+        await indexer.load_arrow(pa.Table.from_pandas(df), timestamp="ts")
+    else:
+        if source == "categorical":
+            df["value"] = df["value"].astype("category")
+
+        await indexer.load_frame(df, timestamp="ts")
+
+    for actual, desired in zip(_layers_arrays(indexer), _layers_arrays(expected)):
+        np.testing.assert_array_equal(actual, desired)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("offload_threshold", [0, 100_000])
+async def test_aget_matches_get(offload_threshold):
+    """Test that the async queries return the same items as the sync ones."""
+    indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    await indexer.load(mock_data_big_granularity)
+    await indexer.add(
+        {
+            "timestamp": datetime(1970, 3, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+            "values": ["z"],
+        },
+    )
+
+    dates = [
+        datetime(1970, m, 1, 0, 0, 0).replace(tzinfo=timezone.utc) for m in range(1, 13)
+    ]
+    dates_from, dates_to = zip(*itertools.product(dates, dates))
+    for date_from, date_to in zip(dates_from, dates_to):
+        np.testing.assert_array_equal(
+            await indexer.aget(date_from, date_to, offload_threshold=offload_threshold),
+            indexer.get(date_from, date_to),
+        )
+
+    actual = await indexer.aget_many(
+        dates_from,
+        dates_to,
+        offload_threshold=offload_threshold,
+    )
+    for values, expected in zip(actual, indexer.get_many(dates_from, dates_to)):
+        np.testing.assert_array_equal(values, expected)
+
+
+@pytest.mark.asyncio
+async def test_aget_offloads_dense_bitmaps(monkeypatch):
+    """Test that the postings stored as bitmaps count towards offloading queries."""
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.HOUR,
+        bitmaps=True,
+    )
+    await indexer.load(
+        [
+            {
+                "timestamp": datetime(1970, 1, 1, 0, m, 0).replace(tzinfo=timezone.utc),
+                "values": [f"v{i:02}" for i in range(64)],
+            }
+            for m in range(10)
+        ],
+    )
+    date_from = datetime(1970, 1, 1, 0, 0, 0).replace(tzinfo=timezone.utc)
+    date_to = datetime(1970, 1, 1, 0, 10, 0).replace(tzinfo=timezone.utc)
+
+    threads = []
+    cached_get = MemoryIndexer._cached_get
+    get_many = MemoryIndexer._get_many
+
+    def record(function):
+        def wrapper(*args):
+            threads.append(threading.current_thread())
+            return function(*args)
+
+        return wrapper
+
+    monkeypatch.setattr(MemoryIndexer, "_cached_get", record(cached_get))
+    monkeypatch.setattr(MemoryIndexer, "_get_many", record(get_many))
+    await indexer.aget(date_from, date_to, offload_threshold=600)
+    await indexer.aget_many([date_from], [date_to], offload_threshold=600)
+
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+
+
+@pytest.mark.asyncio
+async def test_load_keeps_serving_previous_snapshot():
+    """Test that queries see the previous snapshot as a whole until a load ends."""
+    indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    await indexer.load(mock_data_small_granularity)
+    snapshot = indexer.snapshot
+    date_from = datetime(1970, 1, 1, 0, 0, 0).replace(tzinfo=timezone.utc)
+    date_to = datetime(1972, 1, 1, 0, 0, 0).replace(tzinfo=timezone.utc)
+    expected = indexer.get(date_from, date_to)
+
+    resume = asyncio.Event()
+
+    async def chunks():
+        yield mock_data_big_granularity[:4]
+        await resume.wait()
+        yield mock_data_big_granularity[4:]
+
+    load = asyncio.ensure_future(indexer.load(chunks()))
+    await asyncio.sleep(0.1)
+    assert not load.done()
+    assert indexer.snapshot is snapshot
+    np.testing.assert_array_equal(
+        await indexer.aget(date_from, date_to, offload_threshold=0),
+        expected,
+    )
+
+    resume.set()
+    await load
+    assert indexer.snapshot.last_update > snapshot.last_update
+    np.testing.assert_array_equal(
+        await indexer.aget(date_from, date_to),
+        np.array(["a", "b", "c", "d", "e", "f", "g", "h", "i"]),
+    )
+    with pytest.raises(AttributeError):
+        indexer.snapshot.layers = None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+async def test_count_and_histogram(bitmaps):
+    """Test that counts are exact when small and estimated when large."""
+    rng = np.random.RandomState(42)
+    first_timestamp = datetime(2019, 1, 1).replace(tzinfo=timezone.utc)
+    offsets = rng.randint(0, 365 * 24 * 3600, size=5_000)
+    items = [
+        {
+            "timestamp": first_timestamp + timedelta(seconds=int(offset)),
+            "values": [f"v{v}" for v in rng.randint(0, 2_000, size=3)],
+        }
+        for offset in offsets
+    ]
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.YEAR,
+        bitmaps=bitmaps,
+    )
+    await indexer.load(items)
+    await indexer.add(
+        {
+            "timestamp": datetime(2019, 3, 1, 12).replace(tzinfo=timezone.utc),
+            "values": ["added"],
+        },
+    )
+
+    date_from = datetime(2019, 2, 10, 10, 30).replace(tzinfo=timezone.utc)
+    date_to = datetime(2019, 11, 20, 5, 15).replace(tzinfo=timezone.utc)
+    expected = len(indexer.get(date_from, date_to))
+    assert indexer.count(date_from, date_to, exact_threshold=10 ** 9) == expected
+    assert abs(indexer.count(date_from, date_to, exact_threshold=0) - expected) <= (
+        0.1 * expected
+    )
+    assert indexer.count(date_to, date_from) == 0
+
+    histogram = indexer.histogram(date_from, date_to, level=LayerLevel.DAY)
+    assert histogram.index[0] == datetime(2019, 2, 10).replace(tzinfo=timezone.utc)
+    assert histogram.index[-1] == datetime(2019, 11, 20).replace(tzinfo=timezone.utc)
+    for start, count in histogram.items():
+        end = start + timedelta(days=1)
+        values = indexer.get(max(start, date_from), min(end, date_to))
+        assert count == len(values)
+
+    monthly = indexer.histogram(date_from, date_to, level=LayerLevel.MONTH)
+    assert len(monthly) == 10
+    assert monthly.iloc[1] == len(
+        indexer.get(
+            datetime(2019, 3, 1).replace(tzinfo=timezone.utc),
+            datetime(2019, 4, 1).replace(tzinfo=timezone.utc),
+        ),
+    )
+
+    with pytest.raises(ValueError):
+        indexer.histogram(date_from, date_to, level=LayerLevel.SECOND)
+
+
+@pytest.mark.asyncio
+async def test_count_and_histogram_of_added_items_only():
+    """Test that counts are estimated out of the added items before any load."""
+    indexer = MemoryIndexer(min_level=LayerLevel.SECOND)
+    first_timestamp = datetime(2019, 1, 1).replace(tzinfo=timezone.utc)
+    await indexer.add_many(
+        [
+            {
+                "timestamp": first_timestamp + timedelta(seconds=i),
+                "values": [f"v{i}"],
+            }
+            for i in range(20_000)
+        ],
+    )
+
+    date_from, date_to = first_timestamp, first_timestamp + timedelta(days=1)
+    assert abs(indexer.count(date_from, date_to) - 20_000) <= 2_000
+    histogram = indexer.histogram(
+        date_from,
+        date_to,
+        level=LayerLevel.DAY,
+        exact_threshold=0,
+    )
+    assert abs(histogram.iloc[0] - 20_000) <= 2_000
+
+
+@pytest.mark.asyncio
+async def test_count_and_histogram_exact_out_of_added_items(monkeypatch):
+    """Test that only the added items in the interval count towards the threshold."""
+    indexer = MemoryIndexer(min_level=LayerLevel.SECOND, max_level=LayerLevel.DAY)
+    first_timestamp = datetime(2019, 1, 1).replace(tzinfo=timezone.utc)
+    await indexer.add_many(
+        [
+            {
+                "timestamp": first_timestamp + timedelta(seconds=i),
+                "values": [f"v{i}"],
+            }
+            for i in range(20_000)
+        ],
+    )
+
+    exact = []
+    get = MemoryIndexer._get
+
+    def recording_get(self, *args):
+        exact.append(args[1:])
+        return get(self, *args)
+
+    monkeypatch.setattr(MemoryIndexer, "_get", recording_get)
+    date_from = first_timestamp + timedelta(minutes=10)
+    date_to = first_timestamp + timedelta(minutes=12)
+    assert indexer.count(date_from, date_to, exact_threshold=1_000) == 120
+    histogram = indexer.histogram(
+        date_from,
+        date_to,
+        level=LayerLevel.MINUTE,
+        exact_threshold=1_000,
+    )
+    assert histogram.tolist() == [60, 60]
+    assert len(exact) == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("reverse_index", [False, True])
+async def test_occurrences_and_first_last_seen(reverse_index):
+    """Test the lookup of the buckets in which the values occur."""
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.HOUR,
+        max_level=LayerLevel.YEAR,
+        reverse_index=reverse_index,
+    )
+    await indexer.load(mock_data_small_granularity + mock_data_big_granularity)
+    assert ("reverse" in indexer.snapshot.derived) == reverse_index
+    await indexer.add(
+        {
+            "timestamp": datetime(1972, 1, 1, 0, 30, 0).replace(tzinfo=timezone.utc),
+            "values": ["a", "z"],
+        },
+    )
+
+    def hours(*dates):
+        return pd.DatetimeIndex(
+            [datetime(*date).replace(tzinfo=timezone.utc) for date in dates],
+        )
+
+    pd.testing.assert_index_equal(
+        indexer.occurrences("a"),
+        hours((1970, 1, 1, 0), (1972, 1, 1, 0)),
+    )
+    pd.testing.assert_index_equal(
+        indexer.occurrences("d"),
+        hours((1970, 1, 1, 3), (1970, 4, 1, 0)),
+    )
+    pd.testing.assert_index_equal(
+        indexer.occurrences(
+            "d",
+            datetime(1970, 1, 1, 3, 30, 0).replace(tzinfo=timezone.utc),
+            datetime(1970, 4, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+        ),
+        hours((1970, 1, 1, 3)),
+    )
+    assert len(indexer.occurrences("missing")) == 0
+
+    assert indexer.first_seen("a") == datetime(1970, 1, 1).replace(tzinfo=timezone.utc)
+    assert indexer.last_seen("a") == datetime(1972, 1, 1).replace(tzinfo=timezone.utc)
+    assert indexer.first_seen("z") == datetime(1972, 1, 1).replace(tzinfo=timezone.utc)
+    assert indexer.last_seen("i") == datetime(1971, 12, 1).replace(tzinfo=timezone.utc)
+    assert indexer.first_seen("missing") is None
+    assert indexer.last_seen("missing") is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+async def test_get_with_value_filter(bitmaps):
+    """Test that filtered queries return the unfiltered results that pass."""
+    rng = np.random.RandomState(42)
+    first_timestamp = datetime(2019, 6, 15).replace(tzinfo=timezone.utc)
+    items = [
+        {
+            "timestamp": first_timestamp + timedelta(seconds=int(offset)),
+            "values": [f"v{v}" for v in rng.randint(0, 100, size=rng.randint(1, 4))],
+        }
+        for offset in rng.randint(0, 365 * 24 * 3600, size=500)
+    ]
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.YEAR,
+        bitmaps=bitmaps,
+    )
+    await indexer.load(items)
+    await indexer.add(
+        {
+            "timestamp": datetime(2019, 9, 1).replace(tzinfo=timezone.utc),
+            "values": ["v1", "v7x", "w"],
+        },
+    )
+
+    value_filters = [
+        (ValueSet(["v1", "v42", "w", "missing"]), lambda v: v in {"v1", "v42", "w"}),
+        (Prefix("v7"), lambda v: v.startswith("v7")),
+        (
+            Predicate(lambda values: np.array([len(v) == 2 for v in values])),
+            lambda v: len(v) == 2,
+        ),
+    ]
+    for _ in range(10):
+        date_from, date_to = sorted(
+            first_timestamp + timedelta(seconds=int(offset))
+            for offset in rng.randint(0, 365 * 24 * 3600, size=2)
+        )
+        unfiltered = indexer.get(date_from, date_to)
+        for value_filter, passes in value_filters:
+            expected = np.array([v for v in unfiltered if passes(v)], dtype="object")
+            np.testing.assert_array_equal(
+                indexer.get(date_from, date_to, values=value_filter),
+                expected,
+            )
+            np.testing.assert_array_equal(
+                await indexer.aget(
+                    date_from,
+                    date_to,
+                    offload_threshold=0,
+                    values=value_filter,
+                ),
+                expected,
+            )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("level", [None, LayerLevel.HOUR, LayerLevel.DAY])
+async def test_cooccurrences(level):
+    """Test the buckets in which all the values occur against a brute force scan."""
+    rng = np.random.RandomState(42)
+    first_timestamp = datetime(2019, 6, 15).replace(tzinfo=timezone.utc)
+    items = [
+        {
+            "timestamp": first_timestamp + timedelta(seconds=int(offset)),
+            "values": [f"v{v}" for v in rng.randint(0, 5, size=rng.randint(1, 3))],
+        }
+        for offset in rng.randint(0, 60 * 24 * 3600, size=2_000)
+    ]
+    indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.DAY)
+    await indexer.load(items[:-100])
+    await indexer.add_many(items[-100:])
+
+    bucket_level = LayerLevel.MINUTE if level is None else level
+    date_from = datetime(2019, 6, 20, 10, 30).replace(tzinfo=timezone.utc)
+    date_to = datetime(2019, 7, 30, 5, 15).replace(tzinfo=timezone.utc)
+    for values in [["v0"], ["v1", "v2"], ["v0", "v3", "v4"], ["v1", "missing"]]:
+        seen = {}
+        for item in items:
+            if date_from <= item["timestamp"] < date_to:
+                start = bucket_level.transform(item["timestamp"])
+                seen.setdefault(start, set()).update(item["values"])
+
+        expected = sorted(s for s, v in seen.items() if v.issuperset(values))
+        actual = indexer.cooccurrences(values, date_from, date_to, level=level)
+        assert list(actual) == expected
+
+    with pytest.raises(ValueError):
+        indexer.cooccurrences(["v0"], date_from, date_to, level=LayerLevel.SECOND)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+@pytest.mark.parametrize("order", ["asc", "desc"])
+async def test_iter_get_matches_first_occurrences(bitmaps, order):
+    """Test that iterated items are ordered by their first occurrence."""
+    rng = np.random.RandomState(42)
+    first_timestamp = datetime(2019, 6, 15).replace(tzinfo=timezone.utc)
+    items = [
+        {
+            "timestamp": first_timestamp + timedelta(seconds=int(offset)),
+            "values": [f"v{v}" for v in rng.randint(0, 300, size=rng.randint(1, 4))],
+        }
+        for offset in rng.randint(0, 365 * 24 * 3600, size=1_000)
+    ]
+    # An added item in the bucket of a loaded one.
+    items.append({"timestamp": items[100]["timestamp"], "values": ["added", "v1"]})
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.YEAR,
+        bitmaps=bitmaps,
+    )
+    await indexer.load(items[:-50])
+    await indexer.add_many(items[-50:])
+
+    date_from = datetime(2019, 7, 10, 10, 30).replace(tzinfo=timezone.utc)
+    date_to = datetime(2020, 3, 20, 5, 15).replace(tzinfo=timezone.utc)
+    buckets = {}
+    for item in items:
+        if date_from <= item["timestamp"] < date_to:
+            start = LayerLevel.MINUTE.transform(item["timestamp"])
+            buckets.setdefault(start, set()).update(item["values"])
+
+    expected, seen = [], set()
+    for start in sorted(buckets, reverse=order == "desc"):
+        new = buckets[start] - seen
+        seen |= new
+        if new:
+            expected.append(sorted(new))
+
+    chunks = list(indexer.iter_get(date_from, date_to, order=order))
+    assert [list(chunk) for chunk in chunks] == expected
+    np.testing.assert_array_equal(
+        np.sort(np.concatenate(chunks)),
+        indexer.get(date_from, date_to),
+    )
+
+    flat = [v for chunk in expected for v in chunk]
+    for limit in [0, 1, 10, len(flat) + 1]:
+        chunks = list(indexer.iter_get(date_from, date_to, order=order, limit=limit))
+        assert [v for chunk in chunks for v in chunk] == flat[:limit]
+
+    with pytest.raises(ValueError):
+        indexer.iter_get(date_from, date_to, order="random")
+
+
+def recent_items(size: int, days: int, seed: int = 42) -> List[dict]:
+    """Return random items of the last days."""
+    rng = np.random.RandomState(seed)
+    now = datetime.now(timezone.utc)
+    return [
+        {
+            "timestamp": now - timedelta(seconds=int(offset)),
+            "values": [f"v{v}" for v in rng.randint(0, 500, size=rng.randint(1, 4))],
+        }
+        for offset in rng.randint(0, days * 24 * 3600, size=size)
+    ]
+
+
+def scan(items: List[dict], date_from: datetime, date_to: datetime) -> np.ndarray:
+    """Return the distinct values of the items in the time interval."""
+    return np.unique(
+        [
+            v
+            for item in items
+            if date_from <= LayerLevel.MINUTE.transform(item["timestamp"]) < date_to
+            for v in item["values"]
+        ],
+    )
+
+
+@pytest.mark.asyncio
+async def test_retention_falls_back_to_coarser_levels():
+    """Test that parts of queries older than the retention are answered coarser."""
+    items = recent_items(3_000, 10)
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.DAY,
+        retention={
+            LayerLevel.MINUTE: timedelta(days=2),
+            LayerLevel.HOUR: timedelta(days=5),
+        },
+    )
+    await indexer.load(items[:-100])
+    await indexer.add_many(items[-100:])
+    await indexer.compact()
+
+    snapshot = indexer.snapshot
+    now = datetime.now(timezone.utc)
+    minute_horizon = snapshot.horizons[LayerLevel.MINUTE]
+    hour_horizon = snapshot.horizons[LayerLevel.HOUR]
+    assert LayerLevel.DAY not in snapshot.horizons
+    assert minute_horizon == MemoryIndexer._indexify(
+        LayerLevel.HOUR.transform(now - timedelta(days=2)),
+    )
+    assert hour_horizon == MemoryIndexer._indexify(
+        LayerLevel.DAY.transform(now - timedelta(days=5)),
+    )
+    for ll, horizon in snapshot.horizons.items():
+        indexes = np.arange(len(snapshot.layers[ll]))
+        assert indexer._bucket_starts(snapshot, ll, indexes).min() >= horizon
+    assert len(snapshot.layers[LayerLevel.DAY]) == 11
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        date_from = LayerLevel.MINUTE.transform(now - timedelta(hours=30))
+        date_to = LayerLevel.MINUTE.transform(now - timedelta(hours=3))
+        np.testing.assert_array_equal(
+            indexer.get(date_from, date_to),
+            scan(items, date_from, date_to),
+        )
+
+        date_from = LayerLevel.DAY.transform(now - timedelta(days=9))
+        date_to = LayerLevel.DAY.transform(now - timedelta(days=1))
+        np.testing.assert_array_equal(
+            indexer.get(date_from, date_to),
+            scan(items, date_from, date_to),
+        )
+
+    date_from = LayerLevel.MINUTE.transform(now - timedelta(days=3, minutes=30))
+    date_to = LayerLevel.MINUTE.transform(now - timedelta(days=3, minutes=10))
+    with pytest.warns(CoarseFallbackWarning) as record:
+        values = indexer.get(date_from, date_to)
+
+    warning = record[0].message
+    assert warning.level == LayerLevel.HOUR
+    assert warning.date_from == LayerLevel.HOUR.transform(date_from)
+    assert warning.date_from < date_from and warning.date_to > date_from
+    np.testing.assert_array_equal(
+        values,
+        scan(items, warning.date_from, warning.date_to),
+    )
+
+    date_from = LayerLevel.MINUTE.transform(now - timedelta(days=8, minutes=30))
+    date_to = LayerLevel.MINUTE.transform(now - timedelta(hours=1))
+    with pytest.warns(CoarseFallbackWarning) as record:
+        values = indexer.get(date_from, date_to)
+        count = indexer.count(date_from, date_to, exact_threshold=10 ** 9)
+
+    assert record[0].message.level == LayerLevel.DAY
+    widened_from = LayerLevel.DAY.transform(date_from)
+    np.testing.assert_array_equal(values, scan(items, widened_from, date_to))
+    assert count == len(values)
+
+    with pytest.warns(CoarseFallbackWarning) as record:
+        chunks = list(indexer.iter_get(date_from, date_to))
+    assert record[0].message.level == LayerLevel.DAY
+    np.testing.assert_array_equal(np.sort(np.concatenate(chunks)), values)
+
+    with pytest.warns(CoarseFallbackWarning) as record:
+        batch = indexer.get_many([date_from], [date_to], combine=True)
+    assert record[0].message.level == LayerLevel.DAY
+    assert record[0].filename == __file__
+    np.testing.assert_array_equal(batch, values)
+
+    with pytest.warns(CoarseFallbackWarning) as record:
+        batches = await indexer.aget_many([date_from], [date_to], offload_threshold=0)
+    assert record[0].message.level == LayerLevel.DAY
+    np.testing.assert_array_equal(batches[0], values)
+
+    with pytest.warns(CoarseFallbackWarning) as record:
+        histogram = indexer.histogram(
+            date_from,
+            date_to,
+            level=LayerLevel.DAY,
+            exact_threshold=10 ** 9,
+        )
+    assert record[0].message.level == LayerLevel.DAY
+    assert histogram.sum() >= len(values)
+
+    last_update = indexer.last_update
+    await indexer.evict()
+    assert indexer.last_update == last_update
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+async def test_memory_budget_drops_deepest_levels(bitmaps):
+    """Test that the oldest buckets of the deepest levels are dropped first."""
+    items = recent_items(3_000, 60)
+    unbounded = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.MONTH,
+        bitmaps=bitmaps,
+    )
+    await unbounded.load(items)
+    layers = unbounded.snapshot.layers
+    budget = sum(layer.nbytes for layer in layers.values()) // 2
+
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.MONTH,
+        bitmaps=bitmaps,
+        memory_budget=budget,
+    )
+    await indexer.load(items)
+    snapshot = indexer.snapshot
+    assert sum(layer.nbytes for layer in snapshot.layers.values()) <= budget
+    assert len(snapshot.layers[LayerLevel.MONTH]) == len(layers[LayerLevel.MONTH])
+    assert len(snapshot.layers[LayerLevel.MINUTE]) < len(layers[LayerLevel.MINUTE])
+    levels = sorted(snapshot.layers, key=lambda ll: ll.value)
+    horizons = [snapshot.horizons.get(ll, 0) for ll in levels]
+    assert horizons == sorted(horizons, reverse=True)
+
+    date_from = LayerLevel.MONTH.transform(items[0]["timestamp"] - timedelta(days=90))
+    date_to = LayerLevel.MONTH.transform(items[0]["timestamp"] + timedelta(days=90))
+    np.testing.assert_array_equal(
+        indexer.get(date_from, date_to),
+        unbounded.get(date_from, date_to),
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+async def test_custom_levels_match_brute_force(bitmaps):
+    """Test queries on layers of custom levels against a brute force scan."""
+    items = recent_items(2_000, 30)
+    levels = [
+        LayerLevel.MINUTE,
+        LayerLevel.FIVE_MINUTES,
+        LayerLevel.FIFTEEN_MINUTES,
+        LayerLevel.HOUR,
+        LayerLevel.DAY,
+        LayerLevel.WEEK,
+    ]
+    indexer = MemoryIndexer(levels=levels[::-1], bitmaps=bitmaps)
+    await indexer.load(items[:1_500])
+    await indexer.add_many(items[1_500:])
+    await indexer.compact()
+    assert sorted(indexer.snapshot.layers, key=lambda ll: ll.value) == levels
+
+    rng = np.random.RandomState(7)
+    now = datetime.now(timezone.utc)
+    for _ in range(20):
+        date_from, date_to = sorted(
+            LayerLevel.MINUTE.transform(now - timedelta(minutes=int(minutes)))
+            for minutes in rng.randint(0, 31 * 24 * 60, size=2)
+        )
+        expected = scan(items, date_from, date_to)
+        np.testing.assert_array_equal(indexer.get(date_from, date_to), expected)
+        assert indexer.count(date_from, date_to, exact_threshold=10 ** 9) == len(
+            expected,
+        )
+        chunks = list(indexer.iter_get(date_from, date_to)) or [np.array([])]
+        np.testing.assert_array_equal(np.sort(np.concatenate(chunks)), expected)
+        np.testing.assert_array_equal(
+            indexer.get_many([date_from], [date_to])[0],
+            expected,
+        )
+
+
+@pytest.mark.parametrize(
+    "levels",
+    [
+        [LayerLevel.DAY, LayerLevel.WEEK, LayerLevel.MONTH],
+        [LayerLevel.MINUTE, LayerLevel.WEEK, LayerLevel.YEAR],
+        [],
+    ],
+)
+def test_invalid_levels(levels):
+    """Test that levels whose buckets aren't nested are refused."""
+    with pytest.raises(ValueError):
+        MemoryIndexer(levels=levels)
+
+
+@pytest.mark.asyncio
+async def test_min_fanout_skips_sparse_levels():
+    """Test that the levels adding little over the finer layer are skipped."""
+    rng = np.random.RandomState(42)
+    first_timestamp = datetime(2020, 1, 1).replace(tzinfo=timezone.utc)
+    # A few items per day, so that hours and quarters hold few finer buckets.
+    items = [
+        {
+            "timestamp": first_timestamp + timedelta(seconds=int(offset)),
+            "values": [f"v{rng.randint(0, 100)}"],
+        }
+        for offset in rng.randint(0, 365 * 24 * 3600, size=2_000)
+    ]
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.YEAR,
+        min_fanout=4,
+    )
+    await indexer.load(items)
+    layers = indexer.snapshot.layers
+    assert sorted(layers, key=lambda ll: ll.value) == [
+        LayerLevel.MINUTE,
+        LayerLevel.DAY,
+        LayerLevel.MONTH,
+        LayerLevel.YEAR,
+    ]
+
+    levels = sorted(layers, key=lambda ll: ll.value)
+    for finer, coarser in zip(levels, levels[1:]):
+        assert len(layers[finer]) >= 4 * len(layers[coarser])
+
+    for _ in range(20):
+        date_from, date_to = sorted(
+            first_timestamp + timedelta(minutes=int(minutes))
+            for minutes in rng.randint(0, 365 * 24 * 60, size=2)
+        )
+        np.testing.assert_array_equal(
+            indexer.get(date_from, date_to),
+            scan(items, date_from, date_to),
+        )
+
+    await indexer.add_many(items[:10])
+    await indexer.compact()
+    assert indexer.snapshot.layers.keys() == layers.keys()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+async def test_query_hook_reports_stats(bitmaps):
+    """Test that the statistics of each query are passed to the hook."""
+    items = recent_items(2_000, 30)
+    reports = []
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.MONTH,
+        bitmaps=bitmaps,
+        on_query=reports.append,
+    )
+    await indexer.load(items[:1_500])
+    await indexer.add_many(items[1_500:])
+
+    now = datetime.now(timezone.utc)
+    date_from = LayerLevel.MINUTE.transform(now - timedelta(days=20, minutes=7))
+    date_to = LayerLevel.MINUTE.transform(now - timedelta(days=2, minutes=3))
+    values = indexer.get(date_from, date_to)
+    assert len(reports) == 1
+
+    stats = reports[0]
+    assert (stats.date_from, stats.date_to) == (date_from, date_to)
+    assert not stats.cached
+    assert len(stats.buckets) <= stats.searches <= len(indexer.snapshot.layers)
+    assert stats.bisections >= 2 * stats.searches
+    assert LayerLevel.DAY in stats.buckets and LayerLevel.MINUTE in stats.buckets
+    assert stats.postings + stats.bitmaps > 0
+    assert stats.added > 0
+    assert stats.results == len(values)
+    assert set(stats.timings) == {"plan", "collect", "unique", "added"}
+    assert stats.elapsed >= sum(stats.timings.values())
+
+    await indexer.aget(date_from, date_to, offload_threshold=0)
+    assert len(reports) == 2
+    assert reports[1].results == len(values)
+
+
+@pytest.mark.asyncio
+async def test_query_hook_reports_cached_queries():
+    """Test that the queries answered from the cache are reported as such."""
+    reports = []
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        cache=ResultCache(),
+        on_query=reports.append,
+    )
+    await indexer.load(mock_data_small_granularity)
+    date_from = datetime(2020, 1, 1).replace(tzinfo=timezone.utc)
+    date_to = datetime(2021, 1, 1).replace(tzinfo=timezone.utc)
+    indexer.get(date_from, date_to)
+    indexer.get(date_from, date_to)
+
+    assert [stats.cached for stats in reports] == [False, True]
+    assert reports[1].searches == 0 and not reports[1].timings
+    assert reports[0].results == reports[1].results
+
+
+@pytest.mark.asyncio
+async def test_last_load_reports_phases():
+    """Test that the time spent in each phase of the last load is kept."""
+    indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    assert indexer.last_load is None
+
+    await indexer.load(
+        [mock_data_big_granularity[:4], mock_data_big_granularity[4:]],
+    )
+    progress = indexer.last_load
+    assert progress.chunks == 2
+    assert set(progress.phases) == {"add", "merge", "dictionary", "retain"}
+    assert set(progress.levels) == set(indexer.snapshot.layers)
+    assert all(seconds >= 0 for seconds in progress.levels.values())
+    assert progress.elapsed >= sum(progress.levels.values())
+
+
+@pytest.mark.parametrize(
+    "layer_level",
+    [LayerLevel.get(ll_value) for ll_value in LayerLevel.levels().keys()],
+)
+def test_level_table_matches_ordinals(layer_level):
+    """Test that the bucket lookups agree with the bucket ordinals."""
+    rng = np.random.RandomState(42)
+    timestamps = np.sort(rng.randint(-10 ** 15, 10 ** 16, size=2_000))
+    ordinals = np.unique(layer_level.ordinals(timestamps))
+    base = int(ordinals[0])
+    dtype = np.uint32 if ordinals[-1] - base < 2 ** 32 - 1 else np.uint64
+    table = LevelTable(layer_level, (ordinals - base).astype(dtype), base)
+    starts = layer_level.starts(ordinals)
+
+    queries = np.concatenate(
+        [starts, starts - 1, starts + 1, rng.randint(-10 ** 15, 10 ** 16, size=500)],
+    )
+    expected = np.searchsorted(starts, queries)
+    np.testing.assert_array_equal(table.indexes(queries), expected)
+    assert [table.index(int(q)) for q in queries[:50]] == list(expected[:50])
+
+    indexes = np.arange(len(starts))
+    np.testing.assert_array_equal(table.starts_of(indexes), starts)
+    assert [table.start(int(i)) for i in indexes[:50]] == list(starts[:50])
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+async def test_explain(bitmaps):
+    """Test that the plan of a query covers the interval in time order."""
+    items = recent_items(3_000, 60)
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.YEAR,
+        bitmaps=bitmaps,
+        on_query=lambda stats: reports.append(stats),
+    )
+    reports = []
+    await indexer.load(items)
+
+    now = datetime.now(timezone.utc)
+    date_from = LayerLevel.MINUTE.transform(now - timedelta(days=50, minutes=17))
+    date_to = LayerLevel.MINUTE.transform(now - timedelta(days=3, minutes=41))
+    steps = indexer.explain(date_from, date_to)
+    assert {step.level for step in steps} >= {LayerLevel.MINUTE, LayerLevel.DAY}
+    assert steps[0].date_from >= date_from and steps[-1].date_to <= date_to
+    for step, next_step in zip(steps, steps[1:]):
+        assert step.date_from < step.date_to <= next_step.date_from
+
+    values = indexer.get(date_from, date_to)
+    stats = reports[-1]
+    assert sum(step.buckets for step in steps) == sum(stats.buckets.values())
+    assert sum(step.postings for step in steps) >= stats.postings
+    assert sum(step.postings for step in steps) >= len(values)
+    np.testing.assert_array_equal(values, scan(items, date_from, date_to))
+
+    assert indexer.explain(date_to, date_from) == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+async def test_range_unions_match_brute_force(bitmaps):
+    """Test that queries gathering the range unions return the same items."""
+    items = recent_items(5_000, 120)
+    reports = []
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.MONTH,
+        bitmaps=bitmaps,
+        range_unions={LayerLevel.HOUR: 4, LayerLevel.DAY: 1},
+        on_query=reports.append,
+    )
+    plain = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.MONTH,
+        bitmaps=bitmaps,
+        on_query=reports.append,
+    )
+    await indexer.load(items[:4_000])
+    await indexer.add_many(items[4_000:])
+    await plain.load(items[:4_000])
+    assert set(indexer.snapshot.derived["unions"]) == {LayerLevel.HOUR, LayerLevel.DAY}
+
+    rng = np.random.RandomState(7)
+    now = datetime.now(timezone.utc)
+    for _ in range(20):
+        date_from, date_to = sorted(
+            LayerLevel.MINUTE.transform(now - timedelta(minutes=int(minutes)))
+            for minutes in rng.randint(0, 121 * 24 * 60, size=2)
+        )
+        np.testing.assert_array_equal(
+            indexer.get(date_from, date_to),
+            scan(items, date_from, date_to),
+        )
+
+    date_from = LayerLevel.DAY.transform(now - timedelta(days=100))
+    date_to = LayerLevel.DAY.transform(now - timedelta(days=5))
+    reports.clear()
+    indexer.get(date_from, date_to)
+    plain.get(date_from, date_to)
+    assert reports[0].postings < reports[1].postings
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+async def test_lazy_layers_match_brute_force(bitmaps):
+    """Test that lazy layers are built by the queries using them."""
+    items = recent_items(5_000, 120)
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.MONTH,
+        bitmaps=bitmaps,
+        lazy=True,
+    )
+    await indexer.load(items[:4_000])
+    assert set(indexer.snapshot.layers) == {LayerLevel.MINUTE}
+
+    now = datetime.now(timezone.utc)
+    date_from = LayerLevel.HOUR.transform(now - timedelta(hours=5))
+    date_from += timedelta(minutes=10)
+    date_to = date_from + timedelta(minutes=30)
+    np.testing.assert_array_equal(
+        indexer.get(date_from, date_to),
+        scan(items[:4_000], date_from, date_to),
+    )
+    assert set(indexer.snapshot.layers) == {LayerLevel.MINUTE}
+    assert set(indexer.layer_usage.values()) == {0}
+
+    date_from = LayerLevel.DAY.transform(now - timedelta(days=100))
+    date_to = LayerLevel.DAY.transform(now - timedelta(days=5))
+    np.testing.assert_array_equal(
+        indexer.get(date_from, date_to),
+        scan(items[:4_000], date_from, date_to),
+    )
+    assert set(indexer.snapshot.layers) == set(indexer._levels)
+    assert indexer.layer_usage == {
+        LayerLevel.HOUR: 1,
+        LayerLevel.DAY: 1,
+        LayerLevel.MONTH: 1,
+    }
+
+    await indexer.add_many(items[4_000:])
+    await indexer.compact()
+    assert set(indexer.snapshot.layers) == set(indexer._levels)
+
+    rng = np.random.RandomState(7)
+    dates_from, dates_to = [], []
+    for _ in range(20):
+        date_from, date_to = sorted(
+            LayerLevel.MINUTE.transform(now - timedelta(minutes=int(minutes)))
+            for minutes in rng.randint(0, 121 * 24 * 60, size=2)
+        )
+        dates_from.append(date_from)
+        dates_to.append(date_to)
+        np.testing.assert_array_equal(
+            indexer.get(date_from, date_to),
+            scan(items, date_from, date_to),
+        )
+
+    for values, date_from, date_to in zip(
+        indexer.get_many(dates_from, dates_to),
+        dates_from,
+        dates_to,
+    ):
+        np.testing.assert_array_equal(values, scan(items, date_from, date_to))
+
+
+@pytest.mark.asyncio
+async def test_lazy_layers_histogram():
+    """Test that histograms build the lazy layers of the levels they count."""
+    items = recent_items(2_000, 10)
+    lazy = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.DAY,
+        lazy=True,
+    )
+    eager = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.DAY)
+    await lazy.load(items)
+    await eager.load(items)
+
+    now = datetime.now(timezone.utc)
+    date_from = LayerLevel.DAY.transform(now - timedelta(days=8))
+    date_to = LayerLevel.DAY.transform(now - timedelta(days=2))
+    histogram = lazy.histogram(date_from, date_to, level=LayerLevel.HOUR)
+    assert set(lazy.snapshot.layers) == set(lazy._levels)
+    pd.testing.assert_series_equal(
+        histogram,
+        eager.histogram(date_from, date_to, level=LayerLevel.HOUR),
+    )
+
+
+@pytest.mark.asyncio
+async def test_lazy_layers_pinning_and_eviction():
+    """Test that pinned lazy layers are kept while the least used are evicted."""
+    items = recent_items(2_000, 120)
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.MONTH,
+        lazy=True,
+        pinned=[LayerLevel.DAY],
+        max_lazy_layers=1,
+    )
+    await indexer.load(items)
+    assert set(indexer.snapshot.layers) == {LayerLevel.MINUTE, LayerLevel.DAY}
+
+    # The layers needed by the query are kept even over the limit.
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.MONTH,
+        lazy=True,
+        max_lazy_layers=1,
+    )
+    await indexer.load(items)
+    now = datetime.now(timezone.utc)
+    days_to = LayerLevel.DAY.transform(now - timedelta(days=3))
+    indexer.get(days_to - timedelta(days=2), days_to)
+    assert set(indexer.snapshot.layers) == {
+        LayerLevel.MINUTE,
+        LayerLevel.HOUR,
+        LayerLevel.DAY,
+    }
+
+    hours_from = LayerLevel.HOUR.transform(now - timedelta(hours=5))
+    for _ in range(2):
+        indexer.get(hours_from, hours_from + timedelta(hours=3))
+
+    assert indexer.layer_usage == {
+        LayerLevel.HOUR: 3,
+        LayerLevel.DAY: 1,
+        LayerLevel.MONTH: 0,
+    }
+
+    # Pinned layers don't count towards the limit, and the least used layer makes
+    # room for them.
+    await indexer.pin([LayerLevel.MONTH])
+    assert set(indexer.snapshot.layers) == {
+        LayerLevel.MINUTE,
+        LayerLevel.HOUR,
+        LayerLevel.MONTH,
+    }
+
+    date_from = LayerLevel.DAY.transform(now - timedelta(days=100))
+    date_to = LayerLevel.DAY.transform(now - timedelta(days=5))
+    np.testing.assert_array_equal(
+        await indexer.aget(date_from, date_to),
+        scan(items, date_from, date_to),
+    )
+    assert set(indexer.snapshot.layers) == set(indexer._levels)
+
+    with pytest.raises(ValueError):
+        await indexer.pin([LayerLevel.MINUTE])
+
+    with pytest.raises(ValueError):
+        MemoryIndexer(lazy=True, retention={LayerLevel.SECOND: timedelta(days=1)})
+
+
+@pytest.mark.asyncio
+async def test_lazy_layers_alternating_queries():
+    """Test that alternating queries don't evict the layers they use."""
+    items = recent_items(2_000, 120)
+    indexer = MemoryIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=LayerLevel.MONTH,
+        lazy=True,
+        max_lazy_layers=2,
+    )
+    await indexer.load(items)
+
+    now = datetime.now(timezone.utc)
+    hours_from = LayerLevel.HOUR.transform(now - timedelta(hours=5))
+    intervals = [
+        (hours_from, hours_from + timedelta(hours=3)),
+        (
+            LayerLevel.DAY.transform(now - timedelta(days=100)),
+            LayerLevel.DAY.transform(now - timedelta(days=5)),
+        ),
+    ]
+    layers = None
+    for _ in range(3):
+        for date_from, date_to in intervals:
+            np.testing.assert_array_equal(
+                indexer.get(date_from, date_to),
+                scan(items, date_from, date_to),
+            )
+
+        # No layer is built again after the first round.
+        assert layers is None or indexer.snapshot.layers is layers
+        layers = indexer.snapshot.layers
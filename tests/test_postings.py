@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from eviex.postings import BitmapPostings
+from eviex.postings import Postings
+from eviex.postings import PostingsUnion
+
+
+@pytest.fixture
+def postings():
+    return Postings(
+        np.array([0, 1, 1, 2, 3, 0, 4, 5, 6, 7, 8, 9, 10, 11], dtype=np.int32),
+        np.array([0, 2, 3, 3, 6, 14]),
+    )
+
+
+def test_postings_slice(postings):
+    """Test that a range of buckets is returned as a view on the ids buffer."""
+    assert len(postings) == 5
+    np.testing.assert_array_equal(postings.slice(1, 4), np.array([1, 2, 3, 0]))
+    np.testing.assert_array_equal(postings.slice(2, 3), np.array([]))
+    assert postings.slice(0, 5).base is postings.ids
+
+
+def test_bitmap_postings_containers(postings):
+    """Test that only the buckets whose ids take more space become bitmaps."""
+    bitmap_postings = BitmapPostings.from_postings(postings, 100)
+
+    np.testing.assert_array_equal(bitmap_postings.bitmap_offsets, [0, 0, 0, 0, 0, 1])
+    np.testing.assert_array_equal(bitmap_postings.offsets, [0, 2, 3, 3, 6, 6])
+    np.testing.assert_array_equal(
+        np.unpackbits(bitmap_postings.bitmaps[0])[:12],
+        [0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1],
+    )
+
+
+@pytest.mark.parametrize("index_from, index_to", [(0, 5), (1, 4), (3, 5), (2, 2)])
+def test_bitmap_postings_collect(postings, index_from, index_to):
+    """Test that bitmap postings contain the same ids as the flat ones."""
+    bitmap_postings = BitmapPostings.from_postings(postings, 100)
+
+    expected, actual = PostingsUnion(), PostingsUnion()
+    postings.collect(index_from, index_to, expected)
+    bitmap_postings.collect(index_from, index_to, actual)
+    np.testing.assert_array_equal(actual.ids(), expected.ids())
+
+
+def test_bitmap_postings_gather_and_expand(postings):
+    """Test that bitmap postings are expanded to the same postings as flat ones."""
+    bitmap_postings = BitmapPostings.from_postings(postings, 100)
+    queries = np.array([7, 8, 9])
+    index_from = np.array([0, 1, 4])
+    index_to = np.array([5, 4, 5])
+
+    for actual, expected in [
+        (
+            bitmap_postings.gather(queries, index_from, index_to),
+            postings.gather(queries, index_from, index_to),
+        ),
+        (bitmap_postings.expand(), postings.expand()),
+    ]:
+        actual_order = np.lexsort(actual[::-1])
+        expected_order = np.lexsort(expected[::-1])
+        for a, e in zip(actual, expected):
+            np.testing.assert_array_equal(a[actual_order], e[expected_order])
+
+
+@pytest.mark.parametrize("bitmaps", [False, True])
+def test_postings_union_keep(postings, bitmaps):
+    """Test that the ids are filtered by the mask before being deduplicated."""
+    if bitmaps:
+        postings = BitmapPostings.from_postings(postings, 12)
+
+    keep = np.zeros(12, dtype=bool)
+    keep[[1, 3, 9, 11]] = True
+
+    union = PostingsUnion()
+    postings.collect(0, 5, union)
+    np.testing.assert_array_equal(union.ids(keep), [1, 3, 9, 11])
+    np.testing.assert_array_equal(union.ids(np.zeros(12, dtype=bool)), [])
+
+
+@pytest.mark.parametrize("bitmaps", [False, True])
+@pytest.mark.parametrize("count", [0, 2, 4, 5])
+def test_postings_drop(postings, bitmaps, count):
+    """Test that dropping the first buckets keeps the ids of the other ones."""
+    if bitmaps:
+        postings = BitmapPostings.from_postings(postings, 12)
+
+    dropped = postings.drop(count)
+    assert len(dropped) == len(postings) - count
+    assert dropped.nbytes <= postings.nbytes
+    for index in range(len(dropped)):
+        expected, actual = PostingsUnion(), PostingsUnion()
+        postings.collect(index + count, index + count + 1, expected)
+        dropped.collect(index, index + 1, actual)
+        np.testing.assert_array_equal(actual.ids(), expected.ids())
@@ -0,0 +1,178 @@
+import json
+import threading
+from datetime import datetime
+from datetime import timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from eviex.indexer import LayerLevel
+from eviex.indexer import MemoryIndexer
+from eviex.readers import arrow_encoded_columns
+from eviex.readers import encode
+from eviex.readers import frame_columns
+from eviex.readers import items_columns
+from eviex.readers import read_chunks
+from eviex.readers import read_file
+from tests.test_indexer import mock_data_big_granularity
+
+
+def test_items_columns_drops_empty_values():
+    """Test that items are flattened into one row per non-empty value."""
+    timestamps, values = items_columns(
+        [
+            {"timestamp": datetime(1970, 1, 1, 0, 0, 1), "values": ["a", "", "b"]},
+            {"timestamp": datetime(1970, 1, 1, 0, 0, 2), "values": []},
+            {"timestamp": datetime(1970, 1, 1, 0, 0, 3), "values": [None, "c"]},
+        ],
+    )
+
+    np.testing.assert_array_equal(timestamps, np.array([1, 1, 3]) * 1_000_000)
+    np.testing.assert_array_equal(values, np.array(["a", "b", "c"], dtype="object"))
+
+
+def test_frame_columns_long_format():
+    """Test that a frame with one value per row is read as is."""
+    df = pd.DataFrame(
+        {
+            "timestamp": ["1970-01-01T00:00:01Z", "1970-01-01T00:00:02Z"],
+            "value": ["a", None],
+        },
+    )
+    timestamps, values = frame_columns(df)
+
+    np.testing.assert_array_equal(timestamps, np.array([1_000_000]))
+    np.testing.assert_array_equal(values, np.array(["a"], dtype="object"))
+
+
+def test_encode_drops_empty_values():
+    """Test that rows of empty distinct values are dropped from the codes."""
+    timestamps, codes, uniques = encode(
+        np.arange(5),
+        np.array(["b", "", "a", None, "b"], dtype="object"),
+    )
+
+    np.testing.assert_array_equal(timestamps, np.array([0, 2, 4]))
+    np.testing.assert_array_equal(uniques[codes], np.array(["b", "a", "b"]))
+
+
+def test_arrow_encoded_columns():
+    """Test that chunked Arrow columns are encoded with a single dictionary."""
+    pa = pytest.importorskip("pyarrow")
+    table = pa.Table.from_batches(
+        [
+            pa.RecordBatch.from_pydict(
+                {
+                    "timestamp": pa.array([1, 2], type=pa.timestamp("ms", tz="UTC")),
+                    "value": pa.array(["a", None]),
+                },
+            ),
+            pa.RecordBatch.from_pydict(
+                {
+                    "timestamp": pa.array([3, 4], type=pa.timestamp("ms", tz="UTC")),
+                    "value": pa.array(["b", "a"]),
+                },
+            ),
+        ],
+    )
+    timestamps, codes, uniques = arrow_encoded_columns(table)
+
+    np.testing.assert_array_equal(timestamps, np.array([1, 3, 4]) * 1000)
+    np.testing.assert_array_equal(uniques[codes], np.array(["a", "b", "a"]))
+
+
+def _write_ndjson(path):
+    with open(path, "w") as f:
+        for item in mock_data_big_granularity:
+            timestamp = item["timestamp"].isoformat()
+            f.write(json.dumps({"timestamp": timestamp, "values": item["values"]}))
+            f.write("\n")
+
+
+def _write_csv(path):
+    pd.DataFrame(
+        [
+            {"timestamp": item["timestamp"].isoformat(), "value": value}
+            for item in mock_data_big_granularity
+            for value in item["values"]
+        ],
+    ).to_csv(path, index=False)
+
+
+def _write_parquet(path):
+    pytest.importorskip("pyarrow")
+    pd.DataFrame(
+        [
+            {"timestamp": item["timestamp"], "value": value}
+            for item in mock_data_big_granularity
+            for value in item["values"]
+        ],
+    ).to_parquet(path)
+
+
+@pytest.mark.parametrize(
+    "filename, writer",
+    [
+        ("items.ndjson", _write_ndjson),
+        ("items.csv", _write_csv),
+        ("items.parquet", _write_parquet),
+    ],
+)
+def test_read_file_in_chunks(tmp_path, filename, writer):
+    """Test that files are read in chunks of the provided size."""
+    path = str(tmp_path / filename)
+    writer(path)
+
+    chunks = list(read_file(path, chunksize=4))
+    assert [len(values) for _, values in chunks] == [4, 4, 1]
+
+    expected_timestamps, expected_values = items_columns(mock_data_big_granularity)
+    np.testing.assert_array_equal(
+        np.concatenate([timestamps for timestamps, _ in chunks]),
+        expected_timestamps,
+    )
+    np.testing.assert_array_equal(
+        np.concatenate([values for _, values in chunks]),
+        expected_values,
+    )
+
+
+def test_read_file_unsupported_format(tmp_path):
+    """Test that unknown file extensions are rejected."""
+    with pytest.raises(ValueError):
+        list(read_file(str(tmp_path / "items.txt")))
+
+
+@pytest.mark.asyncio
+async def test_load_from_file(tmp_path):
+    """Test that the indexer can be loaded from a file path."""
+    path = tmp_path / "items.ndjson"
+    _write_ndjson(str(path))
+
+    expected = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    await expected.load(mock_data_big_granularity)
+    indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=LayerLevel.YEAR)
+    await indexer.load(path, chunksize=2)
+
+    date_from = datetime(1970, 2, 1, 0, 0, 0).replace(tzinfo=timezone.utc)
+    date_to = datetime(1971, 10, 1, 0, 0, 0).replace(tzinfo=timezone.utc)
+    np.testing.assert_array_equal(
+        indexer.get(date_from, date_to),
+        expected.get(date_from, date_to),
+    )
+
+
+@pytest.mark.asyncio
+async def test_read_chunks_off_the_loop():
+    """Test that chunks are read and encoded out of the thread of the loop."""
+    threads = []
+
+    def chunks():
+        for item in mock_data_big_granularity:
+            threads.append(threading.get_ident())
+            yield [item]
+
+    encoded = [chunk async for chunk in read_chunks(chunks(), chunksize=1)]
+    assert len(encoded) == len(threads) > 1
+    assert threading.get_ident() not in threads
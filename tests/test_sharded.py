@@ -0,0 +1,84 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+import numpy as np
+import pytest
+
+from eviex.indexer import LayerLevel
+from eviex.indexer import MemoryIndexer
+from eviex.sharded import ShardedIndexer
+
+
+first_timestamp = datetime(2019, 6, 15).replace(tzinfo=timezone.utc)
+
+
+def generate_items(rng, size):
+    """Generate random items over three years."""
+    offsets = rng.randint(0, 3 * 365 * 24 * 3600, size=size)
+    return [
+        {
+            "timestamp": first_timestamp + timedelta(seconds=int(offset)),
+            "values": [f"v{v}" for v in rng.randint(0, 100, size=rng.randint(1, 4))],
+        }
+        for offset in offsets
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "shard_level, max_level",
+    [
+        (LayerLevel.YEAR, LayerLevel.YEAR),
+        (LayerLevel.MONTH, LayerLevel.YEAR),
+        (LayerLevel.MONTH, LayerLevel.DAY),
+    ],
+)
+async def test_sharded_matches_memory(shard_level, max_level):
+    """Test that a sharded indexer answers as a single in-memory one."""
+    rng = np.random.RandomState(42)
+    items = generate_items(rng, 500)
+    added = generate_items(rng, 50)
+
+    expected = MemoryIndexer(min_level=LayerLevel.MINUTE, max_level=max_level)
+    await expected.load(items)
+    await expected.add_many(added)
+    indexer = ShardedIndexer(
+        min_level=LayerLevel.MINUTE,
+        max_level=max_level,
+        shard_level=shard_level,
+        max_workers=2,
+    )
+    await indexer.load(items)
+    await indexer.add_many(added)
+
+    starts = list(indexer.shards)
+    assert starts == sorted(starts)
+    assert all(shard_level.transform(start) == start for start in starts)
+
+    intervals = [
+        (first_timestamp, first_timestamp + timedelta(days=3 * 365)),
+        (datetime(2020, 1, 1), datetime(2021, 1, 1)),
+        (datetime(2020, 3, 1), datetime(2020, 3, 1)),
+    ] + [
+        sorted(
+            first_timestamp + timedelta(seconds=int(offset))
+            for offset in rng.randint(0, 3 * 365 * 24 * 3600, size=2)
+        )
+        for _ in range(20)
+    ]
+    for date_from, date_to in intervals:
+        date_from = date_from.replace(tzinfo=timezone.utc)
+        date_to = date_to.replace(tzinfo=timezone.utc)
+        np.testing.assert_array_equal(
+            indexer.get(date_from, date_to),
+            expected.get(date_from, date_to),
+        )
+
+    indexer.close()
+
+
+def test_sharded_rejects_shard_level_below_min_level():
+    """Test that shards can't be finer than the minimum layer level."""
+    with pytest.raises(ValueError):
+        ShardedIndexer(min_level=LayerLevel.DAY, shard_level=LayerLevel.HOUR)
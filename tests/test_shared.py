@@ -0,0 +1,116 @@
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+from eviex.indexer import LayerLevel
+from eviex.indexer import MemoryIndexer
+from eviex.shared import SharedIndexer
+from eviex.shared import SharedReplica
+from tests.test_indexer import mock_data_big_granularity
+from tests.test_indexer import mock_data_small_granularity
+from tests.test_storage import intervals
+
+
+@pytest.fixture
+def name():
+    """Return a unique name for the shared memory."""
+    return f"eviex-test-{uuid.uuid4().hex[:8]}"
+
+
+def _replica_get(name, date_from, date_to):
+    replica = SharedReplica(name, min_level=LayerLevel.MINUTE)
+    try:
+        return replica.version, replica.get(date_from, date_to)
+    finally:
+        replica.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+async def test_replica_follows_versions(name, bitmaps):
+    """Test that replicas answer as the publishing indexer and follow its versions."""
+    indexer = SharedIndexer(name, min_level=LayerLevel.MINUTE, bitmaps=bitmaps)
+    try:
+        replica = SharedReplica(name, min_level=LayerLevel.MINUTE, bitmaps=bitmaps)
+        assert replica.version == 0
+        assert len(replica.get(*intervals[0])) == 0
+
+        for version, items in enumerate(
+            [mock_data_small_granularity, mock_data_big_granularity],
+            start=1,
+        ):
+            expected = MemoryIndexer(min_level=LayerLevel.MINUTE, bitmaps=bitmaps)
+            await expected.load(items)
+            await indexer.load(items)
+
+            assert indexer.version == version
+            for date_from, date_to in intervals:
+                np.testing.assert_array_equal(
+                    replica.get(date_from, date_to),
+                    expected.get(date_from, date_to),
+                )
+
+            assert replica.version == version
+            assert not replica._layers[LayerLevel.MINUTE].ids.flags.writeable
+
+        with pytest.raises(NotImplementedError):
+            await replica.load(mock_data_small_granularity)
+
+        replica.close()
+    finally:
+        indexer.close()
+
+
+@pytest.mark.asyncio
+async def test_replica_refreshes_on_every_query(name):
+    """Test that every kind of query switches the replica to the newer version."""
+    indexer = SharedIndexer(name, min_level=LayerLevel.MINUTE)
+    replica = SharedReplica(name, min_level=LayerLevel.MINUTE)
+    date_from, date_to = intervals[0]
+    queries = [
+        lambda: replica.aget(date_from, date_to),
+        lambda: replica.aget_many([date_from], [date_to]),
+        lambda: replica.count(date_from, date_to),
+        lambda: replica.histogram(date_from, date_to),
+        lambda: list(replica.iter_get(date_from, date_to)),
+        lambda: replica.explain(date_from, date_to),
+        lambda: replica.occurrences("a"),
+        lambda: replica.first_seen("a"),
+        lambda: replica.cooccurrences("a", date_from, date_to),
+    ]
+    try:
+        for query in queries:
+            await indexer.load(mock_data_small_granularity)
+            result = query()
+            if hasattr(result, "__await__"):
+                await result
+
+            assert replica.version == indexer.version
+
+        replica.close()
+    finally:
+        indexer.close()
+
+
+@pytest.mark.asyncio
+async def test_replica_in_another_process(name):
+    """Test that a replica in another process attaches to the current version."""
+    indexer = SharedIndexer(name, min_level=LayerLevel.MINUTE)
+    try:
+        await indexer.load(mock_data_big_granularity)
+        await indexer.add_many(mock_data_small_granularity)
+        await indexer.compact()
+
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            version, values = executor.submit(
+                _replica_get,
+                name,
+                *intervals[0],
+            ).result()
+
+        assert version == indexer.version == 2
+        np.testing.assert_array_equal(values, indexer.get(*intervals[0]))
+    finally:
+        indexer.close()
@@ -0,0 +1,40 @@
+import numpy as np
+
+from eviex.postings import Postings
+from eviex.sketches import Sketches
+from eviex.sketches import SketchUnion
+from eviex.sketches import hash_values
+
+
+def test_sketch_union_estimate():
+    """Test that the estimate is close to the number of distinct values."""
+    for size in (0, 10, 1_000, 100_000):
+        union = SketchUnion()
+        values = np.array([f"v{i}" for i in range(size)], dtype="object")
+        union.add_hashes(hash_values(values))
+        union.add_hashes(hash_values(values[: size // 2]))
+
+        assert abs(union.estimate() - size) <= 0.05 * size
+
+
+def test_sketches_dense_and_sparse_buckets():
+    """Test that dense and sparse buckets are merged into the same sketch."""
+    hashes = hash_values(np.array([f"v{i}" for i in range(1_000)], dtype="object"))
+    postings = Postings(
+        np.concatenate([np.arange(500), np.arange(400, 410), np.arange(500, 1_000)]),
+        np.array([0, 500, 510, 1_010]),
+    )
+    sketches = Sketches.from_postings(postings, hashes)
+
+    assert len(sketches.registers) == 2
+    np.testing.assert_array_equal(sketches.sparse, np.array([1]))
+    assert sketches.count(0, 3) == 1_010
+    assert sketches.count(1, 2) == 10
+
+    union = SketchUnion()
+    sketches.collect(postings, hashes, 0, 3, union)
+    assert abs(union.estimate() - 1_000) <= 50
+
+    union = SketchUnion()
+    sketches.collect(postings, hashes, 1, 2, union)
+    assert union.estimate() == 10
@@ -0,0 +1,241 @@
+import asyncio
+import os
+import threading
+from datetime import datetime
+from datetime import timezone
+
+import numpy as np
+import pytest
+
+from eviex.indexer import LayerLevel
+from eviex.indexer import MemoryIndexer
+from eviex.storage import FileIndexer
+from eviex.storage import StringDictionary
+from tests.test_indexer import long_frame
+from tests.test_indexer import mock_data_big_granularity
+from tests.test_indexer import mock_data_small_granularity
+
+
+intervals = [
+    (
+        datetime(1970, 1, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+        datetime(1972, 1, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+    ),
+    (
+        datetime(1970, 1, 1, 0, 10, 0).replace(tzinfo=timezone.utc),
+        datetime(1970, 1, 1, 3, 40, 0).replace(tzinfo=timezone.utc),
+    ),
+    (
+        datetime(1970, 2, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+        datetime(1970, 10, 1, 0, 0, 0).replace(tzinfo=timezone.utc),
+    ),
+]
+
+
+def test_string_dictionary():
+    """Test that values are decoded back from their UTF-8 encoding."""
+    values = np.array(["", "a", "bb", "città", "😀"], dtype="object")
+    dictionary = StringDictionary.from_values(values)
+
+    assert len(dictionary) == 5
+    np.testing.assert_array_equal(dictionary[np.array([4, 0, 3])], values[[4, 0, 3]])
+    np.testing.assert_array_equal(np.asarray(dictionary), values)
+
+    for value in ["", "b", "bb", "z"]:
+        for side in ["left", "right"]:
+            assert np.searchsorted(dictionary, value, side=side) == np.searchsorted(
+                values,
+                value,
+                side=side,
+            )
+
+    queries = np.array(["z", "", "bb", "b", "😀"], dtype="object")
+    for side in ["left", "right"]:
+        np.testing.assert_array_equal(
+            np.searchsorted(dictionary, queries, side=side),
+            np.searchsorted(values, queries, side=side),
+        )
+
+    with pytest.raises(TypeError):
+        StringDictionary.from_values(np.array([1, 2], dtype="object"))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bitmaps", [False, True])
+@pytest.mark.parametrize(
+    "items",
+    [mock_data_small_granularity, mock_data_big_granularity, []],
+)
+async def test_file_indexer_reopen(tmp_path, items, bitmaps):
+    """Test that a reopened file indexer answers as the in-memory one."""
+    uri = str(tmp_path / "index.eviex")
+    memory_indexer = MemoryIndexer(min_level=LayerLevel.MINUTE, bitmaps=bitmaps)
+    await memory_indexer.load(items)
+    indexer = FileIndexer(uri, min_level=LayerLevel.MINUTE, bitmaps=bitmaps)
+    await indexer.load(items)
+
+    reopened = FileIndexer(uri, min_level=LayerLevel.MINUTE, bitmaps=bitmaps)
+    assert reopened.last_update == indexer.last_update
+    assert isinstance(reopened._layers[LayerLevel.MINUTE].offsets, np.memmap)
+    for date_from, date_to in intervals:
+        expected = memory_indexer.get(date_from, date_to)
+        np.testing.assert_array_equal(indexer.get(date_from, date_to), expected)
+        np.testing.assert_array_equal(reopened.get(date_from, date_to), expected)
+
+
+@pytest.mark.asyncio
+async def test_file_indexer_publishes_mapped_layers_once(tmp_path, monkeypatch):
+    """Test that a load publishes the memory-mapped layers only."""
+    published = []
+
+    def publish(self, layers, *args, **kwargs):
+        published.append(layers[LayerLevel.MINUTE].offsets)
+        MemoryIndexer._publish(self, layers, *args, **kwargs)
+
+    monkeypatch.setattr(FileIndexer, "_publish", publish)
+    indexer = FileIndexer(str(tmp_path / "index.eviex"), min_level=LayerLevel.MINUTE)
+    await indexer.load(mock_data_small_granularity)
+    assert len(published) == 1
+    assert isinstance(published[0], np.memmap)
+
+
+@pytest.mark.asyncio
+async def test_file_indexer_compaction_and_refresh(tmp_path):
+    """Test that compactions rewrite the file and that readers can pick it up."""
+    uri = str(tmp_path / "index.eviex")
+    writer = FileIndexer(uri, min_level=LayerLevel.MINUTE)
+    await writer.load(mock_data_small_granularity)
+    reader = FileIndexer(uri, min_level=LayerLevel.MINUTE)
+    assert not reader.refresh()
+
+    await writer.add_many(mock_data_big_granularity)
+    await writer.compact()
+
+    date_from, date_to = intervals[0]
+    expected = np.array(sorted(set("abcdefghi")))
+    np.testing.assert_array_equal(reader.get(date_from, date_to), expected)
+    assert reader.refresh()
+    np.testing.assert_array_equal(reader.get(date_from, date_to), expected)
+    np.testing.assert_array_equal(
+        reader.get(*intervals[2]),
+        np.array(["b", "c", "d", "e", "f"]),
+    )
+    assert reader.last_update == writer.last_update
+
+
+@pytest.mark.asyncio
+async def test_file_indexer_load_during_compaction(tmp_path, monkeypatch):
+    """Test that a compaction overtaken by a load doesn't overwrite the file."""
+    uri = str(tmp_path / "index.eviex")
+    writer = FileIndexer(uri, min_level=LayerLevel.MINUTE)
+    await writer.load(mock_data_small_granularity)
+    await writer.add_many(mock_data_small_granularity)
+
+    merging = threading.Event()
+    release = threading.Event()
+    merge = FileIndexer._merge
+
+    def blocking_merge(self, *args):
+        merging.set()
+        release.wait()
+        return merge(self, *args)
+
+    monkeypatch.setattr(FileIndexer, "_merge", blocking_merge)
+    compaction = asyncio.ensure_future(writer.compact())
+    while not merging.is_set():
+        await asyncio.sleep(0.001)
+
+    await writer.load(mock_data_big_granularity)
+    release.set()
+    await compaction
+
+    expected = MemoryIndexer(min_level=LayerLevel.MINUTE)
+    await expected.load(mock_data_big_granularity)
+    reader = FileIndexer(uri, min_level=LayerLevel.MINUTE)
+    for date_from, date_to in intervals:
+        np.testing.assert_array_equal(
+            reader.get(date_from, date_to),
+            expected.get(date_from, date_to),
+        )
+        np.testing.assert_array_equal(
+            writer.get(date_from, date_to),
+            expected.get(date_from, date_to),
+        )
+
+    assert not writer.refresh()
+    assert os.listdir(tmp_path) == ["index.eviex"]
+
+
+@pytest.mark.asyncio
+async def test_file_indexer_get_many_added_items(tmp_path):
+    """Test that batch queries resolve the added items against the file dictionary."""
+    uri = str(tmp_path / "index.eviex")
+    indexer = FileIndexer(uri, min_level=LayerLevel.MINUTE)
+    await indexer.load(mock_data_small_granularity)
+    await indexer.add_many(
+        [
+            {
+                "timestamp": datetime(1970, 1, 1, h, 5, 0).replace(tzinfo=timezone.utc),
+                "values": values,
+            }
+            for h, values in [(0, ["z", "c"]), (1, ["y", "a"]), (3, ["zz"])]
+        ],
+    )
+
+    dates_from, dates_to = zip(*intervals)
+    actual = indexer.get_many(dates_from, dates_to)
+    for date_from, date_to, values in zip(dates_from, dates_to, actual):
+        np.testing.assert_array_equal(values, indexer.get(date_from, date_to))
+
+    np.testing.assert_array_equal(
+        indexer.get_many(dates_from, dates_to, combine=True),
+        np.unique(np.concatenate(actual)),
+    )
+
+
+@pytest.mark.asyncio
+async def test_file_indexer_configuration_mismatch(tmp_path):
+    """Test that a file can't be opened with a different configuration."""
+    uri = str(tmp_path / "index.eviex")
+    await FileIndexer(uri, min_level=LayerLevel.MINUTE).load(mock_data_big_granularity)
+
+    with pytest.raises(ValueError):
+        FileIndexer(uri, min_level=LayerLevel.HOUR)
+
+
+def test_file_indexer_not_an_index(tmp_path):
+    """Test that opening a file that is not an index fails."""
+    uri = tmp_path / "index.eviex"
+    uri.write_bytes(b"not an index file")
+
+    with pytest.raises(ValueError):
+        FileIndexer(str(uri))
+
+
+@pytest.mark.asyncio
+async def test_file_indexer_load_frame(tmp_path):
+    """Test that loading a frame persists the layers as loading items."""
+    uri = str(tmp_path / "index.eviex")
+    memory_indexer = MemoryIndexer(min_level=LayerLevel.MINUTE)
+    await memory_indexer.load(mock_data_big_granularity)
+    indexer = FileIndexer(uri, min_level=LayerLevel.MINUTE)
+    await indexer.load_frame(long_frame(mock_data_big_granularity), timestamp="ts")
+
+    reopened = FileIndexer(uri, min_level=LayerLevel.MINUTE)
+    for date_from, date_to in intervals:
+        np.testing.assert_array_equal(
+            reopened.get(date_from, date_to),
+            memory_indexer.get(date_from, date_to),
+        )
+
+
+@pytest.mark.asyncio
+async def test_file_indexer_occurrences(tmp_path):
+    """Test that values are looked up in the memory-mapped dictionary."""
+    uri = str(tmp_path / "index.eviex")
+    indexer = FileIndexer(uri, min_level=LayerLevel.MINUTE)
+    await indexer.load(mock_data_big_granularity)
+
+    reopened = FileIndexer(uri, min_level=LayerLevel.MINUTE)
+    assert reopened.first_seen("c") == datetime(1970, 3, 1).replace(tzinfo=timezone.utc)
+    assert len(reopened.occurrences("missing")) == 0
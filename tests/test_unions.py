@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from eviex.postings import BitmapPostings
+from eviex.postings import Postings
+from eviex.postings import PostingsUnion
+from eviex.unions import RangeUnions
+
+
+def random_postings(buckets: int, size: int, seed: int = 42) -> Postings:
+    """Return postings with a random number of distinct ids in each bucket."""
+    rng = np.random.RandomState(seed)
+    chunks = [
+        np.unique(rng.randint(0, size, size=rng.randint(1, 20)))
+        for _ in range(buckets)
+    ]
+    offsets = np.zeros(buckets + 1, dtype=np.int64)
+    np.cumsum([len(chunk) for chunk in chunks], out=offsets[1:])
+    return Postings(np.concatenate(chunks).astype(np.int32), offsets)
+
+
+@pytest.mark.parametrize("bitmaps", [False, True])
+@pytest.mark.parametrize("span", [1, 2, 5, 16, 64])
+def test_range_unions_collect(span, bitmaps):
+    """Test that the union of any range of buckets is the one of its buckets."""
+    postings = random_postings(37, 50)
+    if bitmaps:
+        postings = BitmapPostings.from_postings(postings, 50)
+
+    unions = RangeUnions.from_postings(postings, span, 50, bitmaps=bitmaps)
+    assert unions.shift == max(int(span - 1).bit_length(), 1)
+    assert len(unions.levels) == (37 >> unions.shift).bit_length()
+
+    for index_from in range(38):
+        for index_to in range(index_from, 38):
+            expected, actual = PostingsUnion(), PostingsUnion()
+            postings.collect(index_from, index_to, expected)
+            unions.collect(postings, index_from, index_to, actual)
+            np.testing.assert_array_equal(actual.ids(), expected.ids())
+
+
+def test_range_unions_blocks():
+    """Test that the blocks of each level hold the distinct ids of their buckets."""
+    postings = Postings(
+        np.array([0, 1, 1, 2, 3, 0, 4, 1, 5], dtype=np.int32),
+        np.array([0, 2, 3, 4, 6, 7, 9]),
+    )
+    unions = RangeUnions.from_postings(postings, 2, 6)
+
+    assert unions.shift == 1 and len(unions.levels) == 2
+    np.testing.assert_array_equal(unions.levels[0].ids, [0, 1, 0, 2, 3, 1, 4, 5])
+    np.testing.assert_array_equal(unions.levels[0].offsets, [0, 2, 5, 8])
+    np.testing.assert_array_equal(unions.levels[1].ids, [0, 1, 2, 3])
+    np.testing.assert_array_equal(unions.levels[1].offsets, [0, 4])
+
+    union = PostingsUnion()
+    unions.collect(postings, 0, 4, union)
+    assert len(union.chunks) == 1
+    assert unions.nbytes == sum(level.nbytes for level in unions.levels)